@@ -9,6 +9,7 @@
 
     utils
     workflows
+    management.commands.update_all_events
     fixtures.std
     fixtures.demo
     fixtures.demo2
@@ -31,6 +32,15 @@ class Plugin(ad.Plugin):
     ignore_dates_before = None
     ignore_dates_after = None
 
+    bulk_auto_events = False
+    """Whether :meth:`update_auto_events
+    <lino_xl.lib.cal.mixins.EventGenerator.update_auto_events>` should
+    write the automatic calendar entries in bulk.  See
+    :meth:`update_auto_events_bulk
+    <lino_xl.lib.cal.mixins.EventGenerator.update_auto_events_bulk>`.
+
+    """
+
     def on_init(self):
         tod = self.site.today()
         # self.ignore_dates_after = tod.replace(year=tod.year+5, day=28)
@@ -40,6 +50,13 @@ class Plugin(ad.Plugin):
     def on_site_startup(self, site):
         self.partner_model = site.models.resolve(self.partner_model)
         super(Plugin, self).on_site_startup(site)
+
+    def get_used_libs(self, html=None):
+        try:
+            from icalendar import __version__ as version
+        except ImportError:
+            version = self.site.not_found_msg
+        yield ("icalendar", version, "https://github.com/collective/icalendar")
         
     def setup_main_menu(self, site, user_type, m):
         m = m.add_menu(self.app_label, self.verbose_name)
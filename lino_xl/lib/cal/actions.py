@@ -13,6 +13,22 @@ from .workflows import EntryStates, GuestStates
 
 
 
+class SyncCalendar(dd.Action):
+    label = _("Synchronize")
+    help_text = _("Import the calendar entries of this remote calendar.")
+    readonly = False
+
+    def run_from_ui(self, ar, **kw):
+        for obj in ar.selected_rows:
+            rv = obj.sync()
+            if rv is None:
+                ar.info(_("{} is unchanged.").format(obj))
+            else:
+                ar.info(_("{} : {} created, {} updated, {} deleted.").format(
+                    obj, *rv))
+        ar.success(refresh=True)
+
+
 class ShowEntriesByDay(dd.Action):
     label = _("Today")
     show_in_bbar = True
@@ -73,6 +89,41 @@ class UpdateGuests(dd.Action):
                     obj, c, u, d)
         ar.info(msg)
 
+    def run_on_events(self, ar, events):
+        """Same as :meth:`run_on_event` for a list of calendar entries,
+        but reading and writing the guests in bulk.
+
+        """
+        Guest = rt.models.cal.Guest
+        events = [e for e in events if e.state.edit_guests]
+        if len(events) == 0:
+            return
+        existing = dict()
+        for g in Guest.objects.filter(event__in=events):
+            existing.setdefault(g.event_id, dict())[g.partner_id] = g
+        new = []
+        unwanted = []
+        u = 0
+        for obj in events:
+            eg = existing.get(obj.pk, dict())
+            # create suggested guest that don't exist
+            for sg in obj.suggest_guests():
+                if eg.pop(sg.partner_id, None) is None:
+                    new.append(sg)
+                else:
+                    u += 1
+            # remove unwanted participants
+            for g in eg.values():
+                if g.state == GuestStates.invited:
+                    unwanted.append(g.pk)
+        Guest.objects.bulk_create(new)
+        if len(unwanted):
+            Guest.objects.filter(pk__in=unwanted).delete()
+        msg = _("Update presences for {} entries : "
+                "{} created, {} unchanged, {} deleted.").format(
+                    len(events), len(new), u, len(unwanted))
+        ar.info(msg)
+
 
 class UpdateAllGuests(UpdateGuests):
     
@@ -85,8 +136,7 @@ class UpdateAllGuests(UpdateGuests):
             qs = Event.objects.filter(
                 **gfk2lookup(gfk, obj, state__in=states))
             def ok(ar2):
-                for e in qs:
-                    self.run_on_event(ar, e)
+                self.run_on_events(ar, list(qs))
 
             fmt = obj.get_date_formatter()
             txt = ', '.join([fmt(e.start_date) for e in qs])
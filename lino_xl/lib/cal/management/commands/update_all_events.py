@@ -0,0 +1,227 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2018 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""Defines the :manage:`update_all_events` admin command:
+
+.. management_command:: update_all_events
+
+.. py2rst::
+
+  from lino_xl.lib.cal.management.commands.update_all_events \
+      import Command
+  print(Command.help)
+
+
+"""
+
+from __future__ import unicode_literals, print_function
+from builtins import str
+
+import time
+import multiprocessing
+
+from django.conf import settings
+from django.db import connection, connections
+from django.core.management.base import BaseCommand
+
+from lino.api import dd, rt
+from lino.core.requests import BaseRequest
+from lino.core.roles import SiteAdmin
+
+from lino_xl.lib.cal.mixins import EventGenerator
+
+
+def puts(msg):
+    dd.logger.info(msg)
+
+
+def get_generator_partitions(models=[]):
+    """Return a list of the partitions of all event generators.
+
+    Every partition is a list of tuples `(model, pks)`.  The
+    generators of a partition are processed one after the other,
+    different partitions may be processed in parallel.  Generators of
+    models with a `room` field are partitioned by room (across all
+    these models), because conflicts occur only between entries in
+    the same room.  Generators without a room are partitioned by
+    model, and so are the generators of all other models.
+
+    `models` is a list of model names (e.g. "courses.Course").  If it
+    is empty, use all models which inherit from
+    :class:`EventGenerator <lino_xl.lib.cal.mixins.EventGenerator>`.
+
+    """
+    if len(models):
+        models = [dd.resolve_model(m) for m in models]
+    else:
+        models = rt.models_by_base(EventGenerator)
+    partitions = []
+    rooms = dict()
+    for m in models:
+        qs = m.objects.order_by('pk')
+        if 'room' in [f.name for f in m._meta.concrete_fields]:
+            noroom = []
+            for pk, room in qs.values_list('pk', 'room'):
+                if room is None:
+                    noroom.append(pk)
+                else:
+                    rooms.setdefault(room, dict()).setdefault(
+                        m, []).append(pk)
+            if len(noroom):
+                partitions.append([(m, noroom)])
+        else:
+            pks = list(qs.values_list('pk', flat=True))
+            if len(pks):
+                partitions.append([(m, pks)])
+    for room in sorted(rooms):
+        partitions.append(list(rooms[room].items()))
+    return partitions
+
+
+def get_default_username():
+    """Return the username of the first site administrator."""
+    for u in settings.SITE.user_model.objects.order_by('pk'):
+        if u.user_type and u.user_type.has_required_roles([SiteAdmin]):
+            return u.username
+
+
+def update_partition(partition, bulk=None, username=None):
+    """Update the automatic calendar entries of the generators of the
+    given partition (as returned by :func:`get_generator_partitions`),
+    acting as the user `username`.
+
+    Returns a list of tuples `(model, generator, count, seconds)`.
+
+    """
+    if username is None:
+        ar = BaseRequest()
+    else:
+        ar = rt.login(username)
+    rv = []
+    for model, pks in partition:
+        label = dd.full_model_name(model)
+        for obj in model.objects.filter(pk__in=pks).order_by('pk'):
+            started = time.time()
+            count = obj.update_auto_events(ar, bulk=bulk)
+            rv.append((label, str(obj), count, time.time() - started))
+    return rv
+
+
+def update_partition_worker(args):
+    partition, bulk, username = args
+    partition = [(dd.resolve_model(label), pks) for label, pks in partition]
+    return update_partition(partition, bulk, username)
+
+
+def update_all_events(models=[], workers=1, bulk=None, username=None):
+    """Update the automatic calendar entries of all event generators.
+    Called by :manage:`update_all_events`.  See there.
+
+    The partitions returned by :func:`get_generator_partitions` are
+    processed in a pool of `workers` processes.  Recurrent events
+    (e.g. holidays) are processed first and in the current process,
+    because their entries may conflict with any other entry.  When
+    the database is SQLite or when `workers` is less than 2,
+    everything is processed in the current process.
+
+    `bulk` is forwarded to :meth:`update_auto_events
+    <lino_xl.lib.cal.mixins.EventGenerator.update_auto_events>`.
+    The entries are updated on behalf of the user `username`
+    (default: the first site administrator).
+
+    Returns a list of tuples `(model, generator, count, seconds)`,
+    one for every generator.
+
+    """
+    if username is None:
+        username = get_default_username()
+    RecurrentEvent = rt.models.cal.RecurrentEvent
+    partitions = get_generator_partitions(models)
+
+    def is_first(p):
+        return all([m is RecurrentEvent for m, pks in p])
+
+    first = [p for p in partitions if is_first(p)]
+    others = [p for p in partitions if not is_first(p)]
+    if workers < 2 or connection.vendor == 'sqlite':
+        first += others
+        others = []
+
+    rv = []
+    for p in first:
+        rv += update_partition(p, bulk, username)
+
+    if len(others) == 0:
+        return rv
+
+    # The worker processes must not share the database connection of
+    # this process.
+    for conn in connections.all():
+        conn.close()
+    tasks = [([(dd.full_model_name(m), pks) for m, pks in p], bulk, username)
+             for p in others]
+    if hasattr(multiprocessing, 'get_context'):
+        pool = multiprocessing.get_context('fork').Pool(processes=workers)
+    else:
+        pool = multiprocessing.Pool(processes=workers)
+    try:
+        for rows in pool.imap_unordered(update_partition_worker, tasks):
+            rv += rows
+    finally:
+        pool.close()
+        pool.join()
+    return rv
+
+
+class Command(BaseCommand):
+    args = "[MODEL1] [MODEL2] ..."
+    help = """
+
+    Update the automatic calendar entries of all event generators.
+
+    If no arguments are given, run it on all event generators.
+    Otherwise every positional argument is expected to be the name of
+    a model (e.g. courses.Course), and only the generators of these
+    models are being updated.
+
+    Use --workers to update them in parallel processes.
+
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='MODEL')
+        parser.add_argument('-w', '--workers', type=int,
+                            dest='workers', default=1,
+                            help="Number of worker processes."),
+        parser.add_argument('-b', '--bulk', action='store_true',
+                            dest='bulk', default=None,
+                            help="Write the entries in bulk."),
+        parser.add_argument('-u', '--username', dest='username',
+                            default=None,
+                            help="The user on whose behalf to update "
+                            "the entries (default: the first site "
+                            "administrator)."),
+
+    def handle(self, *args, **options):
+        started = time.time()
+        rows = update_all_events(
+            models=options['models'] or args,
+            workers=options['workers'], bulk=options['bulk'],
+            username=options['username'])
+        verbose = options['verbosity'] > 1
+        totals = dict()
+        for label, obj, count, seconds in rows:
+            if verbose:
+                puts("{0} {1} : {2} entries in {3:.2f} seconds".format(
+                    label, obj, count, seconds))
+            t = totals.setdefault(label, [0, 0, 0.0])
+            t[0] += 1
+            t[1] += count or 0
+            t[2] += seconds
+        for label in sorted(totals):
+            n, count, seconds = totals[label]
+            puts("{0} : {1} generators, {2} entries, {3:.2f} seconds".format(
+                label, n, count, seconds))
+        puts("Updated {0} generators in {1:.2f} seconds.".format(
+            len(rows), time.time() - started))
@@ -6,9 +6,12 @@
 from __future__ import unicode_literals
 from builtins import str
 
+from itertools import islice
+
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.utils import translation
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
 from django.utils.encoding import force_text
@@ -29,11 +32,15 @@ from lino.modlib.notify.mixins import ChangeNotifier
 from .choicelists import Recurrencies, Weekdays, AccessClasses
 
 from .workflows import EntryStates
-from .utils import day_and_month, day_and_weekday
+from .utils import day_and_month, day_and_weekday, ConflictIndex
+from .utils import update_in_bulk, next_available_date
 from .actions import UpdateAllGuests
 
 from lino.utils.format_date import fdmy
 
+ALL_WEEKDAYS = (True, ) * 7
+
+
 def format_time(t):
     if t is None:
         return ''
@@ -181,13 +188,21 @@ class EventGenerator(dd.Model):
     def update_reminders(self, ar):
         return self.update_auto_events(ar)
 
-    def update_auto_events(self, ar):
+    def update_auto_events(self, ar, bulk=None):
         """Generate automatic calendar events owned by this contract.
 
+        If `bulk` is `True`, call :meth:`update_auto_events_bulk`
+        instead.  Default value is :attr:`bulk_auto_events
+        <lino_xl.lib.cal.Plugin.bulk_auto_events>`.
+
         """
         if settings.SITE.loading_from_dump:
             #~ print "20111014 loading_from_dump"
             return 0
+        if bulk is None:
+            bulk = dd.plugins.cal.bulk_auto_events
+        if bulk:
+            return self.update_auto_events_bulk(ar)
         rset = self.update_cal_rset()
         wanted, unwanted = self.get_wanted_auto_events(ar)
         # ar.info(
@@ -221,10 +236,78 @@ class EventGenerator(dd.Model):
         #~ logger.info("20130528 update_auto_events done")
         return count
 
+    def update_auto_events_bulk(self, ar):
+        """Same as :meth:`update_auto_events`, but collect the changes
+        and write them to the database in bulk: one query for deleting
+        all unwanted entries, one `bulk_create` for the new entries,
+        `bulk_update` (when available) for the modified entries, and
+        the guests of the new entries are created using
+        :meth:`fill_cal_guests`.
+
+        Note that no `pre_save` and `post_save` signals are sent for
+        the new entries.
+
+        """
+        Event = rt.models.cal.Event
+        rset = self.update_cal_rset()
+        updated = []
+        wanted, unwanted = self.get_wanted_auto_events(ar, updated)
+        count = len(wanted)
+        with transaction.atomic():
+            pks = [ee.pk for ee in unwanted.values()
+                   if not ee.is_user_modified()]
+            kept = [ee.pk for ee in unwanted.values()
+                    if ee.is_user_modified()]
+            if len(pks):
+                Event.objects.filter(pk__in=pks).delete()
+                count += len(pks)
+
+            # bulk writes don't call save(), so we must set the
+            # timestamps and the effective end date ourselves
+            now = timezone.now()
+            for ee, fields in updated:
+                ee.modified = now
+                ee.set_effective_end_date()
+                fields += ['modified', 'effective_end_date']
+            update_in_bulk(Event, updated)
+
+            new = list(wanted.values())
+            if len(new) == 0:
+                return count
+            for we in new:
+                if not we.is_user_modified():
+                    rset.before_auto_event_save(we)
+                we.set_default_access_class()
+                we.set_effective_end_date()
+                we.created = we.modified = now
+            Event.objects.bulk_create(new)
+            if new[0].pk is None:
+                # the database backend didn't return the primary keys.
+                # User-modified entries which have been kept may have
+                # the same auto_type as a new entry.
+                qs = self.get_existing_auto_events().filter(
+                    auto_type__in=[we.auto_type for we in new])
+                qs = qs.exclude(pk__in=kept)
+                ids = dict(qs.values_list('auto_type', 'id'))
+                for we in new:
+                    we.id = ids[we.auto_type]
+            self.fill_cal_guests(new)
+        return count
+
     def setup_auto_event(self, obj):
         pass
 
-    def get_wanted_auto_events(self, ar):
+    def get_wanted_auto_events(self, ar, updated=None):
+        """Return two dicts `wanted` and `unwanted`, each of them
+        mapping the sequence number to a calendar entry.
+
+        Existing entries which need to be modified are saved
+        immediately.  Except when `updated` is a list, then they are
+        not saved but appended to that list as tuples `(entry,
+        fields)` where `fields` is a list of the names of the modified
+        fields.
+
+        """
 
         wanted = dict()
         unwanted = dict()
@@ -298,6 +381,7 @@ class EventGenerator(dd.Model):
                 date, until, max_events)
         ignore_before = dd.plugins.cal.ignore_dates_before
         user = self.get_events_user()
+        conflicts = ConflictIndex(date, until, owner=self)
         # if max_events is not None and event_no >= max_events:
         #     raise Exception("20180321")
         with translation.override(self.get_events_language()):
@@ -323,7 +407,8 @@ class EventGenerator(dd.Model):
                         start_time=rset.start_time,
                         end_time=rset.end_time)
                     self.setup_auto_event(we)
-                    date = self.resolve_conflicts(we, ar, rset, until)
+                    date = self.resolve_conflicts(
+                        we, ar, rset, until, conflicts)
                     if date is None:
                         ar.info("Could not resolve conflicts for %s",
                                 event_no)
@@ -336,12 +421,17 @@ class EventGenerator(dd.Model):
                             "%s has been moved from %s to %s."
                             % (ee.summary, date, ee.start_date))
                         date = ee.start_date
-                    else:
+                    elif updated is None:
                         rset.compare_auto_event(ee, we)
                         # we don't need to add it to wanted because
                         # compare_auto_event() saves any changes
                         # immediately.
                         # wanted[event_no] = we
+                    else:
+                        fields = rset.compare_auto_event(
+                            ee, we, save=False)
+                        if fields:
+                            updated.append((ee, fields))
                 date = rset.get_next_suggested_date(ar, date)
                 date = rset.find_start_date(date)
                 if date is None:
@@ -383,8 +473,26 @@ class EventGenerator(dd.Model):
     def care_about_conflicts(self, we):
         return True
 
-    def resolve_conflicts(self, we, ar, rset, until):
-    
+    def resolve_conflicts(self, we, ar, rset, until, conflicts=None):
+        """Move the given entry `we` to the next alternative date until
+        it has no conflicts.  Return the new date, or `None` if no
+        date before `until` was found.
+
+        `conflicts` is an optional :class:`ConflictIndex
+        <lino_xl.lib.cal.utils.ConflictIndex>` to use instead of
+        asking the database for every candidate date.
+
+        """
+        if conflicts is None:
+            has_conflicts = we.has_conflicting_events
+            get_conflicts = we.get_conflicting_events
+        else:
+            def has_conflicts():
+                return conflicts.has_conflicting_events(we)
+
+            def get_conflicts():
+                return conflicts.get_conflicting_events(we)
+
         date = we.start_date
         if rset == Recurrencies.once:
             return date
@@ -394,8 +502,8 @@ class EventGenerator(dd.Model):
         #     ar.info("20171130 resolve_conflicts() %s",
         #             we.has_conflicting_events())
         # ar.debug("20140310 resolve_conflicts %s", we.start_date)
-        while we.has_conflicting_events():
-            qs = we.get_conflicting_events()
+        while has_conflicts():
+            qs = get_conflicts()
             date = rset.get_next_alt_date(ar, date)
             ar.debug("%s wants %s but conflicts with %s, moving to %s. ",
                      we.summary, we.start_date, qs, date)
@@ -431,6 +539,44 @@ class EventGenerator(dd.Model):
 
         return []
 
+    def get_wanted_cal_guests(self, events):
+        """Return a dict which maps the primary key of each of the given
+        calendar entries to a list of (unsaved) :class:`Guest
+        <lino_xl.lib.cal.models.Guest>` objects.  The default
+        implementation calls :meth:`suggest_cal_guests` for every
+        entry.  Subclasses may override this to compute the guests of
+        all entries at once.
+
+        """
+        return {e.pk: list(self.suggest_cal_guests(e)) for e in events}
+
+    def fill_cal_guests(self, events=None):
+        """Create the missing guests of the given calendar entries
+        (default: all automatic entries of this generator) in bulk.
+        Entries in a fixed state are skipped.  Existing guests are
+        left unchanged.
+
+        Returns the number of created guests.
+
+        """
+        Guest = rt.models.cal.Guest
+        if events is None:
+            events = self.get_existing_auto_events()
+        events = [e for e in events if not e.is_fixed_state()]
+        if len(events) == 0:
+            return 0
+        existing = set(Guest.objects.filter(event__in=events).values_list(
+            'event_id', 'partner_id'))
+        new = []
+        for pk, guests in self.get_wanted_cal_guests(events).items():
+            for g in guests:
+                k = (pk, g.partner_id)
+                if k not in existing:
+                    existing.add(k)
+                    new.append(g)
+        Guest.objects.bulk_create(new)
+        return len(new)
+
     @classmethod
     def get_cal_entry_renderer(cls, fmt):
         show_auto_num = False
@@ -596,40 +742,111 @@ class RecurrenceSet(Started, Ended):
         if self.every_unit == Recurrencies.once:
             ar.debug("get_next_suggested_date() once --> None.")
             return None
+        return next_available_date(
+            self.add_recurrence(date), self.get_weekday_mask())
+
+    def add_recurrence(self, date):
+        """Return the given date plus one recurrence step (without
+        looking at the weekdays).
+
+        """
         if self.every_unit == Recurrencies.per_weekday:
-            date = date + ONE_DAY
-        else:
-            date = self.every_unit.add_duration(date, self.every)
-        return self.find_start_date(date)
+            return date + ONE_DAY
+        return self.every_unit.add_duration(date, self.every)
 
     def find_start_date(self, date):
         """Find the first available date for the given date (possibly
         including that date)
 
         """
-
-        if date is not None:
-            for i in range(7):
-                if self.is_available_on(date):
-                    return date
-                date += ONE_DAY
-        return None
+        return next_available_date(date, self.get_weekday_mask())
 
     def is_available_on(self, date):
         """Whether the given date `date` is allowed according to the weekdays
         of this recurrence set.
 
         """
-        if self.monday or self.tuesday or self.wednesday or self.thursday \
-           or self.friday or self.saturday or self.sunday:
-            wd = date.isoweekday()  # Monday:1, Tuesday:2 ... Sunday:7
-            wd = Weekdays.get_by_value(str(wd))
-            rv = getattr(self, wd.name)
-            #~ logger.info('20130529 is_available_on(%s) -> %s -> %s',date,wd,rv)
-            return rv
-        return True
+        return self.get_weekday_mask()[date.weekday()]
+
+    def get_weekday_mask(self):
+        """Return a tuple of seven booleans (Monday first) which says for
+        every weekday whether it is allowed.  If no weekday is
+        checked, all weekdays are allowed.
+
+        """
+        mask = (self.monday, self.tuesday, self.wednesday, self.thursday,
+                self.friday, self.saturday, self.sunday)
+        if any(mask):
+            return mask
+        return ALL_WEEKDAYS
+
+    def iter_recurrence_dates(self, date, until, max_events=None,
+                              ignore_before=None):
+        """Yield a tuple `(event_no, date)` for every date of this
+        recurrence set, starting at the first available date on or
+        after the given `date` and ending at `until` or after
+        `max_events` dates.
+
+        Dates before `ignore_before` are skipped but counted.
+        Conflicts with other calendar entries are not considered.
+        This is the series which :meth:`get_wanted_auto_events
+        <EventGenerator.get_wanted_auto_events>` would generate in a
+        calendar without other entries.
+
+        """
+        if not self.every_unit:
+            return
+        mask = self.get_weekday_mask()
+        date = next_available_date(date, mask)
+        event_no = 0
+        while date is not None and date <= until:
+            if max_events is not None and event_no >= max_events:
+                return
+            event_no += 1
+            if ignore_before is None or date >= ignore_before:
+                yield event_no, date
+            if self.every_unit == Recurrencies.once:
+                return
+            date = next_available_date(self.add_recurrence(date), mask)
+
+    def get_upcoming_dates(self, count=5):
+        """Return a list of the next `count` dates of this recurrence set,
+        starting today.
 
-    def compare_auto_event(self, obj, ae):
+        When this is also an :class:`EventGenerator`, the dates end
+        where :meth:`get_wanted_auto_events
+        <EventGenerator.get_wanted_auto_events>` would stop generating
+        entries.
+
+        """
+        until = None
+        if isinstance(self, EventGenerator):
+            until = self.update_cal_until()
+        until = until or dd.plugins.cal.ignore_dates_after
+        if self.start_date is None or until is None:
+            return []
+        if self.max_events is None:
+            max_events = settings.SITE.site_config.max_auto_events
+        else:
+            max_events = self.max_events
+        dates = self.iter_recurrence_dates(
+            self.start_date, until, max_events, dd.today())
+        return [d for i, d in islice(dates, count)]
+
+    @dd.displayfield(_("Upcoming dates"))
+    def upcoming_dates(self, ar):
+        if ar is None:
+            return ''
+        return ', '.join([fdmy(d) for d in self.get_upcoming_dates()])
+
+    def compare_auto_event(self, obj, ae, save=True):
+        """Update the existing automatic entry `obj` with the values of
+        the wanted entry `ae`.  Save it unless `save` is `False`.
+
+        Return a list with the names of the fields which have been
+        modified.
+
+        """
         original_state = dict(obj.__dict__)
         summary = force_text(ae.summary)
         if obj.summary != summary:
@@ -650,8 +867,13 @@ class RecurrenceSet(Started, Ended):
             obj.room = ae.room
         if not obj.is_user_modified():
             self.before_auto_event_save(obj)
-        if obj.__dict__ != original_state:
+        if obj.__dict__ == original_state:
+            return []
+        if save:
             obj.save()
+        return [f.name for f in obj._meta.concrete_fields
+                if obj.__dict__.get(f.attname)
+                != original_state.get(f.attname)]
 
     def before_auto_event_save(self, event):
         """
@@ -767,11 +989,21 @@ class Component(Started,
 Whether this is private, public or between."""))  # iCal:CLASS
     sequence = models.IntegerField(_("Revision"), default=0)
     auto_type = models.IntegerField(_("No."), null=True, blank=True)
+    uid = models.CharField(
+        _("UID"), max_length=200, blank=True, editable=False)
 
     def save(self, *args, **kw):
+        self.set_default_access_class()
+        super(Component, self).save(*args, **kw)
+
+    def set_default_access_class(self):
+        """Set the :attr:`access_class` to that of the :attr:`user` if it
+        is empty.  Called by :meth:`save` and before creating entries
+        in bulk.
+
+        """
         if self.user is not None and self.access_class is None:
             self.access_class = self.user.access_class
-        super(Component, self).save(*args, **kw)
 
     def on_duplicate(self, ar, master):
         self.auto_type = None
@@ -787,7 +1019,12 @@ Whether this is private, public or between."""))  # iCal:CLASS
         """
         This is going to be used when sending
         locally created components to a remote calendar.
+
+        Components imported from a remote calendar keep their
+        original UID.
         """
+        if self.uid:
+            return self.uid
         if not settings.SITE.uid:
             raise Exception(
                 'Cannot create local calendar components because settings.SITE.uid is empty.')
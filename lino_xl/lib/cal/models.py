@@ -7,22 +7,32 @@ from __future__ import unicode_literals
 from builtins import str
 import six
 
+import base64
 import datetime
+import hashlib
+import time
 
-from django.db import models
+from six.moves.urllib.request import Request, urlopen
+from six.moves.urllib.error import HTTPError
+
+from django.db import models, transaction
 from django.db.models import Q
+from django.db.models.signals import post_delete
 from django.conf import settings
 from django.core.validators import MaxValueValidator
 from django.core.validators import MinValueValidator
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 
+from atelier.utils import last_day_of_month
+
 from lino import mixins
 from lino.api import dd, rt, _, pgettext
 
 from .choicelists import (
     DurationUnits, Recurrencies, Weekdays, AccessClasses, PlannerColumns)
-from .utils import setkw, dt2kw, when_text
+from .utils import setkw, dt2kw, when_text, ConflictIndex
+from .utils import update_in_bulk, read_ics_events
 
 from lino.modlib.checkdata.choicelists import Checker
 from lino.modlib.printing.mixins import TypedPrintable
@@ -33,7 +43,7 @@ from lino_xl.lib.outbox.mixins import MailableType, Mailable
 from lino_xl.lib.contacts.mixins import ContactRelated
 from lino.modlib.office.roles import OfficeStaff
 from .workflows import (TaskStates, EntryStates, GuestStates)
-from .actions import UpdateGuests
+from .actions import UpdateGuests, SyncCalendar
     
 from .mixins import Component
 from .mixins import EventGenerator, RecurrenceSet, Reservation
@@ -41,7 +51,7 @@ from .mixins import Ended
 from .mixins import MoveEntryNext, UpdateEntries, UpdateEntriesByEvent
 from .actions import ShowEntriesByDay
 
-from .ui import ConflictingEvents
+from .ui import ConflictingEvents, clear_summary_cache
 
 DEMO_START_YEAR = 2013
 
@@ -175,6 +185,11 @@ class DailyPlanner(DailyPlannerRows):
     
 
     
+FETCH_TIMEOUT = 30
+"""Number of seconds to wait for the server when fetching a
+:class:`RemoteCalendar`."""
+
+
 class RemoteCalendar(mixins.Sequenced):
 
     class Meta:
@@ -194,6 +209,12 @@ class RemoteCalendar(mixins.Sequenced):
     password = dd.PasswordField(_("Password"),
                                 max_length=200, blank=True)  # ,null=True)
     readonly = models.BooleanField(_("read-only"), default=False)
+    sync_token = models.CharField(
+        _("Sync token"), max_length=200, blank=True, editable=False)
+    sync_hash = models.CharField(
+        _("Sync hash"), max_length=40, blank=True, editable=False)
+
+    sync_calendar = SyncCalendar()
 
     def get_url(self):
         if self.url_template:
@@ -207,6 +228,100 @@ class RemoteCalendar(mixins.Sequenced):
         ct.validate_calendar(self)
         super(RemoteCalendar, self).save(*args, **kw)
 
+    def fetch(self):
+        """Read the iCalendar data of this calendar.  The url is either
+        the name of a local file or an HTTP URL.  Return a tuple
+        `(data, token)` where `token` is the ETag sent by the server.
+        `data` is `None` when the server says that nothing has changed
+        since the last synchronization, or when this calendar has no
+        url.
+
+        If :attr:`username` is given, the request uses HTTP basic
+        authentication.  The server must answer within
+        :data:`FETCH_TIMEOUT` seconds.
+
+        """
+        url = self.get_url()
+        if not url:
+            return None, self.sync_token
+        if url.startswith('file://'):
+            url = url[7:]
+        if '://' not in url:
+            with open(url, 'rb') as f:
+                return f.read(), ''
+        req = Request(url)
+        if self.sync_token:
+            req.add_header('If-None-Match', self.sync_token)
+        if self.username:
+            credentials = "{}:{}".format(self.username, self.password)
+            req.add_header('Authorization', 'Basic ' + base64.b64encode(
+                credentials.encode('utf-8')).decode('ascii'))
+        try:
+            resp = urlopen(req, timeout=FETCH_TIMEOUT)
+        except HTTPError as e:
+            if e.code == 304:
+                return None, self.sync_token
+            raise
+        return resp.read(), resp.headers.get('ETag') or ''
+
+    def sync(self, force=False):
+        """Import the entries of this remote calendar.  Create, update or
+        delete the calendar entries of this calendar so that they
+        match the remote data, using their UID (see
+        :meth:`Component.get_uid
+        <lino_xl.lib.cal.mixins.Component.get_uid>`) for identifying
+        them.
+
+        Don't touch the database when the remote data didn't change
+        since the last call (unless `force` is `True`).
+
+        Return a tuple with the number of created, updated and deleted
+        entries, or `None` if nothing has changed.
+
+        """
+        data, token = self.fetch()
+        if data is None:
+            return None
+        h = hashlib.sha1(data).hexdigest()
+        if h == self.sync_hash and not force:
+            if token != self.sync_token:
+                self.sync_token = token
+                self.save()
+            return None
+        Event = rt.models.cal.Event
+        existing = {
+            e.get_uid(): e
+            for e in Event.objects.filter(remote_calendar=self)}
+        now = timezone.now()
+        new = []
+        updated = []
+        for uid, kw in read_ics_events(data).items():
+            obj = existing.pop(uid, None)
+            if obj is None:
+                obj = Event(
+                    remote_calendar=self, uid=uid,
+                    created=now, modified=now, **kw)
+                obj.set_effective_end_date()
+                new.append(obj)
+                continue
+            fields = [k for k, v in kw.items() if getattr(obj, k) != v]
+            if fields:
+                setkw(obj, **kw)
+                obj.modified = now
+                obj.set_effective_end_date()
+                updated.append(
+                    (obj, fields + ['modified', 'effective_end_date']))
+        with transaction.atomic():
+            if len(existing):
+                Event.objects.filter(
+                    pk__in=[e.pk for e in existing.values()]).delete()
+            Event.objects.bulk_create(new)
+            update_in_bulk(Event, updated)
+            self.sync_token = token
+            self.sync_hash = h
+            self.save()
+        return len(new), len(updated), len(existing)
+
 
 class Room(mixins.BabelNamed, ContactRelated):
     class Meta:
@@ -460,16 +575,26 @@ class Event(Component, Ended, Assignable, TypedPrintable, Mailable, Postable):
         verbose_name_plural = _("Calendar entries")
         # verbose_name = pgettext("cal", "Event")
         # verbose_name_plural = pgettext("cal", "Events")
+        # see get_range_queryset()
+        index_together = [
+            ('effective_end_date', 'start_date'),
+            ('room', 'effective_end_date', 'start_date'),
+            ('user', 'effective_end_date', 'start_date')]
 
     update_guests = UpdateGuests()
     update_events = UpdateEntriesByEvent()
     show_today = ShowEntriesByDay('start_date')
+    allow_cascaded_delete = ['remote_calendar']
 
     event_type = dd.ForeignKey('cal.EventType', blank=True, null=True)
 
     transparent = models.BooleanField(_("Transparent"), default=False)
     room = dd.ForeignKey('cal.Room', null=True, blank=True)
     priority = dd.ForeignKey(Priority, null=True, blank=True)
+    remote_calendar = dd.ForeignKey(
+        'cal.RemoteCalendar', null=True, blank=True, editable=False)
+    effective_end_date = models.DateField(
+        _("Effective end date"), null=True, blank=True, editable=False)
     state = EntryStates.field(
         default=EntryStates.as_callable('suggested'))
     all_day = ExtAllDayField(_("all day"))
@@ -537,6 +662,43 @@ class Event(Component, Ended, Assignable, TypedPrintable, Mailable, Postable):
                 yield (u, u.mail_mode)
     
         
+    def save(self, *args, **kw):
+        self.set_effective_end_date()
+        super(Event, self).save(*args, **kw)
+
+    def set_effective_end_date(self):
+        """Set :attr:`effective_end_date` to the last day of this entry.
+        Called by :meth:`save` and before writing entries in bulk.
+
+        """
+        self.effective_end_date = self.end_date or self.start_date
+
+    @classmethod
+    def get_range_queryset(cls, start_date, end_date, rooms=None,
+                           users=None):
+        """Return a queryset of the calendar entries which overlap with
+        the given date range, optionally restricted to the given lists
+        of rooms and responsible users.
+
+        The filter uses the :attr:`effective_end_date` and is served
+        by the composite indexes of this model, so the query doesn't
+        get slower when the history grows.
+
+        Entries without :attr:`effective_end_date` are not found.  The
+        field is filled by :meth:`save`, i.e. also when a site is
+        migrated by restoring a Python dump.  Otherwise run
+        :class:`EffectiveEndDateChecker` with ``--fix`` after adding
+        the field.
+
+        """
+        qs = cls.objects.filter(
+            effective_end_date__gte=start_date, start_date__lte=end_date)
+        if rooms is not None:
+            qs = qs.filter(room__in=rooms)
+        if users is not None:
+            qs = qs.filter(user__in=users)
+        return qs
+
     def has_conflicting_events(self):
         qs = self.get_conflicting_events()
         if qs is None:
@@ -840,16 +1002,48 @@ class EventGuestChecker(EntryChecker):
 EventGuestChecker.activate()
 
 
+CONFLICT_INDEX_TIMEOUT = 60
+"""Number of seconds during which :class:`ConflictingEventsChecker`
+reuses its indexes of calendar entries."""
+
+
 class ConflictingEventsChecker(EntryChecker):
+    """Uses one :class:`ConflictIndex
+    <lino_xl.lib.cal.utils.ConflictIndex>` per month for all entries
+    checked during a run.  A new run is assumed to start when an entry
+    is checked for the second time or when the indexes are older than
+    :data:`CONFLICT_INDEX_TIMEOUT` seconds.
+
+    """
     verbose_name = _("Check for conflicting calendar entries")
+    _indexes = None
+    _checked = None
+    _built = None
+
+    def get_index(self, obj):
+        if self._indexes is None or obj.pk in self._checked \
+           or time.time() - self._built > CONFLICT_INDEX_TIMEOUT:
+            self._indexes = dict()
+            self._checked = set()
+            self._built = time.time()
+        self._checked.add(obj.pk)
+        start = obj.start_date.replace(day=1)
+        index = self._indexes.get(start)
+        if index is None:
+            index = ConflictIndex(start, last_day_of_month(start))
+            self._indexes[start] = index
+        return index
 
     def get_checkdata_problems(self, obj, fix=False):
-        if not obj.has_conflicting_events():
+        if obj.start_date is None:
+            return
+        index = self.get_index(obj)
+        if not index.has_conflicting_events(obj):
             return
-        qs = obj.get_conflicting_events()
-        num = qs.count()
+        lst = index.get_conflicting_events(obj)
+        num = len(lst)
         if num == 1:
-            msg = _("Event conflicts with {0}.").format(qs[0])
+            msg = _("Event conflicts with {0}.").format(lst[0])
         else:
             msg = _("Event conflicts with {0} other events.").format(num)
         yield (False, msg)
@@ -902,6 +1096,21 @@ class LongEntryChecker(EntryChecker):
 LongEntryChecker.activate()
 
 
+class EffectiveEndDateChecker(EntryChecker):
+    verbose_name = _("Check the effective end date of calendar entries")
+    model = Event
+
+    def get_checkdata_problems(self, obj, fix=False):
+        expected = obj.end_date or obj.start_date
+        if obj.effective_end_date != expected:
+            yield (True, _("Effective end date must be {}.").format(expected))
+            if fix:
+                Event.objects.filter(pk=obj.pk).update(
+                    effective_end_date=expected)
+
+EffectiveEndDateChecker.activate()
+
+
 @dd.python_2_unicode_compatible
 class Guest(Printable):
     workflow_state_field = 'state'
@@ -1049,6 +1258,15 @@ events after the given date.""")
 
 Reservation.show_today = ShowEntriesByDay('start_date')
 
+
+@dd.receiver(dd.post_save, sender=Event,
+             dispatch_uid="clear_entries_summary_on_save")
+@dd.receiver(post_delete, sender=Event,
+             dispatch_uid="clear_entries_summary_on_delete")
+def clear_entries_summary(sender=None, instance=None, **kw):
+    if instance.owner_type_id is not None:
+        clear_summary_cache(instance.owner_type_id, instance.owner_id)
+
 if False:  # removed 20160610 because it is probably not used
 
     def update_reminders_for_user(user, ar):
@@ -5,10 +5,14 @@
 
 from __future__ import unicode_literals
 from builtins import str
+import copy
 from collections import OrderedDict
 
 from django.conf import settings
 from django.db import models
+from django.db.models import Count, Max
+from django.contrib.contenttypes.models import ContentType
+from django.utils.translation import get_language
 
 from lino.api import dd, rt, _
 from lino import mixins
@@ -541,6 +545,7 @@ class RecurrentEvents(dd.Table):
     start_date start_time  end_date end_time
     every_unit every max_events
     monday tuesday wednesday thursday friday saturday sunday
+    upcoming_dates
     description cal.EntriesByController
     """
 
@@ -924,6 +929,39 @@ class CalendarRenderer(object):
         
 
 
+SUMMARY_CACHE_SIZE = 200
+"""Maximum number of calendar views to keep in :data:`SUMMARY_CACHE`."""
+
+SUMMARY_CACHE = OrderedDict()
+"""The calendar views rendered by :meth:`EntriesByController.get_table_summary`,
+indexed by :func:`summary_cache_key`.  The least recently used views
+are removed when there are more than :data:`SUMMARY_CACHE_SIZE`."""
+
+
+def summary_cache_key(owner, ar):
+    """The rendered view depends on the controller and on the user who
+    asks for it (visible entries, links and permissions).
+
+    """
+    user = ar.get_user()
+    return (ContentType.objects.get_for_model(owner.__class__).pk, owner.pk,
+            getattr(user, 'pk', None),
+            getattr(user.user_type, 'value', None))
+
+
+def clear_summary_cache(owner_type_id, owner_id):
+    """Forget the cached summaries of the calendar entries of the given
+    controller.  Called when one of its entries is saved or deleted.
+    The cache is also invalidated when the newest modification time
+    or the number of the entries changes, so entries written without
+    sending signals (e.g. in bulk) are covered as well.
+
+    """
+    for k in list(SUMMARY_CACHE.keys()):
+        if k[0] == owner_type_id and k[1] == owner_id:
+            SUMMARY_CACHE.pop(k, None)
+
+
 class EntriesByController(Events):
     required_roles = dd.login_required((OfficeOperator, OfficeUser))
     # required_roles = dd.login_required(OfficeUser)
@@ -940,20 +978,32 @@ class EntriesByController(Events):
         if ar is None:
             return ''
         sar = self.request_from(ar, master_instance=obj)
+        qs = sar.data_iterator.order_by()
 
         state_coll = {}
-        cal = CalendarRenderer()
-        for evt in sar:
-            # if len(elems) > 0:
-            #     elems.append(', ')
-            if evt.state in state_coll:
-                state_coll[evt.state] += 1
-            else:
-                state_coll[evt.state] = 1
-
-            cal.collect(evt.start_date, evt)
-
-        elems = [cal.to_html(ar)]
+        for row in qs.values('state').annotate(n=Count('id')):
+            st = EntryStates.get_by_value(getattr(
+                row['state'], 'value', row['state']))
+            state_coll[st] = row['n']
+
+        d = qs.aggregate(Max('modified'), Count('id'))
+        key = summary_cache_key(obj, ar)
+        stamp = (d['modified__max'], d['id__count'], get_language(),
+                 ar.renderer.__class__.__name__)
+        cached = SUMMARY_CACHE.pop(key, None)
+        if cached is not None and cached[0] == stamp:
+            html = copy.deepcopy(cached[1])
+        else:
+            cal = CalendarRenderer()
+            for evt in sar:
+                cal.collect(evt.start_date, evt)
+            html = cal.to_html(ar)
+            cached = (stamp, copy.deepcopy(html))
+        SUMMARY_CACHE[key] = cached
+        while len(SUMMARY_CACHE) > SUMMARY_CACHE_SIZE:
+            SUMMARY_CACHE.popitem(last=False)
+
+        elems = [html]
 
         ul = []
         for st in EntryStates.get_list_items():
@@ -26,13 +26,17 @@ import datetime
 from dateutil.tz import tzlocal
 
 from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.encoding import force_text
 
+from lino.utils import ONE_DAY
+
 from lino.utils.format_date import format_date
 from lino.utils.format_date import fds
 from lino.utils.format_date import day_and_month, day_and_weekday
 
-from lino.api import rt
+from lino.api import rt, _
 
 
 def aware(d):
@@ -69,6 +73,62 @@ def dt2kw(dt, name, **d):
     return d
 
 
+def read_ics_events(data):
+    """Parse the given iCalendar data and return a dict which maps the
+    UID of every event to a dict of field values for a calendar entry.
+
+    Requires the `icalendar` package.  Recurring events are imported
+    as a single entry at their first date.
+
+    """
+    try:
+        from icalendar import Calendar
+    except ImportError:
+        raise Warning(_(
+            "Cannot read iCalendar data because the icalendar "
+            "package is not installed."))
+    EntryStates = rt.models.cal.EntryStates
+    rv = dict()
+    for comp in Calendar.from_ical(data).walk('VEVENT'):
+        uid = force_text(comp.get('uid', ''))
+        if not uid or 'recurrence-id' in comp:
+            continue
+        kw = dict(
+            summary=force_text(comp.get('summary', ''))[:200],
+            description=force_text(comp.get('description', '')),
+            sequence=int(comp.get('sequence', 0)),
+            transparent=force_text(
+                comp.get('transp', '')).upper() == 'TRANSPARENT')
+        if force_text(comp.get('status', '')).upper() == 'CANCELLED':
+            kw.update(state=EntryStates.cancelled)
+        else:
+            kw.update(state=EntryStates.draft)
+        start = local_datetime(comp.decoded('dtstart'))
+        kw = dt2kw(start, 'start', **kw)
+        if 'dtend' in comp:
+            end = local_datetime(comp.decoded('dtend'))
+            if not isinstance(end, datetime.datetime):
+                # DTEND of an all-day event is the day after its last day
+                end -= ONE_DAY
+            kw = dt2kw(end, 'end', **kw)
+        else:
+            kw = dt2kw(None, 'end', **kw)
+        if kw['end_date'] == kw['start_date']:
+            kw['end_date'] = None
+        rv[uid] = kw
+    return rv
+
+
+def local_datetime(dt):
+    """Convert the given timezone-aware datetime into a naive local
+    datetime.  Return other values unchanged.
+
+    """
+    if isinstance(dt, datetime.datetime) and dt.tzinfo is not None:
+        return timezone.make_naive(dt)
+    return dt
+
+
 def setkw(obj, **kw):
     for k, v in kw.items():
         setattr(obj, k, v)
@@ -102,6 +162,37 @@ def when_text(d, t=None):
     return txt
 
 
+def next_available_date(date, mask):
+    """Return the first date on or after the given `date` whose weekday
+    is allowed by the given weekday `mask` (as returned by
+    :meth:`RecurrenceSet.get_weekday_mask
+    <lino_xl.lib.cal.mixins.RecurrenceSet.get_weekday_mask>`).
+
+    Examples:
+
+    >>> mask = (True, False, True, False, False, False, False)
+    >>> next_available_date(datetime.date(2018, 6, 1), mask)
+    datetime.date(2018, 6, 4)
+    >>> next_available_date(datetime.date(2018, 6, 4), mask)
+    datetime.date(2018, 6, 4)
+    >>> next_available_date(datetime.date(2018, 6, 5), mask)
+    datetime.date(2018, 6, 6)
+
+    When no weekday is allowed, there is no available date:
+
+    >>> print(next_available_date(datetime.date(2018, 6, 5), (False,) * 7))
+    None
+
+    """
+    if date is None:
+        return None
+    wd = date.weekday()
+    for i in range(7):
+        if mask[(wd + i) % 7]:
+            return date + datetime.timedelta(days=i)
+    return None
+
+
 def update_auto_event(
         autotype, user, date, summary, owner, **defaults):
     return update_auto_component(
@@ -181,3 +272,295 @@ def update_reminder(type, owner, user, orig, msg, num, unit):
         owner)
 
 
+
+
+def update_in_bulk(model, rows):
+    """Save the given modified database objects of the given `model`.
+    `rows` is a list of tuples `(obj, fields)` where `fields` is a
+    list of the names of the modified fields of `obj`.
+
+    Uses `bulk_update` when Django provides it (2.2 and later),
+    otherwise saves every object with `update_fields`.
+
+    Examples:
+
+    >>> class Entry(object):
+    ...     def __init__(self, pk):
+    ...         self.pk = pk
+    ...     def save(self, update_fields):
+    ...         print("save({0}, {1})".format(
+    ...             self.pk, ', '.join(update_fields)))
+    >>> class Manager(object):
+    ...     def bulk_update(self, objs, fields):
+    ...         print("bulk_update({0}, {1})".format(
+    ...             [obj.pk for obj in objs], ', '.join(fields)))
+    >>> class Model(object):
+    ...     objects = Manager()
+    >>> class OldModel(object):
+    ...     objects = object()
+    >>> rows = [(Entry(1), ['summary']), (Entry(2), ['start_date', 'summary'])]
+    >>> update_in_bulk(Model, rows)
+    bulk_update([1, 2], start_date, summary)
+    >>> update_in_bulk(OldModel, rows)
+    save(1, summary)
+    save(2, start_date, summary)
+    >>> update_in_bulk(Model, [])
+
+    """
+    if len(rows) == 0:
+        return
+    if hasattr(model.objects, 'bulk_update'):
+        fields = set()
+        for obj, names in rows:
+            fields.update(names)
+        model.objects.bulk_update(
+            [obj for obj, names in rows], sorted(fields))
+    else:
+        for obj, names in rows:
+            obj.save(update_fields=names)
+
+
+_ALL_ROOMS = object()
+
+
+class ConflictIndex(object):
+    """An in-memory index of the calendar entries between `start_date`
+    and `end_date`, used to detect conflicts without running database
+    queries for every candidate date.
+
+    The methods :meth:`get_conflicting_events` and
+    :meth:`has_conflicting_events` give the same answers as the
+    methods of the same name on :class:`Event
+    <lino_xl.lib.cal.models.Event>`.  Entries outside of the window
+    are delegated to these methods.
+
+    If `owner` is given, the index holds only the entries of that
+    owner, the entries which lock all rooms (e.g. holidays), and the
+    entries of every room asked for (each room being loaded on first
+    use).  That's all which can conflict with an automatic entry
+    generated by `owner`.  Otherwise it holds all entries of the
+    window.
+
+    The index is filled on first use.  It doesn't see entries which
+    are saved afterwards.
+
+    """
+
+    def __init__(self, start_date, end_date, owner=None):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.owner = owner
+        self._days = None
+        self._loaded = set()
+        self._rooms = set()
+        self._all_rooms = owner is None
+
+    def _load(self, *args, **kwargs):
+        Event = rt.models.cal.Event
+        qs = Event.objects.filter(transparent=False)
+        qs = qs.exclude(event_type__transparent=True)
+        qs = qs.filter(start_date__lte=self.end_date)
+        qs = qs.filter(
+            Q(end_date__isnull=True, start_date__gte=self.start_date) |
+            Q(end_date__gte=self.start_date))
+        qs = qs.filter(*args, **kwargs).select_related('event_type')
+        for obj in qs:
+            if obj.pk in self._loaded:
+                continue
+            self._loaded.add(obj.pk)
+            day = max(obj.start_date, self.start_date)
+            last = min(obj.end_date or obj.start_date, self.end_date)
+            while day <= last:
+                self._days.setdefault(day, []).append(obj)
+                day += ONE_DAY
+
+    def _populate(self, room):
+        if self._days is None:
+            self._days = dict()
+            if self._all_rooms:
+                self._load()
+            else:
+                ContentType = rt.models.contenttypes.ContentType
+                ot = ContentType.objects.get_for_model(
+                    self.owner.__class__)
+                self._load(Q(event_type__all_rooms=True) | Q(
+                    owner_type=ot, owner_id=self.owner.pk))
+        if self._all_rooms or room is None:
+            return
+        if room is _ALL_ROOMS:
+            self._load()
+            self._all_rooms = True
+        elif room.pk not in self._rooms:
+            self._load(room=room)
+            self._rooms.add(room.pk)
+
+    def get_conflicting_events(self, obj):
+        """Return a list of the entries which conflict with the given
+        entry `obj`, or `None` if `obj` cannot have any conflicts.
+
+        """
+        if obj.transparent:
+            return
+        if obj.start_date is None or obj.start_date < self.start_date \
+           or obj.start_date > self.end_date:
+            qs = obj.get_conflicting_events()
+            if qs is None:
+                return
+            return list(qs)
+        if obj.owner_id is None and obj.state.transparent:
+            return
+        if obj.room is None and obj.event_type is not None \
+           and obj.event_type.all_rooms:
+            # an entry without room whose type locks all rooms may
+            # conflict with any other entry
+            self._populate(_ALL_ROOMS)
+        else:
+            self._populate(obj.room)
+        return [o for o in self._days.get(obj.start_date, [])
+                if self.conflicts_with(obj, o)]
+
+    def has_conflicting_events(self, obj):
+        """Return `True` if the given entry `obj` has conflicting
+        entries.
+
+        """
+        lst = self.get_conflicting_events(obj)
+        if lst is None:
+            return False
+        if obj.event_type is not None:
+            if obj.event_type.transparent:
+                return False
+            # holidays (all room events) conflict also with events
+            # whose type otherwise would allow conflicting events
+            for o in lst:
+                if o.event_type is not None and o.event_type.all_rooms:
+                    return True
+            n = obj.event_type.max_conflicting - 1
+        else:
+            n = 0
+        return len(lst) > n
+
+    @staticmethod
+    def conflicts_with(obj, other):
+        """Whether the entry `other` (which is known to be
+        non-transparent and to happen on the start date of `obj`)
+        conflicts with the entry `obj`.
+
+        This is a Python translation of the query built by
+        :meth:`Event.get_conflicting_events
+        <lino_xl.lib.cal.models.Event.get_conflicting_events>`.
+
+        Examples:
+
+        >>> class Obj(object):
+        ...     def __init__(self, **kw):
+        ...         self.__dict__.update(kw)
+        >>> opaque = Obj(transparent=False)
+        >>> lesson = Obj(all_rooms=False, locks_user=False)
+        >>> holiday = Obj(all_rooms=True, locks_user=False)
+        >>> room1, room2 = Obj(pk=1), Obj(pk=2)
+        >>> def entry(id, start_time=None, end_time=None, room=None,
+        ...           event_type=lesson, owner_id=None, auto_type=None):
+        ...     return Obj(
+        ...         id=id, start_date=datetime.date(2018, 6, 4),
+        ...         end_date=None, start_time=start_time,
+        ...         end_time=end_time, room=room,
+        ...         room_id=room and room.pk, event_type=event_type,
+        ...         owner_id=owner_id, owner_type_id=owner_id and 1,
+        ...         auto_type=auto_type, state=opaque, user=None,
+        ...         user_id=None)
+        >>> def t(h, m=0):
+        ...     return datetime.time(h, m)
+
+        A lesson generated by course 1 in room 1 from 9:00 to 10:00:
+
+        >>> obj = entry(None, t(9), t(10), room1, owner_id=1, auto_type=5)
+
+        It conflicts with a holiday and with an overlapping lesson in
+        the same room:
+
+        >>> ConflictIndex.conflicts_with(obj, entry(1, event_type=holiday))
+        True
+        >>> ConflictIndex.conflicts_with(
+        ...     obj, entry(2, t(9, 30), t(10, 30), room1, owner_id=2))
+        True
+
+        But not with a lesson which starts when it ends, with a lesson in
+        another room, or with another lesson generated by the same
+        course:
+
+        >>> ConflictIndex.conflicts_with(
+        ...     obj, entry(3, t(10), t(11), room1, owner_id=2))
+        False
+        >>> ConflictIndex.conflicts_with(
+        ...     obj, entry(4, t(9), t(10), room2, owner_id=2))
+        False
+        >>> ConflictIndex.conflicts_with(
+        ...     obj, entry(5, t(9), t(10), room1, owner_id=1, auto_type=4))
+        False
+
+        """
+        end_date = obj.end_date or obj.start_date
+        if other.end_date is None:
+            if other.start_date != obj.start_date:
+                return False
+        elif other.start_date > obj.start_date \
+                or other.end_date < end_date:
+            return False
+        if end_date == obj.start_date and obj.start_time \
+           and obj.end_time:
+            st, et = other.start_time, other.end_time
+            # the other starts before me and ends after i started
+            c1 = st is not None and et is not None \
+                and st <= obj.start_time and et > obj.start_time
+            # the other ends after me and started before i ended
+            c2 = st is not None and et is not None \
+                and et >= obj.end_time and st < obj.end_time
+            # the other is full day
+            c3 = st is None and et is None
+            if not (c1 or c2 or c3):
+                return False
+
+        # saved entries don't conflict with themselves
+        if obj.id is not None and other.id == obj.id:
+            return False
+
+        same_owner = (other.owner_id == obj.owner_id and
+                      other.owner_type_id == obj.owner_type_id)
+
+        # automatic entries never conflict with other generated
+        # entries of same owner
+        if obj.auto_type and other.auto_type is not None and same_owner:
+            return False
+
+        other_opaque = other.state is not None \
+            and not other.state.transparent
+        if obj.owner_id is None:
+            if not other_opaque:
+                return False
+        elif obj.state.transparent:
+            if not same_owner:
+                return False
+        elif not (other_opaque or same_owner):
+            return False
+
+        other_all_rooms = other.event_type is not None \
+            and other.event_type.all_rooms
+        if obj.room is None:
+            if obj.event_type is None or not obj.event_type.all_rooms:
+                if obj.owner_id is None:
+                    if not other_all_rooms:
+                        return False
+                elif not (other_all_rooms or same_owner):
+                    return False
+        elif not (other.room_id == obj.room.pk or other_all_rooms):
+            return False
+
+        if obj.user is not None and obj.event_type is not None \
+           and obj.event_type.locks_user:
+            if other.user_id != obj.user.pk:
+                return False
+            if other.event_type is None \
+               or not other.event_type.locks_user:
+                return False
+        return True
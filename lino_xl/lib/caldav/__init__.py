@@ -6,6 +6,9 @@
 
 Requires radicale to be installed.
 
+Serves an iCalendar feed for every user and every room.  See
+:mod:`lino_xl.lib.caldav.views`.
+
 
 .. autosummary::
     :toctree:
@@ -61,6 +64,19 @@ class Plugin(ad.Plugin):
     verbose_name = _("CalDav")
     needs_plugins = ['lino.xl.cal']
 
+    feed_history = 90
+    """The number of days in the past to include in the iCalendar feeds.
+    `None` means to include all calendar entries.
+
+    """
+
+    token_max_age = 365 * 24 * 3600
+    """The number of seconds during which a feed token (see
+    :func:`get_feed_token <lino_xl.lib.caldav.views.get_feed_token>`)
+    is valid.  `None` means that tokens don't expire.
+
+    """
+
     # RADICALE_CONFIG = {
     # 'server': {
     #     'base_prefix': '/.rad/',
@@ -1,51 +1,301 @@
+# Copyright 2017-2018 Tonis Piip, Luc Saffre
+#
+# License: BSD (see file COPYING for details)
+
+"""Views for the :mod:`lino_xl.lib.caldav` plugin.
+
+Every calendar is exported as an iCalendar feed:
+
+- ``caldav/user/<username>.ics`` : the entries of which the given user
+  is the responsible user or a guest.
+- ``caldav/room/<pk>.ics`` : the entries in the given room.
+
+The feeds are streamed, and responses carry an `ETag` and a
+`Last-Modified` header so that clients which poll a feed get a `304
+Not Modified` response when nothing has changed.
+
+The feeds are available only to authenticated users.  Calendar
+clients which cannot log in add the secret token of a user (see
+:func:`get_feed_token`) to the url, e.g.
+``caldav/user/robin.ics?token=...``.  A token is revoked by changing
+the password of its user, and it expires after
+:attr:`token_max_age <lino_xl.lib.caldav.Plugin.token_max_age>`
+seconds.  The feed of a user is available
+to that user only.  The feed of a room is available to every user
+with the :class:`OfficeUser <lino.modlib.office.roles.OfficeUser>`
+role, but private entries of other users are not exported.
+
+"""
+
+import datetime
+from calendar import timegm
+
 from django.conf import settings
-from django.http import HttpResponse
+from django.core import signing
+from django.db.models import Q, Max, Count, Sum
+from django.http import Http404, HttpResponseForbidden, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.encoding import force_text
+from django.utils.http import http_date, quote_etag
+from django.utils.translation import ugettext as _
 from django.views.generic import View
 
+from icalendar import Event, vCalAddress, vText
+
+from lino.api import dd, rt
+from lino.utils import ONE_DAY
+from lino.modlib.office.roles import OfficeUser
+
+CHUNK_SIZE = 500
+"""Number of calendar entries to read from the database in one query
+when streaming a feed."""
+
+TOKEN_SALT = 'lino_xl.lib.caldav'
+
+ACCESS_CLASSES = {
+    'private': 'PRIVATE',
+    'show_busy': 'CONFIDENTIAL',
+    'public': 'PUBLIC'}
+
+
+def get_feed_queryset(kind, key):
+    """Return a tuple `(queryset, user)` with the calendar entries of
+    the feed specified by `kind` ("user" or "room") and `key` (a
+    username or the primary key of a room).  `user` is the user whose
+    calendar is being exported, or `None`.
+
+    """
+    Event = rt.models.cal.Event
+    qs = Event.objects.all()
+    days = dd.plugins.caldav.feed_history
+    if days is not None:
+        qs = qs.filter(
+            start_date__gte=dd.today() - datetime.timedelta(days=days))
+    if kind == 'user':
+        try:
+            user = rt.models.users.User.objects.get(username=key)
+        except rt.models.users.User.DoesNotExist:
+            raise Http404("No user {}".format(key))
+        flt = Q(user=user)
+        partner = getattr(user, 'partner', None)
+        if partner is not None:
+            # Entries to which the user is invited.  The id__in
+            # subquery avoids duplicate rows.
+            flt |= Q(id__in=rt.models.cal.Guest.objects.filter(
+                partner_id=partner.pk).values('event'))
+        return qs.filter(flt), user
+    if kind == 'room':
+        try:
+            room = rt.models.cal.Room.objects.get(pk=int(key))
+        except (ValueError, rt.models.cal.Room.DoesNotExist):
+            raise Http404("No room {}".format(key))
+        return qs.filter(room=room), None
+    raise Http404("Unknown calendar type {}".format(kind))
+
+
+def get_user_secret(user):
+    """Return a secret string which changes when the password of the
+    given user changes.
+
+    """
+    return salted_hmac(TOKEN_SALT, user.password).hexdigest()[:20]
+
+
+def get_feed_token(user):
+    """Return the secret token which gives access to the feeds of the
+    given user without logging in.  The token is signed using the
+    :setting:`SECRET_KEY` of the site and contains a timestamp and the
+    secret returned by :func:`get_user_secret`.
+
+    """
+    return signing.dumps(
+        [user.username, get_user_secret(user)], salt=TOKEN_SALT)
+
+
+def get_feed_user(request):
+    """Return the user who is requesting a feed, or `None` if the
+    request is anonymous or carries an invalid token.
+
+    """
+    User = rt.models.users.User
+    token = request.GET.get('token')
+    if token:
+        try:
+            username, secret = signing.loads(
+                token, salt=TOKEN_SALT,
+                max_age=dd.plugins.caldav.token_max_age)
+        except (signing.BadSignature, ValueError, TypeError):
+            # SignatureExpired is a subclass of BadSignature
+            return None
+        user = User.objects.filter(username=username).first()
+        if user is None or not constant_time_compare(
+                secret, get_user_secret(user)):
+            return None
+        return user
+    me = getattr(request, 'user', None)
+    if getattr(me, 'pk', None) is None:
+        return None
+    return me
+
+
+def get_feed_stamp(qs, public):
+    """Return a tuple `(etag, last_modified)` for the given queryset of
+    calendar entries as exported to the public or not.
+    `last_modified` is a timestamp in seconds since the epoch, or
+    `None` if there are no entries.
+
+    The ETag is computed from aggregates in a single query.  It
+    includes the number of entries because deleting an entry doesn't
+    change the newest modification time.  Guests (which are exported
+    as attendees) have no modification time, so their number, their
+    highest id and the sum of their partner ids are used.
+
+    """
+    d = qs.aggregate(
+        last=Max('modified'), count=Count('id', distinct=True),
+        guests=Count('guest'), last_guest=Max('guest__id'),
+        partners=Sum('guest__partner_id'))
+    last = d['last']
+    etag = quote_etag("{}-{}-{}-{}-{}-{}".format(
+        timegm(last.utctimetuple()) if last else 0, d['count'],
+        d['guests'], d['last_guest'] or 0, d['partners'] or 0,
+        int(public)))
+    if last is None:
+        return etag, None
+    return etag, timegm(last.utctimetuple())
+
+
+def event2ical(obj, guests, public):
+    """Return a :class:`icalendar.Event` for the given calendar entry
+    `obj`.  `guests` is a list of its :class:`Guest
+    <lino_xl.lib.cal.models.Guest>` objects.  If `public` is `True`,
+    entries with access class "show busy" are shown without details.
+
+    """
+    EntryStates = rt.models.cal.EntryStates
+    AccessClasses = rt.models.cal.AccessClasses
+    ev = Event()
+    ev.add('uid', obj.get_uid())
+    busy = public and obj.access_class == AccessClasses.show_busy
+    if busy:
+        ev.add('summary', force_text(_("Busy")))
+    else:
+        ev.add('summary', obj.summary)
+        if obj.description:
+            ev.add('description', obj.description)
+        if obj.room is not None:
+            ev['location'] = vText(force_text(obj.room))
+    if obj.start_time:
+        ev.add('dtstart', datetime.datetime.combine(
+            obj.start_date, obj.start_time))
+        if obj.end_time:
+            ev.add('dtend', datetime.datetime.combine(
+                obj.end_date or obj.start_date, obj.end_time))
+    else:
+        ev.add('dtstart', obj.start_date)
+        # DTEND of an all-day entry is the day after its last day
+        ev.add('dtend', (obj.end_date or obj.start_date) + ONE_DAY)
+    if obj.modified is not None:
+        ev.add('dtstamp', obj.modified)
+        ev.add('last-modified', obj.modified)
+    if obj.created is not None:
+        ev.add('created', obj.created)
+    ev.add('sequence', obj.sequence)
+    if obj.access_class is not None:
+        ev.add('class', ACCESS_CLASSES.get(obj.access_class.name, 'PUBLIC'))
+    if obj.transparent:
+        ev.add('transp', 'TRANSPARENT')
+    if obj.state.transparent:
+        ev.add('status', 'CANCELLED')
+    elif obj.state == EntryStates.suggested:
+        ev.add('status', 'TENTATIVE')
+    else:
+        ev.add('status', 'CONFIRMED')
+    if busy:
+        return ev
+    if obj.user is not None and obj.user.email:
+        organizer = vCalAddress('MAILTO:' + obj.user.email)
+        organizer.params['cn'] = vText(force_text(obj.user))
+        ev['organizer'] = organizer
+    for g in guests:
+        if g.partner is None or not g.partner.email:
+            continue
+        attendee = vCalAddress('MAILTO:' + g.partner.email)
+        attendee.params['cn'] = vText(force_text(g.partner))
+        ev.add('attendee', attendee, encode=0)
+    return ev
+
+
+def stream_feed(qs, public):
+    """Yield the lines of an iCalendar feed with the calendar entries of
+    the given queryset.  The entries are read in chunks of
+    :data:`CHUNK_SIZE`, each chunk with one query for the entries and
+    one for their guests.
+
+    """
+    Guest = rt.models.cal.Guest
+    yield b"BEGIN:VCALENDAR\r\n"
+    yield b"VERSION:2.0\r\n"
+    yield "PRODID:-//{}//Lino//EN\r\n".format(
+        settings.SITE.verbose_name).encode('utf-8')
+    pks = list(qs.order_by('start_date', 'start_time', 'id').values_list(
+        'id', flat=True))
+    for i in range(0, len(pks), CHUNK_SIZE):
+        chunk = pks[i:i+CHUNK_SIZE]
+        events = qs.model.objects.filter(id__in=chunk).select_related(
+            'room', 'user')
+        events = {e.pk: e for e in events}
+        guests = dict()
+        for g in Guest.objects.filter(event_id__in=chunk).select_related(
+                'partner'):
+            guests.setdefault(g.event_id, []).append(g)
+        for pk in chunk:
+            obj = events.get(pk)
+            if obj is not None:
+                yield event2ical(obj, guests.get(pk, []), public).to_ical()
+    yield b"END:VCALENDAR\r\n"
 
-from datetime import datetime
-from icalendar import Calendar, Event
-import pytz
-from icalendar import vCalAddress, vText
 
 class CalDavView(View):
-    
-    def get(self, request, *args, **kwargs):
-        
-        # code copied from http://icalendar.readthedocs.io/en/latest/usage.html#example
-        
-        cal = Calendar()
-        cal.add('prodid', '-//My calendar product//mxm.dk//')
-        cal.add('version', '2.0')
-
-        event = Event()
-        event.add('summary', 'Python meeting about calendaring')
-        event.add('dtstart', datetime(2005,4,4,8,0,0,tzinfo=pytz.utc))
-        event.add('dtend', datetime(2005,4,4,10,0,0,tzinfo=pytz.utc))
-        event.add('dtstamp', datetime(2005,4,4,0,10,0,tzinfo=pytz.utc))
-        organizer = vCalAddress('MAILTO:noone@example.com')
-
-        organizer.params['cn'] = vText('Max Rasmussen')
-        organizer.params['role'] = vText('CHAIR')
-        event['organizer'] = organizer
-        event['location'] = vText('Odense, Denmark')
-
-        event['uid'] = '20050115T101010/27346262376@mxm.dk'
-        event.add('priority', 5)
-
-        attendee = vCalAddress('MAILTO:maxm@example.com')
-        attendee.params['cn'] = vText('Max Rasmussen')
-        attendee.params['ROLE'] = vText('REQ-PARTICIPANT')
-        event.add('attendee', attendee, encode=0)
-
-        attendee = vCalAddress('MAILTO:the-dude@example.com')
-        attendee.params['cn'] = vText('The Dude')
-        attendee.params['ROLE'] = vText('REQ-PARTICIPANT')
-        event.add('attendee', attendee, encode=0)
-        
-        cal.add_component(event)
-        
-        html = cal.to_ical()
-        
-        return HttpResponse(html)
-        
+    """Serve the iCalendar feed specified by the url, which must be of
+    the form ``<kind>/<key>.ics`` (see :mod:`lino_xl.lib.caldav.views`).
+
+    The feed of a user is served only to that user.  The feed of a
+    room is served to every office user, without the private entries
+    of other users.
+
+    """
+
+    def get(self, request, url='', *args, **kwargs):
+        if not url.endswith('.ics') or url.count('/') != 1:
+            raise Http404("Invalid calendar url {}".format(url))
+        kind, key = url[:-4].split('/')
+        me = get_feed_user(request)
+        if me is None or me.user_type is None:
+            return HttpResponseForbidden()
+        qs, user = get_feed_queryset(kind, key)
+        if user is not None:
+            if user.pk != me.pk:
+                return HttpResponseForbidden()
+            public = False
+        else:
+            if not me.user_type.has_required_roles([OfficeUser]):
+                return HttpResponseForbidden()
+            public = True
+            qs = qs.exclude(
+                ~Q(user=me),
+                access_class=rt.models.cal.AccessClasses.private)
+        etag, last_modified = get_feed_stamp(qs, public)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+        response = StreamingHttpResponse(
+            stream_feed(qs, public), content_type='text/calendar')
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        response['Content-Disposition'] = \
+            'inline; filename="{}-{}.ics"'.format(kind, key)
+        return response
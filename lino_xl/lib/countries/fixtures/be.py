@@ -19,8 +19,8 @@ Original sources:
 """
 
 from lino.core.utils import resolve_model
-from lino.utils.instantiator import Instantiator
 from lino.api import dd, rt
+from lino_xl.lib.countries.utils import PlaceLoader
 
 
 # german names are my spontaneous guessings...
@@ -2882,18 +2882,18 @@ fr = u"""
 
 def objects():
     countries = dd.resolve_app('countries')
-    city = Instantiator(countries.Place, "zip_code name",
-                        country='BE',
-                        type=countries.PlaceTypes.city).build
+    BE = countries.Country.objects.get(isocode='BE')
+    loader = PlaceLoader()
+
+    def city(**kw):
+        loader.add(countries.Place(
+            country=BE, type=countries.PlaceTypes.city, **kw))
+
     for ln in belgian_cities.splitlines():
         ln = ln.strip()
         if ln and ln[0] != '#':
             args = ln.split(None, 1)
-            o = city(*args)
-            # print "%r %r" % (o.zip_code, o.name)
-            yield o
-            #~ print __name__, "20121114"
-            #~ return
+            city(zip_code=args[0], name=args[1].strip())
     for ln in belgian_cities_nl_fr.splitlines():
         ln = ln.strip()
         if ln and ln[0] != '#':
@@ -2901,6 +2901,7 @@ def objects():
             if len(args) != 4:
                 raise Exception("Invalid format : \n%s" % ln)
             args = [x.strip() for x in args]
-            o = city(zip_code=args[0], **dd.babel_values('name',
-                     nl=args[1], fr=args[2], de=args[3], en=args[3]))
-            yield o
+            city(zip_code=args[0], **dd.babel_values(
+                'name', nl=args[1], fr=args[2], de=args[3], en=args[3]))
+    loader.flush()
+    return []
@@ -16,6 +16,7 @@ from commondata.ee.places import (Village, SmallBorough, Borough,
                                   Township, Town, Municipality, County)
 
 from lino.api import dd
+from lino_xl.lib.countries.utils import PlaceLoader
 
 countries = dd.resolve_app('countries')
 
@@ -37,33 +38,26 @@ def cd2type(p):
         return countries.PlaceTypes.village
 
 
-def place2objects(country, place, parent=None):
+def place2objects(loader, country, place, parent=None):
     t = cd2type(place)
     if t is None:
         logger.info("20140612 ignoring place %s", place)
         return
-    obj = countries.Place(
+    obj = loader.add(countries.Place(
         country=country, type=t, name=place.name,
         parent=parent,
-        zip_code=place.zip_code)
-
-    # We must save the parent before we can generate children.
-    try:
-        obj.full_clean()
-    except Exception as e:
-        raise Exception("Could not save %s : %r" % (
-            dd.obj2str(obj), e))
-    obj.save()
-    yield obj
+        zip_code=place.zip_code))
 
     for cp in place.children:
-        yield place2objects(country, cp, obj)
+        place2objects(loader, country, cp, obj)
 
 
 def objects():
 
     eesti = root()
     EE = countries.Country.objects.get(isocode="EE")
+    loader = PlaceLoader()
     for p in eesti.children:
-        yield place2objects(EE, p)
-        
+        place2objects(loader, EE, p)
+    loader.flush()
+    return []
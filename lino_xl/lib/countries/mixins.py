@@ -66,10 +66,10 @@ class CountryCity(dd.Model):
 
     def zip_code_changed(self, ar):
         if self.country and self.zip_code:
-            qs = rt.models.countries.Place.objects.filter(
-                country=self.country, zip_code=self.zip_code)
-            if qs.count() > 0:
-                self.city = qs[0]
+            idx = rt.models.countries.Place.get_city_index(self.country)
+            lst = idx.get_by_zip(self.zip_code)
+            if len(lst) > 0:
+                self.city = lst[0]
 
     def full_clean(self, *args, **kw):
         """Fills my :attr:`zip_code` from my :attr:`city` if my `zip_code` is
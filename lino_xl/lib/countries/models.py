@@ -9,8 +9,11 @@ from builtins import object
 import logging
 logger = logging.getLogger(__name__)
 
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_delete
 from django.conf import settings
+from django.utils.translation import get_language
 
 from lino.api import dd
 from lino import mixins
@@ -19,6 +22,7 @@ from lino.modlib.checkdata.choicelists import Checker
 from lino_xl.lib.contacts.roles import ContactsUser, ContactsStaff
 
 from .choicelists import PlaceTypes, CountryDrivers
+from .utils import CityIndex
 
 
 FREQUENT_COUNTRIES = ['BE', 'NL', 'DE', 'FR', 'LU']
@@ -133,13 +137,29 @@ class Place(Hierarchical, mixins.BabelNamed):
         Extends the default behaviour (which would simply diplay this
         city in the current language) by also adding the name in other
         languages and the type between parentheses.
+
+        The text is taken from the :class:`CityIndex` of the country if
+        it has been built.
         """
+        idx = get_valid_city_index(self.country_id)
+        if idx is not None:
+            s = idx.texts.get(self.pk)
+            if s is not None:
+                return s
+        return self.build_choices_text()
+
+    def get_names(self):
+        """Return a list of the names of this place in all languages,
+        without duplicates."""
         names = [self.name]
         for lng in settings.SITE.BABEL_LANGS:
             n = getattr(self, 'name' + lng.suffix)
             if n and n not in names:
                 names.append(n)
-                #~ s += ' / ' + n
+        return names
+
+    def build_choices_text(self):
+        names = self.get_names()
         if len(names) == 1:
             s = names[0]
         else:
@@ -172,6 +192,24 @@ class Place(Hierarchical, mixins.BabelNamed):
         #~ flt = flt | models.Q(type=PlaceTypes.blank_item)
         return cls.objects.filter(flt).order_by('name')
 
+    @classmethod
+    def get_city_index(cls, country):
+        """Return the :class:`CityIndex` of the given country (which may
+        be `None`) for the current language.  The index is built on
+        first use and kept until a place is saved or deleted (in any
+        process), or until it is older than
+        :data:`CITY_INDEX_TIMEOUT
+        <lino_xl.lib.countries.utils.CITY_INDEX_TIMEOUT>`.
+
+        """
+        country_id = None if country is None else country.pk
+        idx = get_valid_city_index(country_id)
+        if idx is None:
+            idx = CityIndex(cls.get_cities(country),
+                            get_city_index_version(country_id))
+            CITY_INDEXES[(country_id, get_language())] = idx
+        return idx
+
         #~ if country is not None:
             #~ cd = getattr(CountryDrivers,country.isocode,None)
             #~ if cd:
@@ -187,6 +225,51 @@ dd.update_field(
                 "of which this place is a part."))
 
 
+CITY_INDEXES = dict()
+"""The :class:`CityIndex` instances built by
+:meth:`Place.get_city_index`, indexed by `(country_id, language)`."""
+
+CITY_INDEX_VERSION_KEY = 'lino_xl.countries.city_index.{}'
+
+
+def get_city_index_version(country_id):
+    return cache.get(CITY_INDEX_VERSION_KEY.format(country_id), 0)
+
+
+def get_valid_city_index(country_id):
+    """Return the :class:`CityIndex` of the given country for the
+    current language if it has been built and is still valid,
+    otherwise `None`."""
+    idx = CITY_INDEXES.get((country_id, get_language()))
+    if idx is not None and idx.is_valid(get_city_index_version(country_id)):
+        return idx
+
+
+def clear_city_index(country_id):
+    """Forget the :class:`CityIndex` instances which may contain places
+    of the given country.  The version numbers of the country and of
+    the index of all countries are incremented in the Django cache so
+    that other processes forget their indexes as well.
+
+    """
+    for k in list(CITY_INDEXES.keys()):
+        if k[0] is None or k[0] == country_id:
+            CITY_INDEXES.pop(k, None)
+    for cid in (country_id, None):
+        key = CITY_INDEX_VERSION_KEY.format(cid)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+
+@dd.receiver(dd.post_save, dispatch_uid="clear_city_index_on_save")
+@dd.receiver(post_delete, dispatch_uid="clear_city_index_on_delete")
+def clear_city_index_on_change(sender=None, instance=None, **kw):
+    if isinstance(instance, Place):
+        clear_city_index(instance.country_id)
+
+
 class Places(dd.Table):
     help_text = _("""
     The table of known geographical places.
@@ -7,7 +7,17 @@ Utilities for `lino_xl.lib.countries`.
 
 Defines models
 :class:`AddressFormatter` and
-:class:`CountryDrivers`.
+:class:`CountryDrivers`, the :class:`CityIndex` used for choosing a
+city, and the :class:`PlaceLoader` used by fixtures which load many
+places.
+
+.. This is a tested document. You can test it using:
+
+    $ python setup.py test -s tests.UtilsTests.test_countries_utils
+
+..
+  >>> from lino import startup
+  >>> startup('lino.projects.std.settings_test')
 
 """
 from __future__ import print_function
@@ -18,14 +28,18 @@ from builtins import object
 import logging
 logger = logging.getLogger(__name__)
 
+import time
+
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db import models, transaction
 
 from lino.api import rt
 from lino.utils import join_words
 from lino.utils.instantiator import InstanceGenerator
 
-from .choicelists import PlaceTypes
-from .choicelists import CountryDrivers
+from lino_xl.lib.countries.choicelists import PlaceTypes
+from lino_xl.lib.countries.choicelists import CountryDrivers
 
 
 class AddressFormatter(object):
@@ -114,10 +128,284 @@ instance) for the given country."""
     return ADDRESS_FORMATTERS.get(None)
 
 
+def is_cached(f, obj):
+    """Whether the related object of the foreign key `f` has been given
+    as an instance to (and is therefore cached on) `obj`."""
+    if hasattr(f, 'is_cached'):  # Django 2.0 and later
+        return f.is_cached(obj)
+    return hasattr(obj, f.get_cache_name())
+
+
+CITY_INDEX_TIMEOUT = 600
+"""Number of seconds after which a :class:`CityIndex` is built again.
+This limits the time during which a process may use an index which
+has been invalidated by another process when the Django cache is not
+shared between processes."""
+
+
+class CityIndex(object):
+    """An in-memory index of the places that can be chosen as city in
+    a country.
+
+    Built by :meth:`Place.get_city_index
+    <lino_xl.lib.countries.models.Place.get_city_index>`.
+    :attr:`texts` maps the primary key of every place to its choice
+    text.  The places can be looked up by their zip code
+    (:meth:`get_by_zip`).
+
+    An index is valid as long as the version number of its country in
+    the Django cache is unchanged (see :func:`clear_city_index
+    <lino_xl.lib.countries.models.clear_city_index>`) and
+    for at most :data:`CITY_INDEX_TIMEOUT` seconds.
+
+    Examples:
+
+    >>> class Place(object):
+    ...     def __init__(self, pk, name, zip_code=''):
+    ...         self.pk, self.name, self.zip_code = pk, name, zip_code
+    ...     def build_choices_text(self):
+    ...         return "{} {}".format(self.zip_code, self.name).strip()
+    >>> idx = CityIndex([
+    ...     Place(1, "Eupen", "4700"), Place(2, "Kettenis", "4701"),
+    ...     Place(3, "Nispert", "4700"), Place(4, "Raeren")], version=3)
+    >>> print(idx.texts[2])
+    4701 Kettenis
+    >>> print(' '.join([p.name for p in idx.get_by_zip("4700")]))
+    Eupen Nispert
+    >>> idx.get_by_zip("9999")
+    []
+
+    The index is no longer valid when the version number has changed
+    or when it is too old:
+
+    >>> idx.is_valid(3), idx.is_valid(4)
+    (True, False)
+    >>> idx.built -= CITY_INDEX_TIMEOUT
+    >>> idx.is_valid(3)
+    False
+
+    """
+    def __init__(self, qs, version=0):
+        self.version = version
+        self.built = time.time()
+        self.texts = dict()
+        self.by_zip = dict()
+        for p in qs:
+            self.texts[p.pk] = p.build_choices_text()
+            if p.zip_code:
+                self.by_zip.setdefault(p.zip_code, []).append(p)
+
+    def is_valid(self, version):
+        if self.version != version:
+            return False
+        return time.time() - self.built < CITY_INDEX_TIMEOUT
+
+    def get_by_zip(self, zip_code):
+        """Return the list of places having the given zip code."""
+        return self.by_zip.get(zip_code, [])
+
+
+class PlaceLoader(object):
+    """Collects :class:`Place <lino_xl.lib.countries.models.Place>`
+    objects in memory and writes them to the database in bulk.
+
+    Usage::
+
+        loader = PlaceLoader()
+        loader.add(Place(country=BE, zip_code="4700", name="Eupen"))
+        loader.update(BE, "4700", "Eupen", inscode="63023")
+        loader.flush()
+
+    All existing places of the countries involved are read using a
+    single query.  A place is considered to exist already when there
+    is a place of the same country, zip code, name and parent.  New
+    places are inserted using `bulk_create`, level by level so that
+    children can refer to their parent.  Existing places are updated
+    only when their values differ.
+
+    """
+    def __init__(self):
+        self.rows = []
+        self.updates = []
+
+    def add(self, obj, fields=None):
+        """Add the given unsaved place.  Its `parent` may be another
+        place which has been added before.
+
+        `fields` is a list of the names of the fields to update when
+        the place exists already.  The default is the names in the
+        other languages and the type.
+
+        """
+        if fields is None:
+            fields = ['name' + lng.suffix
+                      for lng in settings.SITE.BABEL_LANGS] + ['type']
+        self.rows.append((obj, fields))
+        return obj
+
+    def update(self, country, zip_code, name, **values):
+        """Set the given field values on the place with the given
+        country, zip code and name.  Nothing is done when there is no
+        such place or more than one.
+
+        """
+        self.updates.append((country.pk, zip_code, name, values))
+
+    def flush(self):
+        """Write all collected places and updates to the database.
+        Returns a tuple `(created, updated)` with the number of places
+        that have been created and updated.
+
+        """
+        Place = rt.models.countries.Place
+        countries = set([obj.country_id for obj, fields in self.rows])
+        countries |= set([u[0] for u in self.updates])
+        index = dict()
+        for p in Place.objects.filter(country_id__in=countries):
+            index.setdefault((p.country_id, p.zip_code, p.name), []).append(p)
+
+        changed = dict()
+
+        def set_values(target, values):
+            for k, v in values.items():
+                if getattr(target, k) != v:
+                    setattr(target, k, v)
+                    changed.setdefault(target.pk, (target, set()))[1].add(k)
+
+        # Places added more than once (same country, zip code, name
+        # and parent) are saved only once.  The duplicates and their
+        # children are mapped to the first of them.
+        pending = []
+        first = dict()
+        aliases = dict()
+        duplicates = []
+        for obj, fields in self.rows:
+            parent = None
+            if obj.parent_id is None:
+                parent = obj.parent
+            if parent is not None and id(parent) in aliases:
+                parent = obj.parent = aliases[id(parent)]
+            if parent is None:
+                pkey = obj.parent_id
+            elif parent.pk is None:
+                pkey = ('new', id(parent))
+            else:
+                pkey = parent.pk
+            k = (obj.country_id, obj.zip_code, obj.name, pkey)
+            if k in first:
+                aliases[id(obj)] = first[k]
+                duplicates.append((obj, first[k]))
+                continue
+            first[k] = obj
+            pending.append((obj, fields))
+        self.rows = []
+
+        created = 0
+        failed = set()
+        with transaction.atomic():
+            while len(pending):
+                level = []
+                later = []
+                for obj, fields in pending:
+                    parent = None
+                    if obj.parent_id is None:
+                        parent = obj.parent
+                    if parent is not None:
+                        if id(parent) in failed:
+                            failed.add(id(obj))
+                            logger.warning(
+                                "Ignored %s because its parent failed", obj)
+                            continue
+                        if parent.pk is None:
+                            later.append((obj, fields))
+                            continue
+                        obj.parent_id = parent.pk
+                    level.append((obj, fields))
+                if len(level) == 0 and len(later):
+                    raise Exception("Cannot save {} places".format(
+                        len(later)))
+                new = []
+                for obj, fields in level:
+                    k = (obj.country_id, obj.zip_code, obj.name)
+                    old = None
+                    for p in index.get(k, []):
+                        if p.parent_id == obj.parent_id:
+                            old = p
+                            break
+                    if old is not None:
+                        obj.pk = old.pk
+                        set_values(old, dict(
+                            [(f, getattr(obj, f)) for f in fields]))
+                        continue
+                    # country and parent given as instances don't need
+                    # to be validated again
+                    exclude = [
+                        f.name for f in obj._meta.concrete_fields
+                        if f.many_to_one and is_cached(f, obj)]
+                    try:
+                        obj.full_clean(exclude=exclude, validate_unique=False)
+                    except ValidationError as e:
+                        failed.add(id(obj))
+                        logger.warning(
+                            "Failed to load %s (%s) : %s", obj, obj.type, e)
+                        continue
+                    new.append(obj)
+                    index.setdefault(k, []).append(obj)
+                if len(new):
+                    last = Place.objects.aggregate(
+                        models.Max('pk'))['pk__max'] or 0
+                    Place.objects.bulk_create(new)
+                    if new[0].pk is None:
+                        # bulk_create sets the primary keys only on
+                        # PostgreSQL
+                        pks = Place.objects.filter(pk__gt=last).order_by(
+                            'pk').values_list('pk', flat=True)
+                        for obj, pk in zip(new, pks):
+                            obj.pk = pk
+                    created += len(new)
+                pending = later
+
+            for obj, orig in duplicates:
+                obj.pk = orig.pk
+
+            for country_id, zip_code, name, values in self.updates:
+                lst = index.get((country_id, zip_code, name), [])
+                if len(lst) == 1:
+                    set_values(lst[0], values)
+                else:
+                    logger.debug(
+                        "Cannot update %s %s : found %d places",
+                        zip_code, name, len(lst))
+            self.updates = []
+
+            if hasattr(Place.objects, 'bulk_update'):
+                fields = set()
+                for obj, names in changed.values():
+                    fields.update(names)
+                if len(changed):
+                    Place.objects.bulk_update(
+                        [obj for obj, names in changed.values()],
+                        sorted(fields))
+            else:
+                for obj, names in changed.values():
+                    obj.save(update_fields=names)
+
+        # bulk_create and bulk_update don't send any signals
+        for country_id in countries:
+            rt.models.countries.clear_city_index(country_id)
+        logger.info("Created %d and updated %d places.", created, len(changed))
+        return created, len(changed)
+
+
 class PlaceGenerator(InstanceGenerator):
+    """Generates the places of Estonia.  The places are written in bulk
+    by :meth:`flush`.
+
+    """
     def __init__(self):
         super(PlaceGenerator, self).__init__()
         self.prev_obj = None
+        self.loader = PlaceLoader()
         EE = rt.models.countries.Country.objects.get(isocode="EE")
 
         for pt in PlaceTypes.objects():
@@ -145,16 +433,13 @@ class PlaceGenerator(InstanceGenerator):
                         "%s (%s) is no parent for %s (%s)",
                         prev, prev.type, obj, obj.type)
 
-        try:
-            obj.full_clean()
-            obj.save()
-            self.prev_obj = obj
-            return obj
-        except ValidationError as e:
-            logger.warning(
-                "Failed to load %s (%s) : %s",
-                obj, obj.type, e)
+        self.prev_obj = obj
+        return self.loader.add(obj)
         # return super(PlaceGenerator, self).on_new(obj)
+
+    def flush(self):
+        self.loader.flush()
+        return super(PlaceGenerator, self).flush()
     
     def can_be_parent(self, ptype, otype):
         """return True if a place of type pt can be parent for a place of type
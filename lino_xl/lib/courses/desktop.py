@@ -144,6 +144,7 @@ class CourseDetail(dd.DetailLayout):
     cal_tab = dd.Panel("""
     max_events max_date every_unit every
     monday tuesday wednesday thursday friday saturday sunday
+    upcoming_dates
     cal.EntriesByController
     """, label=_("Calendar"))
 
@@ -240,6 +241,7 @@ class Activities(dd.Table):
 
         qs = self.model.add_param_filter(
             qs, show_active=pv.show_active)
+        qs = self.model.annotate_places(qs)
         
         # if pv.start_date:
         #     # dd.logger.info("20160512 start_date is %r", pv.start_date)
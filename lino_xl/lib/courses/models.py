@@ -11,7 +11,8 @@ ZERO = Decimal()
 ONE = Decimal(1)
 
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
@@ -54,8 +55,6 @@ except AttributeError:
     pupil_model = 'foo.Bar'
     pupil_name_fields = 'foo bar'
 
-FILL_EVENT_GUESTS = False
-
 
 class StartEndTime(dd.Model):
 
@@ -343,6 +342,27 @@ class Course(Reservation, Duplicable, Printable):
                     partner=obj.pupil,
                     role=gr)
 
+    def get_wanted_cal_guests(self, events):
+        """Same as :meth:`suggest_cal_guests` for a list of events, but
+        reading the enrolments only once.
+
+        """
+        Guest = rt.models.cal.Guest
+        Enrolment = rt.models.courses.Enrolment
+        rv = {e.pk: [] for e in events}
+        if self.line is None:
+            return rv
+        gr = self.line.guest_role
+        if gr is None:
+            return rv
+        enrolments = list(Enrolment.objects.filter(course=self).order_by(
+            *[f.name for f in Enrolment.quick_search_fields]))
+        for e in events:
+            rv[e.pk] = [
+                Guest(event=e, partner_id=obj.pupil_id, role=gr)
+                for obj in enrolments if obj.is_guest_for(e)]
+        return rv
+
     def full_clean(self, *args, **kw):
         if self.line_id is not None:
             if self.id is None:
@@ -415,27 +435,80 @@ class Course(Reservation, Duplicable, Printable):
         return rt.models.cal.Event.objects.filter(
             owner_type=ct, owner_id=self.id)
 
-    def get_places_sum(self, today=None, **flt):
+    @classmethod
+    def get_places_queryset(cls, today=None, **flt):
         Enrolment = rt.models.courses.Enrolment
         PeriodEvents = rt.models.system.PeriodEvents
-        qs = Enrolment.objects.filter(course=self, **flt)
+        qs = Enrolment.objects.filter(**flt)
         # see voga.projects.roger.tests.test_max_places
         if today is None:
             rng = DateRangeValue(dd.today(), None)
             qs = PeriodEvents.active.add_filter(qs, rng)
         else:
             qs = PeriodEvents.active.add_filter(qs, today)
+        return qs
+
+    def get_places_sum(self, today=None, **flt):
+        qs = self.get_places_queryset(today, course=self, **flt)
         # logger.info("20160502 %s", qs.query)
         res = qs.aggregate(models.Sum('places'))
         # logger.info("20140819 %s", res)
         return res['places__sum'] or 0
 
+    @classmethod
+    def get_places_filters(cls):
+        """Return a dict which maps the name of an annotation to the
+        enrolment filter of the places it counts.  See
+        :meth:`annotate_places`.
+
+        """
+        d = dict(places_used=dict(
+            state__in=EnrolmentStates.filter(uses_a_place=True)))
+        for name in ('requested', 'confirmed', 'trying'):
+            st = EnrolmentStates.get_by_name(name, None)
+            if st is not None:
+                d['places_' + name] = dict(state=st)
+        return d
+
+    @classmethod
+    def annotate_places(cls, qs):
+        """Annotate the given queryset of activities with the number of
+        places of their currently active enrolments, for each group of
+        enrolment states in :meth:`get_places_filters`.  The
+        annotations are read by :meth:`get_used_places` and the virtual
+        fields :attr:`requested`, :attr:`confirmed` and
+        :attr:`trying` so that a list of activities needs a single
+        query.
+
+        """
+        for name, flt in cls.get_places_filters().items():
+            sq = cls.get_places_queryset(course=OuterRef('pk'), **flt)
+            sq = sq.order_by().values('course').annotate(
+                s=Sum('places')).values('s')
+            qs = qs.annotate(**{name: Coalesce(Subquery(
+                sq, output_field=models.IntegerField()), 0)})
+        return qs
+
+    def get_annotated_places(self, name, **flt):
+        """Return the annotation `places_<name>` if present, otherwise
+        the places sum for the given enrolment filter.
+
+        """
+        v = getattr(self, 'places_' + name, None)
+        if v is None:
+            return self.get_places_sum(**flt)
+        return v
+
     def get_free_places(self, today=None):
         if not self.max_places:
             return None  # _("Unlimited")
         return self.max_places - self.get_used_places(today)
 
     def get_used_places(self, today=None):
+        if today is None:
+            v = getattr(self, 'places_used', None)
+            if v is not None:
+                return v
         states = EnrolmentStates.filter(uses_a_place=True)
         return self.get_places_sum(today, state__in=states)
 
@@ -448,7 +521,8 @@ class Course(Reservation, Duplicable, Printable):
 
     @dd.virtualfield(models.IntegerField(_("Requested")))
     def requested(self, ar):
-        return self.get_places_sum(state=EnrolmentStates.requested)
+        return self.get_annotated_places(
+            'requested', state=EnrolmentStates.requested)
         # pv = dict(start_date=dd.today())
         # pv.update(state=EnrolmentStates.requested)
         # return rt.models.courses.EnrolmentsByCourse.request(
@@ -456,7 +530,8 @@ class Course(Reservation, Duplicable, Printable):
 
     @dd.virtualfield(models.IntegerField(_("Confirmed")))
     def confirmed(self, ar):
-        return self.get_places_sum(state=EnrolmentStates.confirmed)
+        return self.get_annotated_places(
+            'confirmed', state=EnrolmentStates.confirmed)
         # pv = dict(start_date=dd.today())
         # pv.update(state=EnrolmentStates.confirmed)
         # return rt.models.courses.EnrolmentsByCourse.request(
@@ -464,7 +539,8 @@ class Course(Reservation, Duplicable, Printable):
 
     @dd.virtualfield(models.IntegerField(_("Trying")))
     def trying(self, ar):
-        return self.get_places_sum(state=EnrolmentStates.trying)
+        return self.get_annotated_places(
+            'trying', state=EnrolmentStates.trying)
     
     @dd.requestfield(_("Enrolments"))
     def enrolments(self, ar):
@@ -495,28 +571,6 @@ dd.update_field(Course, 'every_unit', default=models.NOT_PROVIDED)
 dd.update_field(Course, 'every', default=models.NOT_PROVIDED)
 
 
-if FILL_EVENT_GUESTS:
-
-    @dd.receiver(dd.post_save, sender=cal.Event,
-                 dispatch_uid="fill_event_guests_from_course")
-    def fill_event_guests_from_course(sender=None, instance=None, **kw):
-        #~ logger.info("20130528 fill_event_guests_from_course")
-        if settings.SITE.loading_from_dump:
-            return
-        event = instance
-        if event.is_user_modified():
-            return
-        if event.is_fixed_state():
-            return
-        if not isinstance(event.owner, Course):
-            return
-        course = event.owner
-        if event.guest_set.count() > 0:
-            return
-        for e in course.enrolment_set.all():
-            cal.Guest(partner=e.pupil, event=event).save()
-
-
 # ENROLMENT
 
 
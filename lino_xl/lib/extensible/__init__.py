@@ -62,6 +62,13 @@ class Plugin(ad.Plugin):
                 'src', 'locale',
                 'extensible-lang-' + language + '.js')
 
+    def get_patterns(self):
+        from django.conf.urls import url
+        from . import views
+        return [
+            url(r'^extensible/range$', views.CalendarRangeView.as_view())
+        ]
+
     def setup_main_menu(config, site, user_type, m):
         m = m.add_menu("cal", site.plugins.cal.verbose_name)
         # m = m.add_menu("cal", _("Calendar"))
@@ -187,7 +187,8 @@ class PanelEvents(Events):
         if startDate:
             d = parsedate(startDate)
             #~ logger.info("startDate is %r", d)
-            fkw.update(start_date__gte=d)
+            # include multi-day entries which started before d
+            fkw.update(effective_end_date__gte=d)
         #~ logger.info("20120118 filter is %r", filter)
 
         #~ subs = Subscription.objects.filter(user=request.user).values_list('calendar__id',flat=True)
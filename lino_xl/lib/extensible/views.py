@@ -0,0 +1,79 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2018 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""Views for `lino_xl.lib.extensible`.
+
+"""
+
+from __future__ import unicode_literals
+
+import datetime
+
+from django.http import HttpResponseBadRequest, HttpResponseForbidden
+from django.http import JsonResponse
+from django.views.generic import View
+from django.utils.translation import ugettext as _
+
+from lino.api import rt
+from lino.core import constants
+from lino.modlib.office.roles import OfficeUser
+
+RANGE_FIELDS = ('id', 'start_date', 'start_time', 'end_date', 'end_time',
+                'summary', 'room_id', 'user_id', 'state', 'access_class')
+"""The fields of every calendar entry returned by
+:class:`CalendarRangeView`.  The last one is used only for hiding the
+summary of foreign entries with access class "show busy".
+
+"""
+
+
+def parse_iso_date(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+
+class CalendarRangeView(View):
+    """Return the calendar entries which overlap with a given date range
+    as a compact JSON object with two keys: `fields` (the list of
+    field names) and `rows` (a list of lists of values).
+
+    The range is given by the URL parameters of the CalendarPanel
+    (``startDate`` and ``endDate``, both in ISO format).  Optional
+    parameters ``room`` and ``user`` (each of them may be repeated)
+    restrict the result to the given rooms and responsible users.
+
+    See :meth:`Event.get_range_queryset
+    <lino_xl.lib.cal.models.Event.get_range_queryset>`.
+
+    """
+
+    def get(self, request, *args, **kwargs):
+        me = request.user
+        if not me.user_type.has_required_roles([OfficeUser]):
+            return HttpResponseForbidden()
+        try:
+            start = parse_iso_date(
+                request.GET[constants.URL_PARAM_START_DATE])
+            end = parse_iso_date(request.GET[constants.URL_PARAM_END_DATE])
+        except (KeyError, ValueError) as e:
+            return HttpResponseBadRequest(str(e))
+        rooms = request.GET.getlist('room') or None
+        users = request.GET.getlist('user') or None
+        qs = rt.models.cal.Event.get_range_queryset(
+            start, end, rooms=rooms, users=users)
+        qs = qs.order_by('start_date', 'start_time', 'id')
+        show_busy = rt.models.cal.AccessClasses.show_busy.value
+        busy = _("Busy")
+        rows = []
+        for row in qs.values_list(*RANGE_FIELDS):
+            row = list(row)
+            for i in (8, 9):
+                # choicelist fields may return Choice instances
+                row[i] = getattr(row[i], 'value', row[i])
+            if row[9] == show_busy and row[7] != me.pk:
+                row[5] = busy
+            for i in (1, 2, 3, 4):
+                if row[i] is not None:
+                    row[i] = row[i].isoformat()
+            rows.append(row[:9])
+        return JsonResponse(dict(fields=RANGE_FIELDS[:9], rows=rows))
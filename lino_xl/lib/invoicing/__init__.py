@@ -11,7 +11,9 @@ See :doc:`/specs/invoicing`.
 .. autosummary::
     :toctree:
 
+    utils
     fixtures.demo_bookings
+    management.commands.execute_plan
 
 """
 
@@ -35,6 +37,22 @@ class Plugin(Plugin):
 
     invoiceable_label = _("Invoiced object")
 
+    chunk_size = 100
+    """
+    The number of invoices to generate in one database transaction
+    when executing an invoicing plan.
+    """
+
+    worker_processes = 0
+    """
+    The number of worker processes to use when executing an invoicing
+    plan using the :manage:`execute_plan` command.  Values below 2
+    mean to generate all invoices in the current process.  The
+    :class:`ExecutePlan <lino_xl.lib.invoicing.actions.ExecutePlan>`
+    action in the web interface always runs in the current process.
+    See :func:`lino_xl.lib.invoicing.utils.execute_plan_parallel`.
+    """
+
     def on_site_startup(self, site):
         from lino.core.utils import resolve_model
         self.voucher_model = resolve_model(self.voucher_model)
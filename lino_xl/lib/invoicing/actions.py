@@ -5,6 +5,9 @@
 
 from __future__ import unicode_literals
 
+from django.db import models
+from django.db.models import Case, When, Value
+
 from lino.api import dd, rt, _
 
 
@@ -60,9 +63,10 @@ class ExecutePlan(dd.Action):
     icon_name = 'money'
 
     def run_from_ui(self, ar, **kw):
+        # Parallel execution is available only through the
+        # execute_plan admin command, not within a web request.
         plan = ar.selected_rows[0]
-        for item in plan.items.filter(selected=True, invoice__isnull=True):
-            item.create_invoice(ar)
+        plan.create_invoices(ar)
         ar.success(refresh=True)
 
 
@@ -90,8 +94,8 @@ class ToggleSelection(dd.Action):
 
     def run_from_ui(self, ar, **kw):
         plan = ar.selected_rows[0]
-        for item in plan.items.all():
-            item.selected = not item.selected
-            item.save()
+        plan.items.update(selected=Case(
+            When(selected=True, then=Value(False)),
+            default=Value(True), output_field=models.BooleanField()))
         ar.success(refresh=True)
 
@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2018 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""Defines the :manage:`execute_plan` admin command:
+
+.. management_command:: execute_plan
+
+.. py2rst::
+
+  from lino_xl.lib.invoicing.management.commands.execute_plan \
+      import Command
+  print(Command.help)
+
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lino.api import dd, rt
+from lino.core.requests import BaseRequest
+
+from lino_xl.lib.invoicing.utils import execute_plan_parallel
+
+
+class Command(BaseCommand):
+    args = "PLAN_ID"
+    help = """
+
+    Execute the given invoicing plan, i.e. generate and register the
+    invoices for all its selected suggestions.
+
+    Use --workers to specify the number of worker processes (default
+    is the value of the `worker_processes` plugin attribute).
+
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('plan', type=int, metavar='PLAN_ID')
+        parser.add_argument('-w', '--workers', type=int,
+                            dest='workers', default=None,
+                            help="Number of worker processes."),
+
+    def handle(self, *args, **options):
+        Plan = rt.models.invoicing.Plan
+        try:
+            plan = Plan.objects.get(pk=options['plan'])
+        except Plan.DoesNotExist:
+            raise CommandError("No plan {0}".format(options['plan']))
+        ar = BaseRequest(user=plan.user)
+
+        def progress(done, total):
+            dd.logger.info("%d of %d suggestions done.", done, total)
+
+        n = execute_plan_parallel(
+            plan, ar, workers=options['workers'], progress=progress)
+        dd.logger.info("%d invoices have been created.", n)
@@ -9,7 +9,7 @@ from builtins import str
 from decimal import Decimal
 ZERO = Decimal()
 
-from django.db import models
+from django.db import models, transaction
 
 from django.utils.translation import string_concat
 from django.utils import translation
@@ -136,6 +136,11 @@ class Plan(UserAuthored):
         return plan
 
     def fill_plan(self, ar):
+        """Create one invoicing suggestion (:class:`Item`) per partner
+        having invoiceables.  The suggestions are collected in memory
+        and written using a single `bulk_create`.
+
+        """
         Item = rt.models.invoicing.Item
         collected = dict()
         for obj in self.get_invoiceables_for_plan():
@@ -171,7 +176,125 @@ class Plan(UserAuthored):
             elif n == ItemsByPlan.row_height + 1:
                 item.preview += '...'
             item.number_of_invoiceables += 1
-            item.save()
+        Item.objects.bulk_create(list(collected.values()))
+
+    def get_invoiceables_by_partner(self, partners=None):
+        """Return a dict which maps the primary key of every invoice
+        recipient to the list of its invoiceables for this plan.
+
+        If `partners` is given, collect only the invoiceables of these
+        partners (one lookup per partner).  Otherwise collect those of
+        all partners in a single pass.
+
+        """
+        invoiceables = dict()
+        if partners is None:
+            for obj in self.get_invoiceables_for_plan():
+                partner = obj.get_invoiceable_partner()
+                if partner is not None:
+                    invoiceables.setdefault(partner.pk, []).append(obj)
+        else:
+            for partner in partners:
+                invoiceables[partner.pk] = list(
+                    self.get_invoiceables_for_plan(partner))
+        return invoiceables
+
+    def create_invoices(self, ar, items=None, lock_journal=False,
+                        progress=None, partners=None):
+        """Create and register the invoices for the given suggestions
+        (default: all selected suggestions of this plan which have no
+        invoice yet).
+
+        The invoiceables of all partners are collected in one pass.
+        Invoices are created in chunks of
+        :attr:`chunk_size <lino_xl.lib.invoicing.Plugin.chunk_size>`
+        suggestions.  The
+        invoice items of a chunk are written using `bulk_create`, and
+        the invoices of a chunk are registered together using
+        :meth:`register_vouchers
+        <lino_xl.lib.ledger.models.Voucher.register_vouchers>`.
+
+        Every chunk uses two database transactions.  The first one
+        numbers and saves the invoices of the chunk.  The second one
+        writes their items and registers them.  If the second one
+        fails, the invoices of the chunk are deleted.
+
+        If `lock_journal` is `True`, the first transaction starts by
+        taking a lock on the journal, which is released as soon as the
+        numbers have been committed.  This is needed when several
+        processes generate invoices into the same journal at the same
+        time (see
+        :func:`lino_xl.lib.invoicing.utils.execute_plan_parallel`).
+
+        `progress` is an optional callable which will be called after
+        each chunk with the number of suggestions processed.
+
+        `partners` is forwarded to :meth:`get_invoiceables_by_partner`.
+
+        Returns the list of created invoices.
+
+        """
+        if self.journal is None:
+            raise Warning(_("No journal specified"))
+        if items is None:
+            items = self.items.filter(
+                selected=True, invoice__isnull=True).select_related(
+                    'partner')
+        items = list(items)
+        invoiceables = self.get_invoiceables_by_partner(partners)
+        ITEM_MODEL = dd.resolve_model(dd.plugins.invoicing.item_model)
+        M = ITEM_MODEL._meta.get_field('voucher').remote_field.to
+        Journal = rt.models.ledger.Journal
+        chunk_size = dd.plugins.invoicing.chunk_size
+        invoices = []
+        for i in range(0, len(items), chunk_size):
+            chunk = items[i:i+chunk_size]
+            built = []
+            for item in chunk:
+                invoice, lst = item.build_invoice(
+                    ar, invoiceables.get(item.partner_id, []))
+                built.append((item, invoice, lst))
+
+            # number and save the invoices in a first transaction so
+            # that the journal is not locked longer than needed
+            with transaction.atomic():
+                if lock_journal:
+                    Journal.objects.select_for_update().get(
+                        pk=self.journal_id)
+                for item, invoice, lst in built:
+                    invoice.full_clean()
+                    invoice.save()
+
+            try:
+                with transaction.atomic():
+                    iitems = []
+                    for item, invoice, lst in built:
+                        seqno = 0
+                        for ii in lst:
+                            seqno += 1
+                            ii.voucher = invoice
+                            ii.seqno = seqno
+                            set_default_title(ii)
+                            ii.full_clean()
+                            iitems.append(ii)
+                    ITEM_MODEL.objects.bulk_create(iitems)
+                    for item, invoice, lst in built:
+                        rt.models.invoicing.Item.objects.filter(
+                            pk=item.pk).update(invoice=invoice)
+                        invoice.compute_totals()
+                        invoice.full_clean()
+                    M.register_vouchers(ar, [b[1] for b in built])
+            except Exception:
+                # don't leave empty invoices behind
+                M.objects.filter(
+                    pk__in=[b[1].pk for b in built]).delete()
+                raise
+            for item, invoice, lst in built:
+                item.invoice = invoice
+                invoices.append(invoice)
+            if progress is not None:
+                progress(len(chunk))
+        return invoices
 
     # def execute_plan(self,  ar):
     #     """Create an invoice for the given partner.
@@ -221,9 +344,12 @@ class Item(dd.Model):
 
     exec_item = ExecuteItem()
 
-    def create_invoice(self,  ar):
-        if self.plan.journal is None:
-            raise Warning(_("No journal specified"))
+    def build_invoice(self, ar, invoiceables):
+        """Return a tuple `(invoice, items)` with an unsaved invoice for
+        this suggestion and the list of its unsaved items, generated
+        from the given invoiceables.
+
+        """
         ITEM_MODEL = dd.resolve_model(dd.plugins.invoicing.item_model)
         M = ITEM_MODEL._meta.get_field('voucher').remote_field.to
         invoice = M(partner=self.partner, journal=self.plan.journal,
@@ -233,7 +359,7 @@ class Item(dd.Model):
         lng = invoice.get_print_language()
         items = []
         with translation.override(lng):
-            for ii in self.plan.get_invoiceables_for_plan(self.partner):
+            for ii in invoiceables:
                 pt = ii.get_invoiceable_payment_term()
                 if pt:
                     invoice.payment_term = pt
@@ -249,6 +375,13 @@ class Item(dd.Model):
             # dd.logger.warning(
             #     _("No invoiceables found for %s.") % self.partner)
             # return
+        return invoice, items
+
+    def create_invoice(self,  ar):
+        if self.plan.journal is None:
+            raise Warning(_("No journal specified"))
+        invoice, items = self.build_invoice(
+            ar, self.plan.get_invoiceables_for_plan(self.partner))
 
         invoice.full_clean()
         invoice.save()
@@ -342,14 +475,15 @@ dd.inject_action(
     invoiceable_type_choices=invoiceable_type_choices)
 
 
-@dd.receiver(dd.pre_save, sender=dd.plugins.invoicing.item_model)
-def item_pre_save_handler(sender=None, instance=None, **kwargs):
-    """When the user sets `title` of an automatically generated invoice
-    item to an empty string, then Lino restores the default value for
-    both title and description
+def set_default_title(self):
+    """Fill the `title` and description of the given automatically
+    generated invoice item if its `title` is empty.
+
+    Called by :func:`item_pre_save_handler` and by
+    :meth:`Plan.create_invoices`, which writes the invoice items using
+    `bulk_create` and hence doesn't send any `pre_save` signal.
 
     """
-    self = instance
     if self.invoiceable_id and not self.title:
         lng = self.voucher.get_print_language()
         # lng = self.voucher.partner.language or dd.get_default_language()
@@ -358,6 +492,16 @@ def item_pre_save_handler(sender=None, instance=None, **kwargs):
             self.invoiceable.setup_invoice_item(self)
 
 
+@dd.receiver(dd.pre_save, sender=dd.plugins.invoicing.item_model)
+def item_pre_save_handler(sender=None, instance=None, **kwargs):
+    """When the user sets `title` of an automatically generated invoice
+    item to an empty string, then Lino restores the default value for
+    both title and description
+
+    """
+    set_default_title(instance)
+
+
 # def get_invoicing_voucher_type():
 #     voucher_model = dd.resolve_model(dd.plugins.invoicing.voucher_model)
 #     vt = VoucherTypes.get_for_model(voucher_model)
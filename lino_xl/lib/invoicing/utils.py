@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2018 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""Utilities for executing large invoicing plans.
+
+The invoicing suggestions of a plan are split into shards of
+:attr:`chunk_size <lino_xl.lib.invoicing.Plugin.chunk_size>`
+suggestions (i.e. partners), and every shard is processed by one of a
+pool of worker processes, each of them having its own database
+connection.  Voucher numbers are assigned by
+:meth:`Journal.get_next_number
+<lino_xl.lib.ledger.models.Journal.get_next_number>` while holding a
+lock on the journal.
+
+This requires a database backend which supports row locking
+(e.g. PostgreSQL or MySQL).  On SQLite the plan is executed in the
+current process.
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import time
+import multiprocessing
+
+from django.db import connection, connections
+
+from lino.api import dd, rt
+from lino.core.requests import BaseRequest
+
+
+def split_items(items, size):
+    """Split the given list of invoicing suggestions into shards of
+    at most `size` suggestions.  Each suggestion is for another
+    partner, so every partner is handled by exactly one shard.
+
+    """
+    items = sorted(items, key=lambda i: i.partner_id)
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+def create_invoices_worker(args):
+    """Create the invoices of one shard.  Runs in a worker process.
+
+    """
+    plan_id, user_id, item_ids = args
+    Plan = rt.models.invoicing.Plan
+    Item = rt.models.invoicing.Item
+    plan = Plan.objects.get(pk=plan_id)
+    ar = BaseRequest(user=rt.models.users.User.objects.get(pk=user_id))
+    items = list(Item.objects.filter(
+        pk__in=item_ids, invoice__isnull=True).select_related('partner'))
+    invoices = plan.create_invoices(
+        ar, items, lock_journal=True,
+        partners=[i.partner for i in items])
+    return len(item_ids), len(invoices)
+
+
+def execute_plan_parallel(plan, ar, workers=None, progress=None):
+    """Create and register the invoices for all selected suggestions
+    of the given plan, using a pool of `workers` processes (default
+    :attr:`worker_processes
+    <lino_xl.lib.invoicing.Plugin.worker_processes>`).
+
+    `progress` is an optional callable which is called after each
+    shard with two arguments: the number of suggestions done so far
+    and the total number of suggestions.
+
+    Returns the number of created invoices.
+
+    """
+    if workers is None:
+        workers = dd.plugins.invoicing.worker_processes
+    items = list(plan.items.filter(selected=True, invoice__isnull=True))
+    total = len(items)
+    if workers < 2 or connection.vendor == 'sqlite':
+        done = [0]
+
+        def cb(n):
+            done[0] += n
+            if progress is not None:
+                progress(done[0], total)
+        return len(plan.create_invoices(ar, items, progress=cb))
+
+    started = time.time()
+    shards = split_items(items, dd.plugins.invoicing.chunk_size)
+    tasks = [(plan.pk, ar.get_user().pk, [i.pk for i in shard])
+             for shard in shards]
+
+    # The worker processes must not share the database connection of
+    # this process.
+    for conn in connections.all():
+        conn.close()
+    if hasattr(multiprocessing, 'get_context'):
+        pool = multiprocessing.get_context('fork').Pool(processes=workers)
+    else:
+        pool = multiprocessing.Pool(processes=workers)
+    done = 0
+    count = 0
+    try:
+        for n, created in pool.imap_unordered(
+                create_invoices_worker, tasks):
+            done += n
+            count += created
+            if progress is not None:
+                progress(done, total)
+    finally:
+        pool.close()
+        pool.join()
+    dd.logger.info(
+        "Created %d invoices for %d suggestions in %d processes "
+        "(%.1f seconds).", count, total, workers, time.time() - started)
+    return count
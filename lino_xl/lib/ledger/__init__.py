@@ -11,6 +11,7 @@ See :doc:`/specs/ledger`.
     roles
     fields
     management.commands.reregister
+    management.commands.rebuild_balances
     fixtures.std
     fixtures.demo
     fixtures.demo_bookings
@@ -84,6 +85,15 @@ class Plugin(ad.Plugin):
     legacy invoices in your database but not their payments.
     """
 
+    aging_buckets = (30, 60, 90)
+    """
+    The upper limits (in days) of the aging buckets shown by the
+    :class:`Debtors <lino_xl.lib.ledger.ui.Debtors>` and
+    :class:`Creditors <lino_xl.lib.ledger.ui.Creditors>` reports.
+    The default value gives the buckets 0-30, 31-60, 61-90 and >90
+    days.  Set this to an empty tuple to show no aging buckets.
+    """
+
     def on_site_startup(self, site):
         if site.the_demo_date is not None:
             if self.start_year > site.the_demo_date.year:
@@ -136,6 +146,7 @@ class Plugin(ad.Plugin):
         m.add_action('ledger.AllVouchers')
         m.add_action('ledger.VoucherTypes')
         m.add_action('ledger.AllMovements')
+        m.add_action('ledger.PeriodBalances')
         m.add_action('ledger.FiscalYears')
         m.add_action('ledger.TradeTypes')
         m.add_action('ledger.JournalGroups')
@@ -0,0 +1,54 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2018 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""Defines the :manage:`rebuild_balances` admin command:
+
+.. management_command:: rebuild_balances
+
+.. py2rst::
+
+  from lino_xl.lib.ledger.management.commands.rebuild_balances \
+      import Command
+  print(Command.help)
+
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+from django.core.management.base import BaseCommand
+
+from lino.api import dd
+
+from lino_xl.lib.ledger.utils import rebuild_period_balances
+
+
+def puts(msg):
+    dd.logger.info(msg)
+
+
+class Command(BaseCommand):
+    help = """
+
+    Verify the table of period balances against the ledger movements
+    and rebuild it.
+
+    Reports every account, partner and accounting period for which
+    the stored balance differs from the sum of the movements.
+
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--check', action='store_true',
+                            dest='check', default=False,
+                            help="Don't rebuild. Just report differences."),
+
+    def handle(self, *args, **options):
+        diffs = rebuild_period_balances(check=options['check'])
+        for k, old, new in diffs:
+            puts("{0} : {1} != {2}".format(k, old, new))
+        msg = "{0} differences found."
+        puts(msg.format(len(diffs)))
+        if not options['check']:
+            puts("Period balances have been rebuilt.")
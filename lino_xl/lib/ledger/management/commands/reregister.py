@@ -1,5 +1,5 @@
 # -*- coding: UTF-8 -*-
-# Copyright 2016 by Luc Saffre.
+# Copyright 2016-2018 by Luc Saffre.
 # License: BSD (see file COPYING for details)
 
 """Defines the :manage:`reregister` admin command:
@@ -17,71 +17,212 @@
 
 from __future__ import unicode_literals, print_function
 
-from optparse import make_option
+import os
+import json
+import warnings
+import datetime
+
 from clint.textui import progress
 # from clint.textui import puts, progress
 
+from django.db import transaction
+from django.db.models import Q
 from django.core.management.base import BaseCommand  # CommandError
 
 from lino.api import dd, rt
 
 from lino.core.requests import BaseRequest
-from lino_xl.lib.ledger.utils import check_clearings_by_partner
+from lino_xl.lib.ledger.utils import check_clearings_by_keys
+
+CHUNK_SIZE = 100
+"""Default number of vouchers to re-register in one database
+transaction."""
 
 
 def puts(msg):
     dd.logger.info(msg)
 
 
-def reregister_vouchers(username=None, args=[], simulate=False):
-    """Called by :manage:`reregister`. See there."""
+def load_checkpoint(filename):
+    if filename and os.path.exists(filename):
+        with open(filename) as f:
+            return json.load(f)
+    return dict()
+
+
+def save_checkpoint(filename, data):
+    if filename:
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, filename)
+
+
+def reregister_vouchers(username=None, args=[], periods=[], years=[],
+                        chunk_size=CHUNK_SIZE, checkpoint=None,
+                        simulate=False):
+    """Re-register all registered vouchers of the given journals and
+    accounting periods.  Called by :manage:`reregister`. See there.
+
+    `args` is a list of journal references.  If it is empty, use all
+    journals.  `periods` is a list of accounting period references and
+    `years` a list of fiscal year values.  If both are empty, don't
+    filter on the accounting period.
+
+    Vouchers are processed in chunks of `chunk_size`, each chunk in
+    its own database transaction.  Clearings are not checked for every
+    voucher but only once at the end, for the match groups of the
+    movements before and after re-registration.
+
+    The vouchers of each journal are processed in chronological order
+    (by entry date and id) because clearings and balances depend on
+    it.
+
+    If `checkpoint` is the name of a file, the entry date and id of
+    the last voucher processed in each journal are written to that
+    file after each chunk, and a subsequent call with the same
+    `checkpoint` and the same filters continues where the previous
+    call has been interrupted.  The file is removed when everything has been done.
+
+    `username` is deprecated and ignored.  Every voucher is
+    re-registered by its author.
+
+    Returns the number of re-registered vouchers.
+
+    """
+    if username is not None:
+        warnings.warn(
+            "The username argument of reregister_vouchers() is ignored",
+            DeprecationWarning)
     Journal = rt.models.ledger.Journal
+    Movement = rt.models.ledger.Movement
+    AccountingPeriod = rt.models.ledger.AccountingPeriod
+    FiscalYears = rt.models.ledger.FiscalYears
     VoucherStates = rt.models.ledger.VoucherStates
     if len(args):
         journals = [Journal.get_by_ref(a) for a in args]
     else:
-        journals = Journal.objects.order_by('seqno')
+        journals = list(Journal.objects.order_by('seqno'))
+    flt = dict()
+    if len(periods):
+        flt.update(accounting_period__in=[
+            AccountingPeriod.get_by_ref(a) for a in periods])
+    if len(years):
+        flt.update(accounting_period__year__in=[
+            FiscalYears.get_by_value(y) for y in years])
+    scope = '|'.join([
+        ','.join(sorted(periods)),
+        ','.join(sorted([str(y) for y in years]))])
+
+    data = load_checkpoint(checkpoint)
+    done = data.setdefault('done', dict())
+    keys = set([tuple(k) for k in data.get('keys', [])])
+    if done:
+        puts("Resuming from checkpoint {0}".format(checkpoint))
+
+    def collect_keys(pks):
+        qs = Movement.objects.filter(
+            voucher_id__in=pks, partner__isnull=False)
+        keys.update(qs.order_by().values_list(
+            'partner_id', 'account_id', 'match').distinct())
+
     count = 0
-    clear_afterwards = True
     for jnl in journals:
         msg = "Re-register all vouchers in journal {0}".format(jnl)
         puts(msg)
         cl = jnl.get_doc_model()
-        qs = cl.objects.filter(journal=jnl, state=VoucherStates.registered)
-        qs = qs.order_by('entry_date')
-        for obj in progress.bar(qs):
-            ses = BaseRequest(user=obj.user)
-            obj.register_voucher(ses, not clear_afterwards)
-            count += 1
+        qs = cl.objects.filter(
+            journal=jnl, state=VoucherStates.registered, **flt)
+        ckey = (jnl.ref or str(jnl.pk)) + '|' + scope
+        last = done.get(ckey)
+        if last is not None:
+            last_date = datetime.datetime.strptime(
+                last[0], '%Y-%m-%d').date()
+            qs = qs.filter(
+                Q(entry_date__gt=last_date) |
+                Q(entry_date=last_date, id__gt=last[1]))
+        qs = qs.order_by('entry_date', 'id')
+        if simulate:
+            n = qs.count()
+            puts("Would re-register {0} vouchers.".format(n))
+            count += n
+            continue
+        rows = list(qs.values_list('entry_date', 'id'))
+        for i in progress.bar(range(0, len(rows), chunk_size)):
+            chunk = [pk for d, pk in rows[i:i+chunk_size]]
+            with transaction.atomic():
+                collect_keys(chunk)
+                objs = cl.objects.filter(id__in=chunk)
+                for obj in objs.order_by('entry_date', 'id'):
+                    ses = BaseRequest(user=obj.user)
+                    obj.register_voucher(ses, False)
+                    count += 1
+                collect_keys(chunk)
+            last_date, last_id = rows[i:i+chunk_size][-1]
+            done[ckey] = [last_date.isoformat(), last_id]
+            data['keys'] = sorted(keys)
+            save_checkpoint(checkpoint, data)
+
+    if simulate:
+        msg = "{0} vouchers would have been re-registered."
+        puts(msg.format(count))
+        return count
 
     msg = "{0} vouchers have been re-registered."
     puts(msg.format(count))
 
-    if clear_afterwards:
-        msg = "Check clearings for all partners"
-        puts(msg)
-        qs = rt.models.contacts.Partner.objects.all()
-        for obj in progress.bar(qs):
-            check_clearings_by_partner(obj)
+    msg = "Check clearings for {0} match groups".format(len(keys))
+    puts(msg)
+    check_clearings_by_keys(keys)
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return count
 
 
 class Command(BaseCommand):
-    args = "[app1.Model1] [app2.Model2] ..."
+    args = "[JNL1] [JNL2] ..."
     help = """
 
     Re-register all ledger vouchers.
 
     If no arguments are given, run it on all vouchers.
-    Otherwise every positional argument is expected to be a model name in
-    the form `app_label.ModelName`, and only these models are being
-    re-registered.
+    Otherwise every positional argument is expected to be the
+    reference of a journal, and only the vouchers of these journals
+    are being re-registered.
+
+    Use --period or --year to re-register only the vouchers of given
+    accounting periods or fiscal years.  Use --checkpoint to be able
+    to resume an interrupted run.
 
     """
 
     def add_arguments(self, parser):
+        parser.add_argument('journals', nargs='*', metavar='JNL')
         parser.add_argument('-s', '--simulate', action='store_true', dest='simulate',
                             default=False,
                             help="Don't actually do it. Just simulate."),
+        parser.add_argument('-p', '--period', action='append',
+                            dest='periods', default=[],
+                            help="Reference of an accounting period. "
+                            "May be given more than once."),
+        parser.add_argument('-y', '--year', action='append',
+                            dest='years', default=[],
+                            help="A fiscal year. "
+                            "May be given more than once."),
+        parser.add_argument('-c', '--chunk-size', type=int,
+                            dest='chunk_size', default=CHUNK_SIZE,
+                            help="Number of vouchers per transaction."),
+        parser.add_argument('--checkpoint', dest='checkpoint',
+                            default=None,
+                            help="Name of a file where to store the "
+                            "progress so that an interrupted run "
+                            "can be resumed."),
 
     def handle(self, *args, **options):
-        reregister_vouchers(args=args, simulate=options['simulate'])
+        reregister_vouchers(
+            args=options['journals'] or args,
+            periods=options['periods'], years=options['years'],
+            chunk_size=options['chunk_size'],
+            checkpoint=options['checkpoint'],
+            simulate=options['simulate'])
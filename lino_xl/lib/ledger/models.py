@@ -18,7 +18,7 @@ logger = logging.getLogger(__name__)
 import datetime
 from dateutil.relativedelta import relativedelta
 
-from django.db import models
+from django.db import models, transaction
 
 from atelier.utils import last_day_of_month
 
@@ -35,10 +35,14 @@ from lino_xl.lib.accounts.utils import DEBIT, CREDIT, ZERO
 from lino_xl.lib.accounts.fields import DebitOrCreditField
 from lino_xl.lib.contacts.choicelists import PartnerEvents
 from lino.modlib.system.choicelists import ObservedEvent
+from lino_xl.lib.countries.utils import is_cached
 
 
 
-from .utils import get_due_movements, check_clearings_by_partner
+from .utils import get_due_movements, check_clearings_by_keys
+from .utils import get_clearing_key, update_period_balances
+from .utils import add_balance_delta, add_balance_deltas
+from .utils import rebuild_period_balances
 from .choicelists import (FiscalYears, VoucherTypes, VoucherStates,
                           PeriodStates, JournalGroups, TradeTypes)
 from .mixins import ProjectRelated, VoucherNumber, JournalRef, PeriodRangeObservable
@@ -569,63 +573,200 @@ class Voucher(UserAuthored, mixins.Registrable, PeriodRangeObservable):
 
     def register_voucher(self, ar, do_clear=True):
         """
-        Delete any existing movements and re-create them
+        Create the movements of this voucher.
+
+        The wanted movements are validated in memory and written using
+        a single `bulk_create`.
+
+        When the voucher has movements already (i.e. when it is being
+        re-registered), call :meth:`update_movements`, which leaves
+        alone the existing movements which are identical to a wanted
+        movement and replaces only those which changed.
+
         """
         # dd.logger.info("20151211 cosi.Voucher.register_voucher()")
         # self.year = FiscalYears.from_date(self.entry_date)
         # dd.logger.info("20151211 movement_set.all().delete()")
 
-        def doit(partners):
-            seqno = 0
-            # dd.logger.info("20151211 gonna call get_wanted_movements()")
-            movements = self.get_wanted_movements()
-            # dd.logger.info("20151211 gonna save %d movements", len(movements))
-            # self.full_clean()
-            # self.save()
-            
-            fcu = dd.plugins.ledger.force_cleared_until
+        if self.movement_set.exists():
+            self.update_movements(do_clear)
+            return
+
+        def doit(keys):
+            movements = self.get_prepared_movements()
+            rt.models.ledger.Movement.objects.bulk_create(movements)
             for m in movements:
-                seqno += 1
-                m.seqno = seqno
-                if fcu and self.entry_date <= fcu:
-                    m.cleared = True
-                m.full_clean()
-                m.save()
-                if m.partner:
-                    partners.add(m.partner)
+                k = get_clearing_key(m)
+                if k is not None:
+                    keys.add(k)
 
         self.do_and_clear(doit, do_clear)
 
+    @classmethod
+    def register_vouchers(cls, ar, vouchers, do_clear=True):
+        """Register the given vouchers, none of which may have movements
+        yet.
+
+        This gives the same result as calling :meth:`register` on each
+        of them, but the movements of all vouchers are written using a
+        single `bulk_create`, and the :class:`PeriodBalance` rows and
+        clearings are updated once for all of them.  Used by
+        :meth:`Plan.create_invoices
+        <lino_xl.lib.invoicing.models.Plan.create_invoices>`.
+
+        """
+        Movement = rt.models.ledger.Movement
+        registered = VoucherStates.registered
+        movements = []
+        keys = set()
+        deltas = dict()
+        with transaction.atomic():
+            for v in vouchers:
+                old = v.state
+                v.before_state_change(ar, old, registered)
+                v.state = registered
+                v.after_state_change(ar, old, registered)
+                v.save()
+                clear = do_clear and v.journal.auto_check_clearings
+                for m in v.get_prepared_movements():
+                    movements.append(m)
+                    add_balance_delta(
+                        deltas, (m.account_id, m.partner_id,
+                                 v.accounting_period_id),
+                        m.dc, m.amount)
+                    k = get_clearing_key(m)
+                    if clear and k is not None:
+                        keys.add(k)
+            Movement.objects.bulk_create(movements)
+            update_period_balances(deltas)
+            check_clearings_by_keys(keys)
+
+    def get_prepared_movements(self):
+        """Return a list of the movements wanted by this voucher, numbered
+        and validated, ready to be saved.
+
+        Foreign keys to objects which are already given as instances
+        are not validated again, which saves a database query per
+        foreign key and per movement.
+
+        """
+        movements = []
+        seqno = 0
+        # dd.logger.info("20151211 gonna call get_wanted_movements()")
+        fcu = dd.plugins.ledger.force_cleared_until
+        for m in self.get_wanted_movements():
+            seqno += 1
+            m.seqno = seqno
+            if fcu and self.entry_date <= fcu:
+                m.cleared = True
+            exclude = [
+                f.name for f in m._meta.concrete_fields
+                if f.many_to_one and is_cached(f, m)]
+            m.full_clean(exclude=exclude)
+            movements.append(m)
+        return movements
+
+    def update_movements(self, do_clear=True):
+        """Update the existing movements of this voucher to match the
+        wanted movements, leaving unchanged movements alone.  Then
+        update the :class:`PeriodBalance` rows and check clearings for
+        the match groups of all movements which have been deleted or
+        created.
+
+        Called by :meth:`register_voucher` when the voucher has
+        movements already.
+
+        """
+        Movement = rt.models.ledger.Movement
+        if not self.journal.auto_check_clearings:
+            do_clear = False
+        fields = [f.attname for f in Movement._meta.concrete_fields
+                  if f.attname not in ('id', 'cleared')]
+
+        def same(a, b):
+            for k in fields:
+                if getattr(a, k) != getattr(b, k):
+                    return False
+            return True
+
+        with transaction.atomic():
+            wanted = dict()
+            for m in self.get_prepared_movements():
+                wanted[m.seqno] = m
+            obsolete = []
+            keys = set()
+            deltas = dict()
+            qs = self.movement_set.select_related(
+                'account', 'voucher')
+            for em in qs:
+                wm = wanted.get(em.seqno)
+                if wm is not None and same(em, wm):
+                    del wanted[em.seqno]
+                else:
+                    obsolete.append(em.pk)
+                    add_balance_delta(
+                        deltas, (em.account_id, em.partner_id,
+                                 em.voucher.accounting_period_id),
+                        em.dc, -em.amount)
+                    k = get_clearing_key(em)
+                    if k is not None:
+                        keys.add(k)
+            if obsolete:
+                Movement.objects.filter(pk__in=obsolete).delete()
+            new = list(wanted.values())
+            Movement.objects.bulk_create(new)
+            for m in new:
+                add_balance_delta(
+                    deltas, (m.account_id, m.partner_id,
+                             self.accounting_period_id),
+                    m.dc, m.amount)
+                k = get_clearing_key(m)
+                if k is not None:
+                    keys.add(k)
+            update_period_balances(deltas)
+            if do_clear:
+                check_clearings_by_keys(keys)
+
     def deregister_voucher(self, ar, do_clear=True):
 
-        def doit(partners):
+        def doit(keys):
             pass
         self.do_and_clear(doit, do_clear)
 
     def do_and_clear(self, func, do_clear):
         """Delete all movements of this voucher, then run the given callable
-        `func`, passing it a set with all partners who had at least
-        one movement in this voucher. The function is expected to add
-        more partners to this set.  Then call `check_clearings` for
-        all these partners.
+        `func`, passing it a set with the keys of all match groups
+        which had at least one movement in this voucher. The function
+        is expected to add more keys to this set.  Then update the
+        :class:`PeriodBalance` rows of the accounts and partners
+        involved and call :func:`check_clearings_by_keys
+        <lino_xl.lib.ledger.utils.check_clearings_by_keys>` for these
+        match groups.
+
+        A key is a tuple `(partner_id, account_id, match)` as returned
+        by :func:`get_clearing_key
+        <lino_xl.lib.ledger.utils.get_clearing_key>`.
 
         """
         existing_mvts = self.movement_set.all()
-        partners = set()
+        keys = set()
         # accounts = set()
         if not self.journal.auto_check_clearings:
             do_clear = False
-        if do_clear:
-            for m in existing_mvts.filter(
-                    account__clearable=True, partner__isnull=False):
-                partners.add(m.partner)
-        existing_mvts.delete()
-        func(partners)
-        if do_clear:
-            for p in partners:
-                check_clearings_by_partner(p)
-            # for a in accounts:
-            #     check_clearings_by_account(a)
+        with transaction.atomic():
+            if do_clear:
+                qs = existing_mvts.filter(partner__isnull=False)
+                keys.update(qs.values_list('partner', 'account', 'match'))
+            deltas = dict()
+            add_balance_deltas(deltas, existing_mvts, -1)
+            existing_mvts.delete()
+            func(keys)
+            add_balance_deltas(deltas, self.movement_set.all())
+            update_period_balances(deltas)
+            if do_clear:
+                check_clearings_by_keys(keys)
+                # for a in accounts:
+                #     check_clearings_by_account(a)
         
         # dd.logger.info("20151211 Done cosi.Voucher.register_voucher()")
 
@@ -867,6 +1008,35 @@ class Movement(ProjectRelated, PeriodRangeObservable):
 Movement.set_widget_options('voucher_link', width=12)
 
 
+class PeriodBalance(dd.Model):
+    """The sum of all debit and credit movements per account, partner
+    and accounting period.
+
+    This table is maintained automatically when a voucher gets
+    registered or deregistered, and it is used by
+    :class:`AccountBalances <lino_xl.lib.ledger.ui.AccountBalances>`
+    instead of summing up the movements.  Use :manage:`rebuild_balances`
+    to verify or rebuild it.
+
+    """
+    allow_cascaded_delete = ['account', 'partner', 'accounting_period']
+
+    class Meta:
+        app_label = 'ledger'
+        verbose_name = _("Period balance")
+        verbose_name_plural = _("Period balances")
+        unique_together = ['account', 'partner', 'accounting_period']
+
+    account = dd.ForeignKey('accounts.Account')
+    partner = dd.ForeignKey(
+        'contacts.Partner',
+        related_name="%(app_label)s_%(class)s_set_by_partner",
+        blank=True, null=True)
+    accounting_period = dd.ForeignKey('ledger.AccountingPeriod')
+    debit = dd.PriceField(_("Debit"), default=ZERO)
+    credit = dd.PriceField(_("Credit"), default=ZERO)
+
+    
 class MatchRule(dd.Model):
 
     class Meta:
@@ -929,14 +1099,7 @@ class VoucherChecker(Checker):
             return obj.seqno
 
         wanted = dict()
-        seqno = 0
-        fcu = dd.plugins.ledger.force_cleared_until
-        for m in obj.get_wanted_movements():
-            seqno += 1
-            m.seqno = seqno
-            if fcu and obj.entry_date <= fcu:
-                m.cleared = True
-            m.full_clean()
+        for m in obj.get_prepared_movements():
             wanted[m2k(m)] = m
 
         for em in obj.movement_set.all():
@@ -962,6 +1125,32 @@ class VoucherChecker(Checker):
 VoucherChecker.activate()
 
 
+class PeriodBalanceChecker(Checker):
+    """Check whether the :class:`PeriodBalance` rows of an accounting
+    period match the sums of its movements.  Fixing the problem
+    rebuilds the balances of the period.
+
+    On sites which have been created before :class:`PeriodBalance`
+    existed, run this checker with `--fix` or the
+    :manage:`rebuild_balances` command in order to fill the table.
+
+    """
+    verbose_name = _("Check period balances")
+    model = 'ledger.AccountingPeriod'
+    messages = dict(
+        diff=_("{0} period balances differ from the movements."),
+    )
+
+    def get_checkdata_problems(self, obj, fix=False):
+        diffs = rebuild_period_balances(check=True, period=obj)
+        if diffs:
+            yield (True, self.messages['diff'].format(len(diffs)))
+            if fix:
+                rebuild_period_balances(period=obj)
+
+PeriodBalanceChecker.activate()
+
+
 class PartnerHasOpenMovements(ObservedEvent):
     text = _("Has open movements")
 
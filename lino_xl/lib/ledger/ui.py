@@ -23,11 +23,13 @@ from lino.api import dd, rt, _, gettext
 from lino import mixins
 from lino.utils.report import Report
 from etgen.html import E
-from lino.utils import join_elems
+from lino.utils import join_elems, SumCollector
 
 from lino_xl.lib.accounts.utils import DEBIT, CREDIT, ZERO
 
-from .utils import Balance, DueMovement, get_due_movements
+from .utils import Balance, DueMovement, get_due_movements, get_due_sums
+from .utils import get_aging_bucket, get_aging_bucket_labels
+from .utils import PARTNER_CHUNK_SIZE
 from .choicelists import TradeTypes, FiscalYears, VoucherTypes, JournalGroups
 from .choicelists import VoucherStates
 from .mixins import JournalRef
@@ -105,6 +107,14 @@ class AccountingPeriods(dd.Table):
     column_names = "ref start_date end_date year state remark *"
 
 
+class PeriodBalances(dd.Table):
+    required_roles = dd.login_required(LedgerStaff)
+    model = 'ledger.PeriodBalance'
+    editable = False
+    order_by = ["accounting_period__ref", "account__ref", "partner"]
+    column_names = "accounting_period account partner debit credit *"
+
+
 class PaymentTerms(dd.Table):
     required_roles = dd.login_required(LedgerStaff)
     model = 'ledger.PaymentTerm'
@@ -441,7 +451,7 @@ class AccountBalances(dd.Table):
         sp = pv.start_period or AccountingPeriod.get_default_for_date(
             dd.today())
         ep = pv.end_period or sp
-        
+
         qs = super(AccountBalances, self).get_request_queryset(ar)
         
         flt = self.rowmvtfilter(ar)
@@ -449,29 +459,27 @@ class AccountBalances(dd.Table):
         oldflt.update(flt)
         duringflt = dict()
         duringflt.update(flt)
-        during_periods = AccountingPeriod.objects.filter(
-            ref__gte=sp.ref, ref__lte=ep.ref)
-        before_periods = AccountingPeriod.objects.filter(
-            ref__lt=sp.ref)
-        oldflt.update(voucher__accounting_period__in=before_periods)
-        duringflt.update(voucher__accounting_period__in=during_periods)
+        oldflt.update(accounting_period__ref__lt=sp.ref)
+        duringflt.update(accounting_period__ref__gte=sp.ref,
+                         accounting_period__ref__lte=ep.ref)
 
         outer_link = self.model._meta.model_name
 
-        def addann(kw, name, dc, flt):
-            mvts = rt.models.ledger.Movement.objects.filter(dc=dc, **flt)
-            mvts = mvts.order_by()
-            mvts = mvts.values(outer_link)  # this was the important thing
-            mvts = mvts.annotate(total=Sum(
-                'amount', output_field=dd.PriceField()))
-            mvts = mvts.values('total')
-            kw[name] = Subquery(mvts, output_field=dd.PriceField())
+        def addann(kw, name, fieldname, flt):
+            # read the precomputed sums, not the movements
+            qs = rt.models.ledger.PeriodBalance.objects.filter(**flt)
+            qs = qs.order_by()
+            qs = qs.values(outer_link)  # this was the important thing
+            qs = qs.annotate(total=Sum(
+                fieldname, output_field=dd.PriceField()))
+            qs = qs.values('total')
+            kw[name] = Subquery(qs, output_field=dd.PriceField())
 
         kw = dict()
-        addann(kw, 'old_d', DEBIT, oldflt)
-        addann(kw, 'old_c', CREDIT, oldflt)
-        addann(kw, 'during_d', DEBIT, duringflt)
-        addann(kw, 'during_c', CREDIT, duringflt)
+        addann(kw, 'old_d', 'debit', oldflt)
+        addann(kw, 'old_c', 'credit', oldflt)
+        addann(kw, 'during_d', 'debit', duringflt)
+        addann(kw, 'during_c', 'credit', duringflt)
         
         qs = qs.annotate(**kw)
 
@@ -578,8 +586,31 @@ class DebtorsCreditors(dd.VirtualTable):
 
     d_or_c = NotImplementedError
 
+    @classmethod
+    def setup_columns(cls):
+        buckets = dd.plugins.ledger.aging_buckets
+        names = ''
+        for i, label in enumerate(get_aging_bucket_labels(buckets)):
+            vf = dd.VirtualField(
+                dd.PriceField(_("{} days").format(label)),
+                cls.aging_getter(i))
+            cls.add_virtual_field('aging' + str(i), vf)
+            names += ' aging' + str(i)
+        cls.column_names = "age due_date partner partner_id balance" \
+            + names + " vouchers"
+
+    @classmethod
+    def aging_getter(cls, i):
+        def func(fld, row, ar):
+            return row._aging[i] or None
+        return func
+
     @classmethod
     def get_data_rows(self, ar):
+        """Yield the partners with an open balance in a single grouped
+        query, then collect the due movements of these partners only.
+
+        """
         rows = []
         mi = ar.master_instance
         if mi is None:  # called directly from main menu
@@ -588,21 +619,39 @@ class DebtorsCreditors(dd.VirtualTable):
             end_date = ar.param_values.today
         else:   # called from Situation report
             end_date = mi.today
-        
-        qs = rt.models.contacts.Partner.objects.order_by('name')
-        for row in qs:
+
+        balances = SumCollector()
+        for grp in get_due_sums(self.d_or_c, value_date__lte=end_date):
+            if grp['partner'] is not None and grp['balance']:
+                balances.collect(grp['partner'], grp['balance'])
+        pks = [pk for pk, bal in balances.items() if bal > ZERO]
+        if len(pks) == 0:
+            return rows
+
+        buckets = dd.plugins.ledger.aging_buckets
+        expected = dict()
+        for i in range(0, len(pks), PARTNER_CHUNK_SIZE):
+            for dm in get_due_movements(
+                    self.d_or_c, partner__in=pks[i:i+PARTNER_CHUNK_SIZE],
+                    value_date__lte=end_date):
+                if dm.balance:
+                    expected.setdefault(dm.partner.pk, []).append(dm)
+
+        qs = rt.models.contacts.Partner.objects.filter(pk__in=pks)
+        for row in qs.order_by('name'):
             row._balance = ZERO
             row._due_date = None
-            row._expected = tuple(
-                get_due_movements(
-                    self.d_or_c,
-                    partner=row,
-                    value_date__lte=end_date))
+            row._aging = [ZERO] * (len(buckets) + 1)
+            row._expected = tuple(expected.get(row.pk, []))
             for dm in row._expected:
                 row._balance += dm.balance
                 if dm.due_date is not None:
                     if row._due_date is None or row._due_date > dm.due_date:
                         row._due_date = dm.due_date
+                    age = (end_date - dm.due_date).days
+                else:
+                    age = 0
+                row._aging[get_aging_bucket(age, buckets)] += dm.balance
                 # logger.info("20140105 %s %s", row, dm)
 
             if row._balance > ZERO:
@@ -5,6 +5,15 @@
 
 """Utilities for this plugin.
 
+.. This is a tested document. You can test it using:
+
+    $ python setup.py test -s tests.LibTests.test_ledger_utils
+
+..
+  >>> from lino import startup
+  >>> startup('lino.projects.std.settings_test')
+  >>> from lino.api.doctest import *
+
 
 .. data:: on_ledger_movement
 
@@ -20,6 +29,8 @@
 from builtins import str
 from decimal import Decimal, ROUND_HALF_UP
 from django.dispatch import Signal, receiver
+from django.db import models, transaction
+from django.db.models import Sum, Min, Count, Case, When, Value, Q, F
 from lino.api import rt, dd
 
 from lino.utils import SumCollector
@@ -28,6 +39,25 @@ from lino_xl.lib.accounts.utils import Balance, ZERO, DEBIT
 
 CENT = Decimal('.01')
 
+CLEARING_CHUNK_SIZE = 100
+"""Maximum number of match groups per query in
+:func:`check_clearings_by_keys`.
+
+"""
+
+LEAF_CHUNK_SIZE = 500
+"""Maximum number of primary keys per query when fetching the MTI
+leaves of vouchers in :func:`get_leaf_vouchers`.
+
+"""
+
+PARTNER_CHUNK_SIZE = 500
+"""Maximum number of partners per query when collecting the due
+movements in :class:`DebtorsCreditors
+<lino_xl.lib.ledger.ui.DebtorsCreditors>`.
+
+"""
+
 on_ledger_movement = Signal(['instance'])
 
 
@@ -74,21 +104,41 @@ class DueMovement(object):
     def collect_all(self):
         flt = dict(
             partner=self.partner, account=self.account, match=self.match)
-        for mvt in rt.models.ledger.Movement.objects.filter(**flt):
-            self.collect(mvt)
+        qs = rt.models.ledger.Movement.objects.filter(**flt)
+        mvts = list(qs.select_related('voucher__journal'))
+        leaves = get_leaf_vouchers([mvt.voucher for mvt in mvts])
+        for mvt in mvts:
+            self.collect(mvt, leaves.get(mvt.voucher_id))
             
-    def collect(self, mvt):
+    def collect(self, mvt, voucher=None):
         """Add the given movement to the list of movements that are being
         cleared by this DueMovement.
 
+        `voucher` is the MTI leaf of the movement's voucher. If it is
+        not given, we look it up, which costs a database query.
+
         """
         # dd.logger.info("20160604 collect %s", mvt)
         if mvt.cleared:
             self.has_satisfied_movement = True
         else:
             self.has_unsatisfied_movement = True
+        if mvt.dc == self.dc:
+            self.balance += mvt.amount
+        else:
+            self.balance -= mvt.amount
+        self.add_movement(mvt, voucher)
+
+    def add_movement(self, mvt, voucher=None):
+        """Add the given movement to the :attr:`debts` or :attr:`payments`
+        of this DueMovement and update its due date, trade type and
+        bank account.  Unlike :meth:`collect` this doesn't update the
+        balance and the cleared flags, which :func:`get_due_movements`
+        computes in SQL.
 
-        voucher = mvt.voucher.get_mti_leaf()
+        """
+        if voucher is None:
+            voucher = mvt.voucher.get_mti_leaf()
         due_date = voucher.get_due_date()
         if self.due_date is None or due_date < self.due_date:
             self.due_date = due_date
@@ -97,7 +147,6 @@ class DueMovement(object):
             self.trade_type = voucher.get_trade_type()
         if mvt.dc == self.dc:
             self.debts.append(mvt)
-            self.balance += mvt.amount
             bank_account = voucher.get_bank_account()
             if bank_account is not None:
                 if self.bank_account != bank_account:
@@ -110,7 +159,6 @@ class DueMovement(object):
 
         else:
             self.payments.append(mvt)
-            self.balance -= mvt.amount
 
     def unused_check_clearings(self):
         """Check whether involved movements are cleared or not, and update
@@ -130,6 +178,45 @@ class DueMovement(object):
                 m.save()
 
 
+def get_leaf_vouchers(vouchers):
+    """Return a dict which maps the primary key of each of the given
+    :class:`Voucher <lino_xl.lib.ledger.models.Voucher>` objects to
+    its MTI leaf.
+
+    This does one query per voucher model (and per
+    :data:`LEAF_CHUNK_SIZE` vouchers) instead of one query per
+    voucher as :meth:`get_mti_leaf
+    <lino_xl.lib.ledger.models.Voucher.get_mti_leaf>` would do.  The
+    given vouchers should have their journal already loaded
+    (e.g. using ``select_related('voucher__journal')``).
+
+    """
+    leaves = dict()
+    pks_by_model = dict()
+    for v in vouchers:
+        if v.pk in leaves:
+            continue
+        m = v.journal.voucher_type.model
+        if v.__class__ is m:
+            leaves[v.pk] = v
+        else:
+            pks_by_model.setdefault(m, set()).add(v.pk)
+
+    for m, pks in pks_by_model.items():
+        related = ['journal']
+        for f in m._meta.get_fields():
+            if f.name in ('bank_account', 'payment_term') \
+               and f.many_to_one:
+                # needed by get_bank_account() and get_due_date()
+                related.append(f.name)
+        pks = sorted(pks)
+        for i in range(0, len(pks), LEAF_CHUNK_SIZE):
+            qs = m.objects.filter(pk__in=pks[i:i+LEAF_CHUNK_SIZE])
+            for obj in qs.select_related(*related):
+                leaves[obj.pk] = obj
+    return leaves
+
+
 def get_due_movements(dc, **flt):
     """Analyze the movements corresponding to the given filter condition
     `flt` and yield a series of :class:`DueMovement` objects which
@@ -148,6 +235,14 @@ def get_due_movements(dc, **flt):
     Generates and yields a list of the :class:`DueMovement` objects
     specified by the filter criteria.
 
+    The match groups, their balances and whether they contain cleared
+    or uncleared movements are computed by a grouped SQL query (see
+    :func:`get_due_sums`).  The movements are then read in a single
+    query (together with their voucher, journal, account, partner and
+    project) and the MTI leaves of their vouchers are fetched in bulk
+    using :func:`get_leaf_vouchers`.  So the number of queries does
+    not depend on the number of movements.
+
     Arguments:
 
     :dc: (boolean): The caller must specify whether he means the debts
@@ -161,32 +256,340 @@ def get_due_movements(dc, **flt):
     """
     if dc is None:
         return
+    groups = get_due_sums(dc, **flt)
+    if len(groups) == 0:
+        return []
     qs = rt.models.ledger.Movement.objects.filter(**flt)
     qs = qs.filter(account__clearable=True)
-    # qs = qs.exclude(match='')
-    qs = qs.order_by(*dd.plugins.ledger.remove_dummy(
-        'value_date', 'account__ref', 'partner', 'project', 'id'))
-    
-    
-    matches_by_account = dict()
+    qs = qs.order_by('value_date', 'id')
+    qs = qs.select_related(*dd.plugins.ledger.remove_dummy(
+        'voucher__journal', 'account', 'partner', 'project'))
+
+    mvts = list(qs)
+    leaves = get_leaf_vouchers([mvt.voucher for mvt in mvts])
+
+    mvts_by_group = dict()
+    for mvt in mvts:
+        k = (mvt.account_id, mvt.partner_id,
+             getattr(mvt, 'project_id', None), mvt.match)
+        mvts_by_group.setdefault(k, []).append(mvt)
+
     matches = []
-    for mvt in qs:
-        k = (mvt.account, mvt.partner, mvt.project, mvt.match)
-        # k = (mvt.account, mvt.partner, mvt.project, mvt.get_match())
-        dm = matches_by_account.get(k)
-        if dm is None:
-            dm = DueMovement(dc, mvt)
-            matches_by_account[k] = dm
-            matches.append(dm)
-        dm.collect(mvt)
-        # matches = matches_by_account.setdefault(k, set())
-        # m = mvt.match or mvt
-        # if m not in matches:
-        #     matches.add(m)
-        #     yield DueMovement(dc, mvt)
+    for grp in groups:
+        lst = mvts_by_group[(grp['account'], grp['partner'],
+                             grp['project'], grp['match'])]
+        dm = DueMovement(dc, lst[0])
+        dm.balance = grp['balance']
+        dm.has_satisfied_movement = grp['has_cleared']
+        dm.has_unsatisfied_movement = grp['has_uncleared']
+        for mvt in lst:
+            dm.add_movement(mvt, leaves.get(mvt.voucher_id))
+        matches.append(dm)
     return matches
 
 
+def get_due_sums(dc, **flt):
+    """Return the balances of the match groups corresponding to the
+    given filter condition `flt`, computed in a single grouped SQL
+    query.
+
+    Returns a list of dicts, one for every (account, partner, project,
+    match) group, with the ids of these four fields, the group's
+    `balance` (positive or negative depending on `dc`, like in
+    :func:`get_due_movements`), the `value_date` of its eldest
+    movement and whether it contains cleared (`has_cleared`) and
+    uncleared (`has_uncleared`) movements.  The groups are ordered
+    by the value date, account, partner and project of their eldest
+    movement, like those of :func:`get_due_movements`.
+
+    Use this instead of :func:`get_due_movements` when you don't need
+    the movements themselves.
+
+    """
+    if dc is None:
+        return []
+    keys = dd.plugins.ledger.remove_dummy(
+        'account', 'partner', 'project', 'match')
+    qs = rt.models.ledger.Movement.objects.filter(**flt)
+    qs = qs.filter(account__clearable=True)
+    qs = qs.order_by().values(*keys)
+    qs = qs.annotate(
+        debts=Sum(Case(
+            When(dc=dc, then='amount'), default=Value(ZERO),
+            output_field=dd.PriceField())),
+        payments=Sum(Case(
+            When(dc=dc, then=Value(ZERO)), default='amount',
+            output_field=dd.PriceField())),
+        eldest_date=Min('value_date'),
+        first_id=Min('id'),
+        cleared_count=Sum(Case(
+            When(cleared=True, then=Value(1)), default=Value(0),
+            output_field=models.IntegerField())),
+        movement_count=Count('id'))
+    qs = qs.order_by(*dd.plugins.ledger.remove_dummy(
+        'eldest_date', 'account__ref', 'partner', 'project', 'first_id'))
+    rows = []
+    for row in qs:
+        row.setdefault('project', None)
+        row['balance'] = (row.pop('debts') or ZERO) - (
+            row.pop('payments') or ZERO)
+        row['value_date'] = row.pop('eldest_date')
+        del row['first_id']
+        n = row.pop('cleared_count')
+        row['has_cleared'] = n > 0
+        row['has_uncleared'] = n < row.pop('movement_count')
+        rows.append(row)
+    return rows
+
+
+def get_clearing_key(mvt):
+    """Return the key of the match group to which the given movement
+    belongs, or `None` if the movement has no partner.
+
+    Like :func:`check_clearings_by_partner`, this includes the
+    movements on accounts which are not :attr:`clearable
+    <lino_xl.lib.accounts.models.Account.clearable>`: their
+    :attr:`cleared` field is maintained as well.
+
+    See :func:`check_clearings_by_keys`.
+
+    """
+    if mvt.partner_id is None:
+        return None
+    return (mvt.partner_id, mvt.account_id, mvt.match)
+
+
+def check_clearings_by_keys(keys):
+    """Update the :attr:`cleared` field of the movements in the given
+    match groups.
+
+    `keys` is an iterable of `(partner_id, account_id, match)` tuples
+    as returned by :func:`get_clearing_key`.  This gives the same
+    result as calling :func:`check_clearings_by_partner` for every
+    partner involved, but it reads only the movements of the given
+    match groups, computes their balances in SQL and updates them
+    using at most two `UPDATE` statements per
+    :data:`CLEARING_CHUNK_SIZE` groups.
+
+    """
+    Movement = rt.models.ledger.Movement
+    keys = sorted(set(keys))
+    if not keys:
+        return
+    for i in range(0, len(keys), CLEARING_CHUNK_SIZE):
+        chunk = keys[i:i+CLEARING_CHUNK_SIZE]
+        q = Q()
+        for partner_id, account_id, match in chunk:
+            q |= Q(partner_id=partner_id, account_id=account_id,
+                   match=match)
+        qs = Movement.objects.filter(q).order_by()
+        qs = qs.values('partner', 'account', 'match').annotate(
+            balance=Sum(Case(
+                When(dc=DEBIT, then=F('amount')),
+                default=-F('amount'), output_field=dd.PriceField())))
+        cleared = Q()
+        uncleared = Q()
+        for row in qs:
+            flt = Q(partner_id=row['partner'], account_id=row['account'],
+                    match=row['match'])
+            if row['balance'] == ZERO:
+                cleared |= flt
+            else:
+                uncleared |= flt
+        if len(cleared):
+            Movement.objects.filter(cleared).exclude(
+                cleared=True).update(cleared=True)
+        if len(uncleared):
+            Movement.objects.filter(uncleared).exclude(
+                cleared=False).update(cleared=False)
+
+    Partner = rt.models.contacts.Partner
+    for p in Partner.objects.filter(pk__in=set([k[0] for k in keys])):
+        on_ledger_movement.send(sender=p.__class__, instance=p)
+
+
+def sum_movements(qs, *keys):
+    """Group the movements of the given queryset by the given `keys`
+    and yield a dict for each group, containing the values of the keys
+    and the `debit` and `credit` sums of the group.
+
+    """
+    qs = qs.order_by().values(*keys).annotate(
+        debit=Sum(Case(
+            When(dc=DEBIT, then=F('amount')), default=Value(ZERO),
+            output_field=dd.PriceField())),
+        credit=Sum(Case(
+            When(dc=DEBIT, then=Value(ZERO)), default=F('amount'),
+            output_field=dd.PriceField())))
+    for row in qs:
+        row['debit'] = row['debit'] or ZERO
+        row['credit'] = row['credit'] or ZERO
+        yield row
+
+
+def add_balance_delta(deltas, key, dc, amount):
+    """Add the given `amount` to the debit or credit (depending on `dc`)
+    of the given `key` in the dict `deltas`.  See
+    :func:`update_period_balances`.
+
+    """
+    debit, credit = deltas.get(key, (ZERO, ZERO))
+    if dc == DEBIT:
+        debit += amount
+    else:
+        credit += amount
+    deltas[key] = (debit, credit)
+
+
+def add_balance_deltas(deltas, qs, sign=1):
+    """Add the debit and credit sums of the movements of the given
+    queryset, multiplied by `sign`, to the dict `deltas`.  See
+    :func:`update_period_balances`.
+
+    """
+    for row in sum_movements(
+            qs, 'account', 'partner', 'voucher__accounting_period'):
+        k = (row['account'], row['partner'],
+             row['voucher__accounting_period'])
+        debit, credit = deltas.get(k, (ZERO, ZERO))
+        deltas[k] = (debit + sign * row['debit'],
+                     credit + sign * row['credit'])
+
+
+def update_period_balances(deltas):
+    """Add the given amounts to the :class:`PeriodBalance
+    <lino_xl.lib.ledger.models.PeriodBalance>` rows.  Called when a
+    voucher gets registered or deregistered.
+
+    `deltas` is a dict which maps `(account_id, partner_id,
+    accounting_period_id)` tuples to `(debit, credit)` tuples.  The
+    amounts are negative for movements which have been removed.
+
+    Every existing row is updated by a single `UPDATE` statement, so
+    the cost doesn't depend on the number of movements in the period.
+    A missing row is created while the accounting period is locked, so
+    that two concurrent registrations cannot create the same row
+    twice.  (The unique constraint doesn't catch this when the
+    partner is `None`.)  This should be called within a transaction.
+
+    """
+    PeriodBalance = rt.models.ledger.PeriodBalance
+    AccountingPeriod = rt.models.ledger.AccountingPeriod
+
+    def sortkey(k):
+        return (k[0], k[1] or 0, k[2])
+
+    for k in sorted(deltas.keys(), key=sortkey):
+        debit, credit = deltas[k]
+        if debit == ZERO and credit == ZERO:
+            continue
+        account_id, partner_id, period_id = k
+        qs = PeriodBalance.objects.filter(
+            account_id=account_id, partner_id=partner_id,
+            accounting_period_id=period_id)
+        values = dict(debit=F('debit') + debit, credit=F('credit') + credit)
+        if qs.update(**values):
+            continue
+        AccountingPeriod.objects.select_for_update().get(pk=period_id)
+        if qs.update(**values):
+            continue
+        PeriodBalance.objects.create(
+            account_id=account_id, partner_id=partner_id,
+            accounting_period_id=period_id, debit=debit, credit=credit)
+
+
+def rebuild_period_balances(check=False, batch_size=1000, period=None):
+    """Compare the :class:`PeriodBalance
+    <lino_xl.lib.ledger.models.PeriodBalance>` table with the sums of
+    the movements and return a list of `(key, stored, computed)` tuples
+    for every difference found, where `key` is a tuple `(account_id,
+    partner_id, accounting_period_id)` and `stored` and `computed`
+    are tuples `(debit, credit)`.
+
+    Unless `check` is `True`, also rebuild the table from scratch.
+
+    If `period` is given, do this only for the balances of that
+    accounting period.
+
+    """
+    Movement = rt.models.ledger.Movement
+    PeriodBalance = rt.models.ledger.PeriodBalance
+    mqs = Movement.objects.all()
+    bqs = PeriodBalance.objects.all()
+    if period is not None:
+        mqs = mqs.filter(voucher__accounting_period=period)
+        bqs = bqs.filter(accounting_period=period)
+    computed = dict()
+    for row in sum_movements(
+            mqs, 'account', 'partner', 'voucher__accounting_period'):
+        k = (row['account'], row['partner'],
+             row['voucher__accounting_period'])
+        computed[k] = (row['debit'], row['credit'])
+    stored = dict()
+    for b in bqs:
+        k = (b.account_id, b.partner_id, b.accounting_period_id)
+        stored[k] = (b.debit, b.credit)
+    diffs = []
+    nothing = (ZERO, ZERO)
+    for k in set(computed.keys()) | set(stored.keys()):
+        old = stored.get(k, nothing)
+        new = computed.get(k, nothing)
+        if old != new:
+            diffs.append((k, old, new))
+    if not check:
+        with transaction.atomic():
+            bqs.delete()
+            PeriodBalance.objects.bulk_create([
+                PeriodBalance(
+                    account_id=k[0], partner_id=k[1],
+                    accounting_period_id=k[2], debit=v[0], credit=v[1])
+                for k, v in computed.items()], batch_size=batch_size)
+    return diffs
+
+
+def get_aging_bucket(age, buckets):
+    """Return the index of the aging bucket for a debt of the given
+    `age` (in days).  `buckets` is a sequence of upper limits as in
+    :attr:`aging_buckets <lino_xl.lib.ledger.Plugin.aging_buckets>`.
+
+    >>> get_aging_bucket(0, (30, 60, 90))
+    0
+    >>> get_aging_bucket(30, (30, 60, 90))
+    0
+    >>> get_aging_bucket(31, (30, 60, 90))
+    1
+    >>> get_aging_bucket(91, (30, 60, 90))
+    3
+
+    Debts which are not yet due count as 0 days old:
+
+    >>> get_aging_bucket(-5, (30, 60, 90))
+    0
+
+    """
+    for i, limit in enumerate(buckets):
+        if age <= limit:
+            return i
+    return len(buckets)
+
+
+def get_aging_bucket_labels(buckets):
+    """Return a list of labels for the given aging buckets.
+
+    >>> get_aging_bucket_labels((30, 60, 90))
+    ['0-30', '31-60', '61-90', '>90']
+
+    """
+    labels = []
+    start = 0
+    for limit in buckets:
+        labels.append("{0}-{1}".format(start, limit))
+        start = limit + 1
+    if len(buckets):
+        labels.append(">{0}".format(buckets[-1]))
+    return labels
+
+
 def check_clearings_by_account(account, matches=[]):
     # not used. See blog/2017/0802.rst
     qs = rt.models.ledger.Movement.objects.filter(
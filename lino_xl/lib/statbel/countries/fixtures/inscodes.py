@@ -28,6 +28,7 @@ data used here comes from uncertain sources.  One such source
 from lino.api import dd
 from lino.core.utils import resolve_model
 from lino.utils import dblogger as logger
+from lino_xl.lib.countries.utils import PlaceLoader
 
 ISO2INS = {
     'AL': '101',  # Albanie / Albanië / Albanien'
@@ -3342,7 +3343,6 @@ CITIES = u"""
 
 def objects():
     Country = resolve_model('countries.Country')
-    Place = resolve_model('countries.Place')
 
     BE = Country.objects.get(pk='BE')
 
@@ -3367,6 +3367,7 @@ def objects():
 
     # ~ return # 20120531
     logger.info("Loading city INS codes")
+    loader = PlaceLoader()
     for ln in CITIES.splitlines():
         if not ln.strip():
             continue
@@ -3374,20 +3375,8 @@ def objects():
         zip_code, name, inscode, x, y, z = a
         if not zip_code:
             continue
-        try:
-            city = Place.objects.get(country=BE, zip_code=zip_code, name=name)
-            city.inscode = inscode
-            logger.debug("inscode %s --> city %s", inscode, city)
-            yield city
-        except Place.MultipleObjectsReturned:
-            logger.debug(
-                "Failed to set inscode %s because "
-                "there are multiple cities %s %s",
-                inscode, zip_code, name)
-        except Place.DoesNotExist:
-            logger.debug(
-                "Failed to set inscode %s because there's no city %s %s",
-                inscode, zip_code, name)
+        loader.update(BE, zip_code, name, inscode=inscode)
+    loader.flush()
 
         #~ for city in Place.objects.filter(country=BE,zip_code=zip_code):
             #~ if city.inscode and city.inscode != inscode:
@@ -58,6 +58,14 @@ class Plugin(ad.Plugin):
 
     """
 
+    use_mmap = False
+    """
+    Whether to use :mod:`lino_xl.lib.tim2lino.mmapdbf` to read the
+    file.  This reader memory-maps the file and decodes only the
+    columns declared by the ``load_xxx`` method.  It takes precedence
+    over :attr:`use_dbf_py` and :attr:`use_dbfread`.
+    """
+
     dbf_table_ext = '.DBF'
     # dbf_table_ext = '.FOX'
     """The file extension of TIM tables. Meaningful values are `'.DBF'` or
@@ -66,7 +74,23 @@ class Plugin(ad.Plugin):
     """
 
     timloader_module = 'lino_xl.lib.tim2lino.timloader1'
+
+    worker_processes = 0
+    """
+    The number of worker processes to use when loading the TIM
+    tables in bulk mode.  Values below 2 mean to load all tables in the
+    current process.  See
+    :meth:`lino_xl.lib.tim2lino.utils.TimLoader.run_bulk`.
+    """
     
+    sync_state_file = None
+    """
+    The name of the file where to store the state of the TIM tables
+    for the incremental mode.  Default is :file:`tim2lino_sync.json`
+    in the :attr:`cache_dir <lino.core.site.Site.cache_dir>`.  See
+    :meth:`lino_xl.lib.tim2lino.utils.TimLoader.run_sync`.
+    """
+
     load_listeners = []
 
     # siteconfig_accounts = dict(
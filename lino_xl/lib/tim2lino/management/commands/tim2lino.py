@@ -0,0 +1,76 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2018 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""Defines the :manage:`tim2lino` admin command:
+
+.. management_command:: tim2lino
+
+.. py2rst::
+
+  from lino_xl.lib.tim2lino.management.commands.tim2lino \
+      import Command
+  print(Command.help)
+
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+from importlib import import_module
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lino.api import dd
+
+
+def puts(msg):
+    dd.logger.info(msg)
+
+
+class Command(BaseCommand):
+    help = """
+
+    Import the data from TIM into the existing database.
+
+    The loader is specified by :attr:`timloader_module
+    <lino_xl.lib.tim2lino.Plugin.timloader_module>`.  Without options,
+    load all tables object by object, like the :fixture:`tim2lino`
+    fixture.  Use --bulk to write the tables in batches (optionally
+    in parallel worker processes), or --sync to load only the records
+    which have changed since the previous --sync run.
+
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--bulk', action='store_true',
+                            dest='bulk', default=False,
+                            help="Load the tables in bulk mode."),
+        parser.add_argument('-s', '--sync', action='store_true',
+                            dest='sync', default=False,
+                            help="Load only the records which have "
+                            "changed since the previous run."),
+        parser.add_argument('-w', '--workers', type=int,
+                            dest='workers', default=None,
+                            help="Number of worker processes "
+                            "in bulk mode."),
+        parser.add_argument('--statefile', dest='statefile',
+                            default=None,
+                            help="Name of the file where to store the "
+                            "state of the TIM tables in sync mode."),
+
+    def handle(self, *args, **options):
+        if options['bulk'] and options['sync']:
+            raise CommandError("Cannot use --bulk and --sync together.")
+        mod = import_module(dd.plugins.tim2lino.timloader_module)
+        cls = mod.TimLoader
+        if options['bulk']:
+            rv = cls.run_bulk(workers=options['workers'])
+            puts("{0} objects have been written.".format(
+                sum([count for t, count, seconds in rv])))
+        elif options['sync']:
+            count = cls.run_sync(statefile=options['statefile'])
+            puts("{0} keys have been loaded again or deleted.".format(
+                count))
+        else:
+            cls.run()
@@ -0,0 +1,370 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2018 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""A memory-mapped DBF reader which decodes only the columns that are
+actually needed.
+
+Used by :meth:`TimLoader.load_dbf
+<lino_xl.lib.tim2lino.utils.TimLoader.load_dbf>` when
+:attr:`use_mmap <lino_xl.lib.tim2lino.Plugin.use_mmap>` is `True`.
+
+The ``load_xxx`` methods of a loader declare the columns they need
+using the :func:`dbf_columns` decorator::
+
+    @dbf_columns('IDART', 'NAME1', 'NAME2')
+    def load_art(self, row, **kw):
+        ...
+
+Deleted records are skipped by looking at their first byte, without
+reading them.  Methods which don't declare their columns get all
+columns.  Records with a value which cannot be decoded (e.g. a
+malformed date) are logged and skipped.
+
+.. This is a tested document. You can test it using:
+
+    $ python setup.py test -s tests.LibTests.test_tim2lino_mmapdbf
+
+Examples:
+
+The following examples use a small DBF file with four records, one of
+them being deleted and another having a malformed date:
+
+>>> import tempfile
+>>> def field(name, tp, length, dec=0):
+...     return struct.pack(str('<11sc4xBB14x'), name.encode('ascii'),
+...                        tp.encode('ascii'), length, dec)
+>>> def record(flag, idpar, name, date, amount):
+...     return (flag + idpar.encode('ascii') +
+...             name.encode('cp850').ljust(10) +
+...             date.encode('ascii').ljust(8) +
+...             amount.encode('ascii').rjust(8))
+>>> fields = [field('IDPAR', 'C', 6), field('NAME', 'C', 10),
+...           field('DATE', 'D', 8), field('AMOUNT', 'N', 8, 2)]
+>>> records = [
+...     record(b' ', '000001', 'Ärgerlich', '20180131', '12.50'),
+...     record(b'*', '000002', 'Deleted', '20180201', '1.00'),
+...     record(b' ', '000003', 'Malformed', '20181301', '3.00'),
+...     record(b' ', '000004', 'Empty', '', '')]
+>>> header = struct.pack(str('<B3xIHH20x'), 3, len(records), 161, 33)
+>>> dirname = tempfile.mkdtemp()
+>>> filename = os.path.join(dirname, 'PAR.DBF')
+>>> with open(filename, 'wb') as f:
+...     n = f.write(header + b''.join(fields) + b'\\r' +
+...                 b''.join(records) + b'\\x1a')
+
+>>> t = DBFTable(filename)
+>>> len(t)
+4
+>>> print(' '.join([f[0] for f in t.fields]))
+IDPAR NAME DATE AMOUNT
+>>> for rec in t:
+...     print("{} {} {} {}".format(rec.idpar, rec.name, rec.date, rec.amount))
+000001 Ärgerlich 2018-01-31 12.50
+000004 Empty None None
+>>> print(rec['NAME'])
+Empty
+>>> 'amount' in rec, 'foo' in rec
+(True, False)
+>>> t.close()
+
+When only some columns are decoded, the malformed date doesn't
+matter.  Unknown column names are ignored:
+
+>>> t = DBFTable(filename, columns=['idpar', 'amount', 'foo'])
+>>> for rec in t:
+...     print("{} {}".format(rec.idpar, rec.amount))
+000001 12.50
+000003 3.00
+000004 None
+>>> 'NAME' in rec
+False
+>>> t.close()
+
+:func:`read_dbf_hashes` is used to find the records which have been
+modified since the previous synchronization:
+
+>>> checksum = dbf_checksum(filename)
+>>> hashes = read_dbf_hashes(filename, ['IDPAR'], 'cp850')
+>>> print(' '.join(sorted(hashes.keys())))
+000001 000003 000004
+>>> with open(filename, 'r+b') as f:
+...     n = f.seek(161 + 3 * 33 + 25)
+...     n = f.write(b'    9.00')
+>>> dbf_checksum(filename) == checksum
+False
+>>> new = read_dbf_hashes(filename, ['IDPAR'], 'cp850')
+>>> print(' '.join([k for k in sorted(new) if new[k] != hashes[k]]))
+000004
+
+>>> import shutil
+>>> shutil.rmtree(dirname)
+
+"""
+
+from __future__ import unicode_literals
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import mmap
+import hashlib
+import struct
+import datetime
+from decimal import Decimal
+
+
+def dbf_columns(*names):
+    """Decorator which declares the names of the DBF fields used by a
+    ``load_xxx`` method.  Names of fields which don't exist in a table
+    are ignored, so a method may declare optional fields.
+
+    """
+    def decorator(func):
+        func.dbf_columns = names
+        return func
+    return decorator
+
+
+def read_dbf_header(f):
+    """Read the header of the DBF file `f` and return a tuple
+    `(count, header_length, record_length, fields)` where `fields` is
+    an ordered list of tuples `(name, type, offset, length, decimals)`.
+    The offset is relative to the start of a record (whose first byte
+    is the deletion flag).
+
+    """
+    count, hlen, rlen = struct.unpack('<4xIHH', f.read(12))
+    f.read(20)
+    fields = []
+    offset = 1
+    while True:
+        d = f.read(32)
+        if len(d) < 32 or d[:1] == b'\r':
+            break
+        name = d[:11].split(b'\0')[0].decode('ascii').upper()
+        tp = d[11:12].decode('ascii')
+        length, dec = struct.unpack('<BB', d[16:18])
+        if tp == 'C':
+            # Clipper & FoxPro store the length of long character
+            # fields in both bytes
+            length += dec * 256
+            dec = 0
+        fields.append((name, tp, offset, length, dec))
+        offset += length
+    return count, hlen, rlen, fields
+
+
+class DBFRecord(object):
+    """Base class for the records yielded by :class:`DBFTable`.  The
+    values are stored in slots named after the lowercase field names,
+    so they are accessible as attributes.  Item access and the `in`
+    operator are supported for compatibility with the other
+    backends.
+
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name.lower())
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return name.lower() in self._fields
+
+    def get(self, name, default=None):
+        return getattr(self, name.lower(), default)
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, ', '.join([
+            "{}={!r}".format(k, getattr(self, k)) for k in self._fields]))
+
+
+class DBFTable(object):
+    """A DBF file opened for reading.
+
+    `columns` is an iterable with the names of the fields to decode,
+    or `None` to decode all fields.  Iterating over the table yields a
+    :class:`DBFRecord` for every record which is not deleted.
+
+    """
+
+    def __init__(self, filename, codepage='cp850', columns=None):
+        self.filename = filename
+        self.codepage = codepage
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (self.count, self.header_length, self.record_length,
+         self.fields) = read_dbf_header(self.map)
+        if columns is not None:
+            columns = set([c.upper() for c in columns])
+            self.fields = [f for f in self.fields if f[0] in columns]
+        names = tuple([str(f[0].lower()) for f in self.fields])
+        self.record_class = type(
+            str('DBFRecord'), (DBFRecord, ),
+            dict(__slots__=names, _fields=names))
+        self.decoders = [
+            (f[0].lower(), f[2], f[2] + f[3], self.get_decoder(f[1], f[4]))
+            for f in self.fields]
+        self.memo = None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        mm = self.map
+        rlen = self.record_length
+        cls = self.record_class
+        decoders = self.decoders
+        pos = self.header_length
+        end = min(pos + self.count * rlen, len(mm))
+        while pos + rlen <= end:
+            if mm[pos:pos+1] != b'*':
+                rec = cls()
+                try:
+                    for name, start, stop, decode in decoders:
+                        setattr(rec, name, decode(mm[pos+start:pos+stop]))
+                except Exception as e:
+                    logger.warning(
+                        "Skipped record at offset %d of %s (%s : %s)",
+                        pos, self.filename, name, e)
+                else:
+                    yield rec
+            pos += rlen
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+        if self.memo is not None:
+            self.memo.close()
+
+    def get_decoder(self, tp, dec):
+        codepage = self.codepage
+        if tp == 'C':
+            return lambda v: v.decode(codepage).rstrip()
+        if tp in 'NF':
+            def decode_number(v):
+                v = v.strip()
+                if not v or v.startswith(b'*'):
+                    return None
+                if dec or b'.' in v:
+                    return Decimal(v.decode('ascii'))
+                return int(v)
+            return decode_number
+        if tp == 'D':
+            def decode_date(v):
+                v = v.strip()
+                if not v:
+                    return None
+                return datetime.date(int(v[:4]), int(v[4:6]), int(v[6:8]))
+            return decode_date
+        if tp == 'L':
+            def decode_bool(v):
+                if v in b'TtYy':
+                    return True
+                if v in b'FfNn':
+                    return False
+                return None
+            return decode_bool
+        if tp == 'I':
+            return lambda v: struct.unpack('<i', v)[0]
+        if tp == 'M':
+            return self.decode_memo
+        return bytes
+
+    def decode_memo(self, v):
+        if len(v) == 4:
+            block = struct.unpack('<I', v)[0]
+        else:
+            v = v.strip()
+            if not v:
+                return None
+            block = int(v)
+        if block == 0:
+            return None
+        if self.memo is None:
+            self.memo = MemoFile(self.filename, self.codepage)
+        return self.memo.read(block)
+
+
+class MemoFile(object):
+    """The memo file (:file:`.DBT` or :file:`.FPT`) of a DBF file."""
+
+    def __init__(self, filename, codepage):
+        base = os.path.splitext(filename)[0]
+        self.foxpro = False
+        for ext in ('.FPT', '.fpt', '.DBT', '.dbt'):
+            if os.path.exists(base + ext):
+                self.foxpro = ext.lower() == '.fpt'
+                filename = base + ext
+                break
+        else:
+            raise Exception("No memo file for {}".format(filename))
+        self.codepage = codepage
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.foxpro:
+            self.block_size = struct.unpack('>H', self.map[6:8])[0]
+        else:
+            self.block_size = 512
+
+    def read(self, block):
+        pos = block * self.block_size
+        if self.foxpro:
+            length = struct.unpack('>I', self.map[pos+4:pos+8])[0]
+            data = self.map[pos+8:pos+8+length]
+        else:
+            end = self.map.find(b'\x1a', pos)
+            if end == -1:
+                end = len(self.map)
+            data = self.map[pos:end]
+        return data.decode(self.codepage)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def dbf_checksum(filename):
+    """Return the MD5 checksum of the given file."""
+    m = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def read_dbf_hashes(filename, keyfields, codepage):
+    """Return a dict which maps the key of every record of the given DBF
+    file to a hash of its raw content.  The key is made of the values
+    of the fields `keyfields`, separated by "|".  When several records
+    have the same key, the hash is computed over all of them.  Deleted
+    records are ignored.
+
+    Memo fields are represented by a pointer to the memo file, so a
+    memo which has been modified in place is not detected.
+
+    """
+    rv = dict()
+    with open(filename, 'rb') as f:
+        count, hlen, rlen, fields = read_dbf_header(f)
+        fields = dict([(fld[0], (fld[2], fld[3])) for fld in fields])
+        slices = [fields[k.upper()] for k in keyfields]
+        f.seek(hlen)
+        for i in range(count):
+            rec = f.read(rlen)
+            if len(rec) < rlen:
+                break
+            if rec[:1] == b'*':
+                continue
+            key = '|'.join([rec[o:o+l].decode(codepage).strip()
+                            for o, l in slices])
+            m = rv.get(key)
+            if m is None:
+                m = rv[key] = hashlib.md5()
+            m.update(rec)
+    return dict([(k, m.hexdigest()) for k, m in rv.items()])
@@ -49,6 +49,7 @@ from lino.core.utils import is_valid_email
 
 from lino_xl.lib.ledger.utils import myround
 from lino_xl.lib.tim2lino.utils import TimLoader
+from lino_xl.lib.tim2lino.mmapdbf import dbf_columns
 
 from lino.api import dd, rt
 
@@ -243,6 +244,85 @@ class TimLoader(TimLoader):
     
     """
 
+    bulk_tables = [
+        [[('GEN', 'load_gen2group'), ('GEN', 'load_gen2account')],
+         [('ART', None)],
+         [('PLZ', None)]],
+        [[('JNL', None)],
+         [('PAR', None)]],
+        [[('VEN', None), ('VNL', None)],
+         [('FIN', None), ('FNL', None)]],
+    ]
+    """PAR is loaded after GEN because partners may refer to a purchase
+    account, and after PLZ because it creates the missing places.
+    JNL needs the accounts.  The vouchers need the journals and the
+    partners.  Their lines must be loaded by the same job because
+    they are looked up in :attr:`VENDICT` and :attr:`FINDICT`.  The
+    vouchers themselves use multi-table inheritance and are saved one
+    by one, but their lines are written using `bulk_create`.
+
+    """
+
+    sync_keys = dict(
+        GEN=('IDGEN',), ART=('IDART',), JNL=('IDJNL',),
+        PLZ=('PAYS', 'CP'), PAR=('IDPAR',),
+        VEN=('IDJNL', 'IDDOC'), VNL=('IDJNL', 'IDDOC'),
+        FIN=('IDJNL', 'IDDOC'), FNL=('IDJNL', 'IDDOC'))
+
+    sync_tables = [
+        [('GEN', 'load_gen2group'), ('GEN', 'load_gen2account')],
+        [('ART', None)],
+        [('JNL', None)],
+        [('PLZ', None)],
+        [('PAR', None)],
+        [('VEN', None), ('VNL', None)],
+        [('FIN', None), ('FNL', None)],
+    ]
+
+    sync_replace = set(['VEN', 'FIN'])
+
+    def sync_group(self, group, state):
+        if 'GEN' in [t for t, m in group]:
+            # load_gen2account needs all groups, not only those which
+            # have changed
+            for g in accounts.Group.objects.all():
+                self.GROUPS.setdefault(g.ref, g)
+        return super(TimLoader, self).sync_group(group, state)
+
+    def sync_lookup(self, obj):
+        if isinstance(obj, Place):
+            return Place.objects.filter(
+                country=obj.country, zip_code=obj.zip_code).first()
+        if dd.is_installed('sepa') and isinstance(obj, sepa.Account):
+            return sepa.Account.objects.filter(
+                partner=obj.partner, iban=obj.iban).first()
+        return super(TimLoader, self).sync_lookup(obj)
+
+    def sync_find_gen(self, idgen):
+        if len(idgen) == self.LEN_IDGEN:
+            return accounts.Account.objects.filter(ref=idgen)
+        return accounts.Group.objects.filter(ref=idgen)
+
+    def sync_find_art(self, idart):
+        return products.Product.objects.filter(ref=idart)
+
+    def sync_find_jnl(self, idjnl):
+        return Journal.objects.filter(ref=idjnl)
+
+    def sync_find_plz(self, pays, cp):
+        return Place.objects.filter(
+            country__isocode=self.short2iso(pays), zip_code=cp)
+
+    def sync_find_par(self, idpar):
+        return contacts.Partner.objects.filter(pk=self.par_pk(idpar))
+
+    def sync_find_ven(self, idjnl, iddoc):
+        year, num = year_num(iddoc)
+        return ledger.Voucher.objects.filter(
+            journal__ref=idjnl, accounting_period__year=year, number=num)
+
+    sync_find_fin = sync_find_ven
+
     def get_customer(self, pk):
         pk = pk.strip()
         if not pk:
@@ -317,6 +397,7 @@ class TimLoader(TimLoader):
         # if s == 'NL': return 'NL'
         # raise Exception("Unknown short country code %r" % s)
 
+    @dbf_columns('IDGEN', 'LIBELL1', 'LIBELL2', 'LIBELL3', 'LIBELL4')
     def load_gen2group(self, row, **kw):
         idgen = row.idgen.strip()
         if not idgen:
@@ -338,6 +419,7 @@ class TimLoader(TimLoader):
             self.GROUPS[idgen] = ag
             yield ag
 
+    @dbf_columns('IDGEN', 'LIBELL1', 'LIBELL2', 'LIBELL3', 'LIBELL4')
     def load_gen2account(self, row, **kw):
         idgen = row.idgen.strip()
         if not idgen:
@@ -376,6 +458,7 @@ class TimLoader(TimLoader):
         except accounts.Account.DoesNotExist:
             return None
         
+    @dbf_columns('IDJNL', 'IDDOC', 'DATE', 'MONT1', 'MONT2', 'ETAT')
     def load_fin(self, row, **kw):
         jnl, year, number = row2jnl(row)
         if jnl is None:
@@ -398,6 +481,8 @@ class TimLoader(TimLoader):
             self.must_register.append(doc)
         return doc
 
+    @dbf_columns('IDJNL', 'IDDOC', 'LINE', 'DATE', 'IDCTR', 'IDCPT', 'MONT',
+                 'DC', 'MATCH')
     def load_fnl(self, row, **kw):
         jnl, year, number = row2jnl(row)
         if jnl is None:
@@ -454,6 +539,8 @@ class TimLoader(TimLoader):
             dblogger.warning(
                 "Failed to load FNL line %s from %s : %s", row, kw, e)
 
+    @dbf_columns('IDJNL', 'IDDOC', 'IDREG', 'IDPAR', 'IDPRJ', 'REMISE',
+                 'DATE', 'AUTEUR', 'MONTR', 'MONTT', 'MATCH', 'ETAT')
     def load_ven(self, row, **kw):
         jnl, year, number = row2jnl(row)
         if jnl is None:
@@ -502,6 +589,8 @@ class TimLoader(TimLoader):
         #     # self.must_match.append((doc, doc, match))
         return doc
 
+    @dbf_columns('IDJNL', 'IDDOC', 'LINE', 'IDART', 'CODE', 'PRIXU', 'QTE',
+                 'DESIG', 'IDTAX', 'CMONT', 'MONTT')
     def load_vnl(self, row, **kw):
         jnl, year, number = row2jnl(row)
         if jnl is None:
@@ -587,6 +676,7 @@ class TimLoader(TimLoader):
             country.short_code = row['idnat'].strip()
         return country
 
+    @dbf_columns('PAYS', 'NOM', 'CP')
     def load_plz(self, row):
         pk = row.pays.strip()
         if not pk:
@@ -620,6 +710,10 @@ class TimLoader(TimLoader):
         )
         return Place(**kw)
 
+    @dbf_columns('IDPAR', 'IDPRT', 'EMAIL', 'IDREG', 'IDGEN', 'ALLO', 'FIRME',
+                 'VORNAME', 'NOTVA', 'NAME2', 'SEX', 'DATCREA', 'LANGUE',
+                 'MEMO', 'PAYS', 'CP', 'TEL', 'FAX', 'RUE', 'RUENUM',
+                 'RUEBTE', 'COMPTE1')
     def load_par(self, row):
         kw = {}
         # kw.update(
@@ -827,6 +921,7 @@ class TimLoader(TimLoader):
         #     kw.update(partner_id=self.par_pk(row.idpar))
         #     yield tickets.Sponsorship(**kw)
 
+    @dbf_columns('IDART', 'NAME1', 'NAME2', 'NAME3', 'NAME4')
     def load_art(self, row, **kw):
         # try:
         #     pk = int(row.idart)
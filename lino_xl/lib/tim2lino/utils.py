@@ -8,12 +8,21 @@ Import legacy data from TIM (basic version).
 
 import traceback
 import os
+import json
+import time
+import multiprocessing
+import six
+from importlib import import_module
 from clint.textui import puts, progress
 from django.conf import settings
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.core.management.color import no_style
+from django.db import models, transaction, connection, connections
 from atelier.utils import AttrDict
 from lino.api import dd, rt
 from lino.utils import dbfreader
+from .mmapdbf import DBFTable, dbf_columns
+from .mmapdbf import dbf_checksum, read_dbf_hashes
 
 
 class TimLoader(object):
@@ -23,6 +32,52 @@ class TimLoader(object):
 
     archived_tables = set()
     archive_name = None
+    sync_keys = dict()
+    """A dict which maps the name of a table to the names of the fields
+    that identify a record (e.g. ``('IDJNL', 'IDDOC')``).  Used in
+    incremental mode (:meth:`run_sync`).  Several records may share
+    a same key (e.g. all lines of a voucher).
+
+    """
+
+    sync_tables = []
+    """The tables to load in incremental mode (:meth:`run_sync`).
+
+    This is a list of groups which are processed one after the other.
+    Every group is a list of tuples `(tableName, methodName)` like in
+    :attr:`bulk_tables`.  The first table of a group is its master.
+    When a key has changed in any table of a group, the records with
+    that key are loaded again from all tables of the group.
+
+    """
+
+    sync_replace = set()
+    """The names of the master tables whose objects must be deleted
+    before their records are loaded again (e.g. vouchers, whose lines
+    cannot be updated one by one).
+
+    """
+
+    bulk_size = 1000
+    """Number of database objects to write in one batch when running
+    in bulk mode (:meth:`run_bulk`)."""
+
+    bulk_tables = []
+    """The tables to load in bulk mode (:meth:`run_bulk`).
+
+    This is a list of stages which are processed one after the other.
+    Every stage is a list of jobs which may run in parallel.  Every
+    job is a list of tuples `(tableName, methodName)` to be loaded one
+    after the other by a same loader.  `methodName` may be `None` to
+    use the default method.  The jobs of a same stage must not write
+    to the same model in bulk (objects which are saved one by one,
+    like those of models with multi-table inheritance, are numbered
+    by the database and may be shared).
+
+    Use the :manage:`tim2lino` command with ``--bulk`` to run this.
+
+    """
+
     codepage = 'cp850'
     # codepage = 'cp437'
     # etat_registered = "C"¹
@@ -38,6 +93,7 @@ class TimLoader(object):
         self.must_register = []
         self.must_match = {}
         self.duplicate_zip_codes = dict()
+        self.next_ids = dict()
 
     def finalize(self):
         if len(self.duplicate_zip_codes):
@@ -52,18 +108,7 @@ class TimLoader(object):
         ses = rt.login(self.ROOT.username)
 
         Journal = rt.models.ledger.Journal
-        dd.logger.info("Register %d vouchers", len(self.must_register))
-        failures = 0
-        for doc in progress.bar(self.must_register):
-            # puts("Registering {0}".format(doc))
-            try:
-                doc.register(ses)
-            except Exception as e:
-                dd.logger.warning("Failed to register %s : %s ", doc, e)
-                failures += 1
-                if failures > 100:
-                    dd.logger.warning("Abandoned after 100 failures.")
-                    break
+        self.register_vouchers()
 
         # Given a string `ms` of type 'VKR940095', locate the corresponding
         # movement.
@@ -100,6 +145,26 @@ class TimLoader(object):
                 
         
 
+    def register_vouchers(self):
+        """Register the vouchers in :attr:`must_register` and empty that
+        list."""
+        if self.ROOT is None:
+            return
+        ses = rt.login(self.ROOT.username)
+        dd.logger.info("Register %d vouchers", len(self.must_register))
+        failures = 0
+        for doc in progress.bar(self.must_register):
+            # puts("Registering {0}".format(doc))
+            try:
+                doc.register(ses)
+            except Exception as e:
+                dd.logger.warning("Failed to register %s : %s ", doc, e)
+                failures += 1
+                if failures > 100:
+                    dd.logger.warning("Abandoned after 100 failures.")
+                    break
+        self.must_register = []
+
     def par_class(self, row):
         # wer eine nationalregisternummer hat ist eine Person, selbst wenn er
         # auch eine MwSt-Nummer hat.
@@ -211,6 +276,7 @@ class TimLoader(object):
         #     raise Exception("Journal type not recognized: %s" % row.idjnl)
         return vcl, kw
         
+    @dbf_columns('IDJNL', 'LIBELL', 'DC', 'SEQ', 'ALIAS', 'IDCTR', 'IDGEN')
     def load_jnl(self, row, **kw):
         vcl = None
         kw.update(ref=row.idjnl.strip(), name=row.libell)
@@ -223,17 +289,34 @@ class TimLoader(object):
         if vcl is not None:
             return vcl.create_journal(**kw)
 
-    def load_dbf(self, tableName, row2obj=None):
-        if row2obj is None:
-            row2obj = getattr(self, 'load_' + tableName[-3:].lower())
+    def get_dbf_filename(self, tableName):
         fn = self.dbpath
         if self.archive_name is not None:
             if tableName in self.archived_tables:
                 fn = os.path.join(fn, self.archive_name)
         fn = os.path.join(fn, tableName)
-        fn += dd.plugins.tim2lino.dbf_table_ext
+        return fn + dd.plugins.tim2lino.dbf_table_ext
+
+    def load_dbf(self, tableName, row2obj=None):
+        if row2obj is None:
+            row2obj = getattr(self, 'load_' + tableName[-3:].lower())
+        fn = self.get_dbf_filename(tableName)
         count = 0
-        if dd.plugins.tim2lino.use_dbf_py:
+        if dd.plugins.tim2lino.use_mmap:
+            table = DBFTable(fn, self.codepage,
+                             getattr(row2obj, 'dbf_columns', None))
+            dd.logger.info("Loading %d records from %s...", len(table), fn)
+            for record in table:
+                try:
+                    yield row2obj(record)
+                    count += 1
+                except Exception as e:
+                    traceback.print_exc()
+                    dd.logger.warning(
+                        "Failed to load record %s from %s : %s",
+                        record, tableName, e)
+            table.close()
+        elif dd.plugins.tim2lino.use_dbf_py:
             dd.logger.info("Loading %s...", fn)
             import dbf  # http://pypi.python.org/pypi/dbf/
             # table = dbf.Table(fn)
@@ -297,6 +380,275 @@ class TimLoader(object):
             "{} rows have been loaded from {}.".format(count, fn))
         self.after_load(tableName)
 
+    def bulk_load_dbf(self, tableName, row2obj=None):
+        """Load the given table like :meth:`load_dbf`, but write the
+        objects to the database in batches of :attr:`bulk_size`, each
+        batch in one transaction.
+
+        Returns a tuple `(count, seconds)`.
+
+        """
+        started = time.time()
+        count = 0
+        batch = []
+        for obj in self.expand(self.load_dbf(tableName, row2obj)):
+            if self.has_unsaved_relations(obj):
+                self.flush_batch(batch)
+                batch = []
+            try:
+                obj.full_clean(validate_unique=False)
+            except ValidationError as e:
+                dd.logger.warning(
+                    "Ignored %s from %s : %s", dd.obj2str(obj), tableName, e)
+                continue
+            batch.append(obj)
+            count += 1
+            if len(batch) >= self.bulk_size:
+                self.flush_batch(batch)
+                batch = []
+        self.flush_batch(batch)
+        seconds = time.time() - started
+        dd.logger.info(
+            "Wrote %d objects from %s in %.2f seconds (%.0f per second).",
+            count, tableName, seconds, count / seconds if seconds else 0)
+        return count, seconds
+
+    def has_unsaved_relations(self, obj):
+        """Return `True` if the given object points to another object
+        which hasn't yet been written to the database.  Also update
+        the foreign key values of relations to objects that have been
+        written since they were assigned.
+
+        """
+        for f in obj._meta.concrete_fields:
+            if f.is_relation and getattr(obj, f.attname) is None:
+                other = getattr(obj, f.name, None)
+                if other is not None:
+                    if other.pk is None:
+                        return True
+                    setattr(obj, f.attname, other.pk)
+        return False
+
+    def flush_batch(self, objs):
+        """Write the given objects to the database.
+
+        Consecutive objects of a same model are written using a single
+        `bulk_create`.  Objects of models with multi-table inheritance
+        (for which Django cannot create in bulk) and objects that were
+        read from the database are saved one by one.  Primary keys are
+        assigned before writing so that other objects can refer to
+        them.  :meth:`reset_sequences` must be called before any other
+        objects of these models get saved.
+
+        """
+        if len(objs) == 0:
+            return
+        with transaction.atomic():
+            i = 0
+            while i < len(objs):
+                model = objs[i].__class__
+                j = i
+                while j < len(objs) and objs[j].__class__ is model:
+                    j += 1
+                new = []
+                for obj in objs[i:j]:
+                    self.has_unsaved_relations(obj)
+                    if model._meta.parents or not obj._state.adding:
+                        obj.save()
+                    else:
+                        if obj.pk is None:
+                            obj.pk = self.get_next_id(model)
+                        new.append(obj)
+                if len(new):
+                    model.objects.bulk_create(new)
+                    for obj in new:
+                        obj._state.adding = False
+                i = j
+
+    def get_next_id(self, model):
+        if model not in self.next_ids:
+            if not isinstance(model._meta.pk, models.AutoField):
+                raise Exception("Cannot number {} objects".format(model))
+            d = model.objects.aggregate(models.Max('pk'))
+            self.next_ids[model] = (d['pk__max'] or 0) + 1
+        pk = self.next_ids[model]
+        self.next_ids[model] = pk + 1
+        return pk
+
+    def reset_sequences(self):
+        """Reset the database sequences of the models for which
+        :meth:`flush_batch` has assigned primary keys.
+
+        """
+        sql = connection.ops.sequence_reset_sql(
+            no_style(), list(self.next_ids.keys()))
+        if len(sql):
+            with connection.cursor() as cursor:
+                for line in sql:
+                    cursor.execute(line)
+
+    def get_sync_key(self, tableName, row):
+        values = []
+        for name in self.sync_keys[tableName]:
+            v = getattr(row, name.lower())
+            if isinstance(v, six.string_types):
+                v = v.strip()
+            values.append(six.text_type(v))
+        return '|'.join(values)
+
+    def sync_find(self, tableName, key):
+        """Return a queryset with the database objects which have been
+        created from the records with the given key in the given
+        master table, or `None` if there is no ``sync_find_xxx``
+        method for that table.
+
+        """
+        m = getattr(self, 'sync_find_' + tableName[-3:].lower(), None)
+        if m is not None:
+            return m(*key.split('|'))
+
+    def sync_lookup(self, obj):
+        """Return the database object which corresponds to the given
+        unsaved object, or `None`.  This is used for objects which
+        don't have an explicit primary key.  The default
+        implementation looks up objects having a `ref` field.
+
+        """
+        ref = getattr(obj, 'ref', None)
+        if ref:
+            return obj.__class__.objects.filter(ref=ref).first()
+
+    def sync_delete(self, tableName, key):
+        qs = self.sync_find(tableName, key)
+        if qs is None:
+            dd.logger.warning(
+                "Cannot delete %s record %s", tableName, key)
+            return
+        ses = None
+        if self.ROOT is not None:
+            ses = rt.login(self.ROOT.username)
+        for obj in qs:
+            if isinstance(obj, rt.models.ledger.Voucher):
+                obj.deregister_voucher(ses)
+                obj = obj.get_mti_leaf()
+            try:
+                obj.delete()
+            except Exception as e:
+                dd.logger.warning(
+                    "Failed to delete %s : %s", dd.obj2str(obj), e)
+
+    def sync_save(self, obj):
+        if obj.pk is None and obj._state.adding:
+            existing = self.sync_lookup(obj)
+            if existing is not None:
+                obj.pk = existing.pk
+                obj._state.adding = False
+        try:
+            obj.full_clean()
+            obj.save()
+        except Exception as e:
+            dd.logger.warning(
+                "Failed to save %s : %s", dd.obj2str(obj), e)
+            return False
+        return True
+
+    def sync_group(self, group, state):
+        """Synchronize the given group of :attr:`sync_tables`.
+
+        `state` is a dict with the checksum and the record hashes of
+        every table as they were at the previous run.  It is updated
+        in place.  Returns the number of keys that have been loaded
+        again or deleted.
+
+        Keys whose records failed to load or save are not stored in
+        the state, so they are tried again at the next run.
+
+        """
+        tables = []
+        for tableName, methodName in group:
+            if tableName not in tables:
+                tables.append(tableName)
+        checksums = dict()
+        for t in tables:
+            checksums[t] = dbf_checksum(self.get_dbf_filename(t))
+        if all([state.get(t, {}).get('checksum') == checksums[t]
+                for t in tables]):
+            dd.logger.info("%s : unchanged", ', '.join(tables))
+            return 0
+        started = time.time()
+        hashes = dict()
+        changed = set()
+        for t in tables:
+            old = state.get(t, {}).get('records', {})
+            new = read_dbf_hashes(
+                self.get_dbf_filename(t), self.sync_keys[t], self.codepage)
+            for k, h in new.items():
+                if old.get(k) != h:
+                    changed.add(k)
+            for k in old:
+                if k not in new:
+                    changed.add(k)
+            hashes[t] = new
+        master = tables[0]
+        old = state.get(master, {}).get('records', {})
+        deleted = set([k for k in old if k not in hashes[master]])
+        changed = set([k for k in changed if k in hashes[master]])
+
+        failed = set()
+        current = [None]
+
+        def sync_filter(tableName, row2obj):
+            if row2obj is None:
+                row2obj = getattr(self, 'load_' + tableName[-3:].lower())
+
+            def f(row):
+                key = self.get_sync_key(tableName, row)
+                if key in changed:
+                    current[0] = key
+                    try:
+                        return row2obj(row)
+                    except Exception:
+                        failed.add(key)
+                        raise
+            columns = getattr(row2obj, 'dbf_columns', None)
+            if columns is not None:
+                f.dbf_columns = columns + self.sync_keys[tableName]
+            return f
+
+        with transaction.atomic():
+            for key in deleted:
+                self.sync_delete(master, key)
+            if master in self.sync_replace:
+                for key in changed:
+                    self.sync_delete(master, key)
+            if len(changed):
+                for tableName, methodName in group:
+                    row2obj = None
+                    if methodName is not None:
+                        row2obj = getattr(self, methodName)
+                    for obj in self.expand(self.load_dbf(
+                            tableName, sync_filter(tableName, row2obj))):
+                        if not self.sync_save(obj):
+                            failed.add(current[0])
+            self.register_vouchers()
+        for t in tables:
+            records = hashes[t]
+            checksum = checksums[t]
+            if failed:
+                records = dict([(k, h) for k, h in records.items()
+                                if k not in failed])
+                checksum = None
+            state[t] = dict(checksum=checksum, records=records)
+        dd.logger.info(
+            "%s : %d changed and %d deleted keys in %.2f seconds",
+            ', '.join(tables), len(changed), len(deleted),
+            time.time() - started)
+        if failed:
+            dd.logger.warning(
+                "%s : %d keys failed and will be retried",
+                ', '.join(tables), len(failed))
+        return len(changed) + len(deleted)
+
     def after_load(self, tableName):
         for tableName2, func in dd.plugins.tim2lino.load_listeners:
             if tableName2 == tableName:
@@ -338,4 +690,143 @@ class TimLoader(object):
             # temporary:
             # dd.logger.info("Saved %s", dd.obj2str(o))
         self.finalize()
+
+    @classmethod
+    def run_sync(cls, statefile=None):
+        """Like :meth:`run`, but load only the records that have changed
+        since the previous run.  The tables are specified by
+        :attr:`sync_tables`.
+
+        The checksum of every table and a hash of every record are
+        stored in the file `statefile` (default
+        :attr:`sync_state_file
+        <lino_xl.lib.tim2lino.Plugin.sync_state_file>`).  A table
+        whose file hasn't changed is not read at all.  Every group of
+        tables is synchronized in one transaction, and the state file
+        is written after each group, so a run that has been
+        interrupted continues with the group that failed.
+
+        Returns the number of keys that have been loaded again or
+        deleted.
+
+        """
+        if statefile is None:
+            statefile = dd.plugins.tim2lino.sync_state_file
+            if statefile is None:
+                statefile = os.path.join(
+                    settings.SITE.cache_dir, 'tim2lino_sync.json')
+        self = cls(settings.SITE.legacy_data_path)
+        for o in self.expand(self.create_users()):
+            qs = o.__class__.objects.filter(pk=o.pk)
+            if o.pk is not None and qs.exists():
+                if o is self.ROOT:
+                    self.ROOT = qs.get()
+            else:
+                o.full_clean()
+                o.save()
+        state = load_sync_state(statefile)
+        count = 0
+        for group in self.sync_tables:
+            count += self.sync_group(group, state)
+            save_sync_state(statefile, state)
+        self.finalize()
+        return count
+
+    def run_bulk_job(self, job):
+        rv = []
+        for tableName, methodName in job:
+            row2obj = None
+            if methodName is not None:
+                row2obj = getattr(self, methodName)
+            count, seconds = self.bulk_load_dbf(tableName, row2obj)
+            rv.append((tableName, count, seconds))
+        self.reset_sequences()
+        self.next_ids = dict()
+        return rv
+
+    @classmethod
+    def run_bulk(cls, workers=None):
+        """Like :meth:`run`, but load the tables specified by
+        :attr:`bulk_tables` using :meth:`bulk_load_dbf`.
+
+        The jobs of a stage are processed in a pool of `workers`
+        processes (default :attr:`worker_processes
+        <lino_xl.lib.tim2lino.Plugin.worker_processes>`).  When the
+        database is SQLite or when `workers` is less than 2, everything
+        is processed in the current process.
+
+        Returns a list of tuples `(tableName, count, seconds)`.
+
+        """
+        if workers is None:
+            workers = dd.plugins.tim2lino.worker_processes
+        if connection.vendor == 'sqlite':
+            workers = 0
+        self = cls(settings.SITE.legacy_data_path)
+        for o in self.expand(self.create_users()):
+            o.full_clean()
+            o.save()
+        rv = []
+        for stage in self.bulk_tables:
+            if workers < 2 or len(stage) < 2:
+                for job in stage:
+                    rv += self.run_bulk_job(job)
+                continue
+            # The worker processes must not share the database
+            # connection of this process.
+            for conn in connections.all():
+                conn.close()
+            root = None if self.ROOT is None else self.ROOT.pk
+            tasks = [(cls.__module__, cls.__name__, self.dbpath, root, job)
+                     for job in stage]
+            if hasattr(multiprocessing, 'get_context'):
+                pool = multiprocessing.get_context('fork').Pool(
+                    processes=min(workers, len(tasks)))
+            else:
+                pool = multiprocessing.Pool(
+                    processes=min(workers, len(tasks)))
+            try:
+                for rows, registered in pool.imap_unordered(
+                        bulk_load_worker, tasks):
+                    rv += rows
+                    for label, pk in registered:
+                        m = dd.resolve_model(label)
+                        self.must_register.append(m.objects.get(pk=pk))
+            finally:
+                pool.close()
+                pool.join()
+        for tableName, count, seconds in rv:
+            dd.logger.info(
+                "%s : %d objects in %.2f seconds (%.0f per second)",
+                tableName, count, seconds, count / seconds if seconds else 0)
+        self.finalize()
+        return rv
+
+
+def load_sync_state(filename):
+    if os.path.exists(filename):
+        with open(filename) as f:
+            return json.load(f)
+    return dict()
+
+
+def save_sync_state(filename, data):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, filename)
+
+
+def bulk_load_worker(args):
+    """Run one job of :meth:`TimLoader.run_bulk` in a worker process.
+
+    """
+    module, name, dbpath, root, job = args
+    self = getattr(import_module(module), name)(dbpath)
+    if root is not None:
+        self.ROOT = settings.SITE.user_model.objects.get(pk=root)
+    rows = self.run_bulk_job(job)
+    registered = [(dd.full_model_name(doc.__class__), doc.pk)
+                  for doc in self.must_register]
+    return rows, registered
     
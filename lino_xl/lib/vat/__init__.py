@@ -57,6 +57,7 @@ class Plugin(ad.Plugin):
         if isinstance(self.default_vat_class, six.string_types):
             self.default_vat_class = vat.VatClasses.get_by_name(
                 self.default_vat_class)
+        vat.VatRules.build_index()
 
     def setup_reports_menu(self, site, user_type, m):
         mg = site.plugins.accounts
@@ -224,6 +224,18 @@ class DeclarationField(dd.Choice):
     #     # return self.text
     #     return "[{}] {}".format(self.value, self.text)
 
+    def matches(self, vat_column, vat_class, vat_regime):
+        """Return `True` if this field is interested in movements with
+        the given VAT column, class and regime.
+
+        Used by :meth:`VatDeclaration.get_payable_sums_dict
+        <lino_xl.lib.vat.mixins.VatDeclaration.get_payable_sums_dict>`
+        to compute only once per combination which fields must see a
+        movement.
+
+        """
+        return True
+
     def collect_from_movement(self, dcl, mvt, field_values, payable_sums):
         pass
     
@@ -255,24 +267,30 @@ class WritableDeclarationField(DeclarationField):
 
 class MvtDeclarationField(DeclarationField):
     
-    def collect_from_movement(self, dcl, mvt, field_values, payable_sums):
-        # if not mvt.account.declaration_field in self.observed_fields:
-        #     return 0
+    def matches(self, vat_column, vat_class, vat_regime):
         if self.vat_classes is not None:
-            if not mvt.vat_class in self.vat_classes:
-                return
-            if mvt.vat_class in self.exclude_vat_classes:
-                return
+            if not vat_class in self.vat_classes:
+                return False
+            if vat_class in self.exclude_vat_classes:
+                return False
         if self.vat_columns is not None:
-            if not mvt.account.vat_column in self.vat_columns:
-                return
-            if mvt.account.vat_column in self.exclude_vat_columns:
-                return
+            if not vat_column in self.vat_columns:
+                return False
+            if vat_column in self.exclude_vat_columns:
+                return False
         if self.vat_regimes is not None:
-            if not mvt.vat_regime in self.vat_regimes:
-                return
-            if mvt.vat_regime in self.exclude_vat_regimes:
-                return
+            if not vat_regime in self.vat_regimes:
+                return False
+            if vat_regime in self.exclude_vat_regimes:
+                return False
+        return True
+
+    def collect_from_movement(self, dcl, mvt, field_values, payable_sums):
+        # if not mvt.account.declaration_field in self.observed_fields:
+        #     return 0
+        if not self.matches(
+                mvt.account.vat_column, mvt.vat_class, mvt.vat_regime):
+            return
         if mvt.dc == self.dc:
             amount = mvt.amount
         elif self.both_dc:
@@ -418,11 +436,37 @@ class VatRules(dd.ChoiceList):
     item_class = VatRule
     column_names = "value text description"
 
+    _rules_index = None
+    """A dict which maps a tuple `(vat_area, trade_type, vat_regime,
+    vat_class)` to the list of rules which apply to it regardless of
+    their date range.  Built by :meth:`build_index` and reset whenever
+    rules are added or removed.
+
+    """
+
     @classmethod
-    def get_vat_rule(
-            cls, vat_area,
-            trade_type=None, vat_regime=None, vat_class=None,
-            date=None, default=models.NOT_PROVIDED):
+    def add_item_instance(cls, i):
+        cls._rules_index = None
+        return super(VatRules, cls).add_item_instance(i)
+
+    @classmethod
+    def remove_item(cls, i):
+        cls._rules_index = None
+        return super(VatRules, cls).remove_item(i)
+
+    @classmethod
+    def clear(cls):
+        cls._rules_index = None
+        return super(VatRules, cls).clear()
+
+    @classmethod
+    def find_candidates(cls, vat_area, trade_type, vat_regime, vat_class):
+        """Return the list of rules which apply to the given combination
+        when ignoring their date range, in the order of their
+        definition.
+
+        """
+        lst = []
         for i in cls.get_list_items():
             if i.vat_area is not None and vat_area != i.vat_area:
                 continue
@@ -432,6 +476,40 @@ class VatRules(dd.ChoiceList):
                 continue
             if i.vat_regime is not None and vat_regime != i.vat_regime:
                 continue
+            lst.append(i)
+        return lst
+
+    @classmethod
+    def build_index(cls):
+        """Precompute the candidate rules for all combinations of VAT
+        areas, trade types, VAT regimes and VAT classes.  Called at
+        site startup.  Combinations which are not precomputed
+        (e.g. when some argument is `None`) are added to the index
+        when they are first asked for.
+
+        """
+        index = dict()
+        for va in VatAreas.get_list_items():
+            for tt in TradeTypes.get_list_items():
+                for vr in VatRegimes.get_list_items():
+                    for vc in VatClasses.get_list_items():
+                        k = (va, tt, vr, vc)
+                        index[k] = cls.find_candidates(*k)
+        cls._rules_index = index
+
+    @classmethod
+    def get_vat_rule(
+            cls, vat_area,
+            trade_type=None, vat_regime=None, vat_class=None,
+            date=None, default=models.NOT_PROVIDED):
+        index = cls._rules_index
+        if index is None:
+            index = cls._rules_index = dict()
+        k = (vat_area, trade_type, vat_regime, vat_class)
+        candidates = index.get(k)
+        if candidates is None:
+            candidates = index[k] = cls.find_candidates(*k)
+        for i in candidates:
             if date is not None:
                 if i.start_date and i.start_date > date:
                     continue
@@ -29,6 +29,55 @@ from .choicelists import VatClasses, VatRegimes, VatAreas, VatRules
 
 DECLARED_IN = False
 
+
+class MovementSum(object):
+    """A volatile object which looks like a ledger movement and
+    represents the sum of a group of movements with same account,
+    project, VAT class, VAT regime and booking direction.
+
+    """
+    def __init__(self, account, project, vat_class, vat_regime, dc,
+                 amount):
+        self.account = account
+        self.project = project
+        self.vat_class = vat_class
+        self.vat_regime = vat_regime
+        self.dc = dc
+        self.amount = amount
+
+    def __repr__(self):
+        return "MovementSum({0}, {1}, {2}, {3}, {4}, {5})".format(
+            self.account, self.project, self.vat_class, self.vat_regime,
+            self.dc, self.amount)
+
+
+def get_movement_sums(**flt):
+    """Yield a :class:`MovementSum` for every group of ledger
+    movements matching the given filter.  The sums are computed by a
+    single grouped query, and the accounts and projects are fetched
+    in bulk.
+
+    """
+    keys = dd.plugins.ledger.remove_dummy(
+        'account', 'project', 'vat_class', 'vat_regime', 'dc')
+    qs = rt.models.ledger.Movement.objects.filter(**flt)
+    qs = qs.order_by(*keys).values(*keys).annotate(
+        total=models.Sum('amount'))
+    rows = list(qs)
+    accounts = rt.models.accounts.Account.objects.in_bulk(
+        set([row['account'] for row in rows]))
+    projects = dict()
+    if dd.plugins.ledger.project_model:
+        pks = set([row['project'] for row in rows])
+        pks.discard(None)
+        projects = dd.resolve_model(
+            dd.plugins.ledger.project_model).objects.in_bulk(pks)
+    for row in rows:
+        yield MovementSum(
+            accounts[row['account']], projects.get(row.get('project')),
+            row['vat_class'], row['vat_regime'], row['dc'], row['total'])
+
+
 class PartnerDetailMixin(dd.DetailLayout):
     """
     Defines a panel :attr:`ledger`, to be added as a tab panel to your
@@ -540,6 +589,11 @@ class VatDeclaration(Payable, Voucher, Certifiable, PeriodRange):
         As a side effect this updates values in the computed fields of
         this declaration.
 
+        The declarable movements are not loaded one by one but summed
+        up by the database (see :func:`get_movement_sums`), and the
+        declaration fields interested in a given combination of VAT
+        column, class and regime are computed only once.
+
         """
         fields = self.fields_list.get_list_items()
         payable_sums = SumCollector()
@@ -558,13 +612,14 @@ class VatDeclaration(Payable, Voucher, Certifiable, PeriodRange):
             # voucher__declared_in__isnull=True)
 
 
-        qs = rt.models.ledger.Movement.objects.filter(**flt)
-        qs = qs.order_by('voucher__journal', 'voucher__number')
-
-        # print(20170713, qs)
-
-        for mvt in qs:
-            for fld in fields:
+        dispatch = dict()
+        for mvt in get_movement_sums(**flt):
+            k = (mvt.account.vat_column, mvt.vat_class, mvt.vat_regime)
+            flds = dispatch.get(k)
+            if flds is None:
+                flds = [fld for fld in fields if fld.matches(*k)]
+                dispatch[k] = flds
+            for fld in flds:
                 fld.collect_from_movement(
                     self, mvt, sums, payable_sums)
                 # if fld.is_payable:
@@ -16,7 +16,8 @@ from __future__ import unicode_literals
 # import sys
 # PY2 = sys.version_info[0] == 2
 
-install_requires = ['lino', 'odfpy', 'bleach', 'weasyprint', 'appy']
+install_requires = [
+    'lino', 'odfpy', 'bleach', 'weasyprint', 'appy', 'icalendar']
 # install_requires = ['lino', 'odfpy', 'bleach', 'weasyprint']
 
 # if PY2:
@@ -24,14 +24,50 @@ class LibTests(LinoTestCase):
     def test_cal_utils(self):
         self.run_simple_doctests('lino_xl/lib/cal/utils.py')
         
+    def test_ledger_utils(self):
+        self.run_simple_doctests('lino_xl/lib/ledger/utils.py')
+
     def test_vat_utils(self):
         self.run_simple_doctests('lino_xl/lib/vat/utils.py')
 
+    def test_tim2lino_mmapdbf(self):
+        self.run_simple_doctests('lino_xl/lib/tim2lino/mmapdbf.py')
+
 
 class UtilsTests(LinoTestCase):
 
     def test_contacts_utils(self):
         self.run_simple_doctests('lino_xl/lib/contacts/utils.py')
 
+    def test_countries_utils(self):
+        self.run_simple_doctests('lino_xl/lib/countries/utils.py')
+
+
+class SpecsTests(LinoTestCase):
+
+    def test_clearings(self):
+        self.run_simple_doctests('tests/specs/clearings.rst')
+
+    def test_register(self):
+        self.run_simple_doctests('tests/specs/register.rst')
+
+    def test_balances(self):
+        self.run_simple_doctests('tests/specs/balances.rst')
+
+    def test_movement_sums(self):
+        self.run_simple_doctests('tests/specs/movement_sums.rst')
+
+    def test_invoicing(self):
+        self.run_simple_doctests('tests/specs/invoicing.rst')
+
+    def test_auto_events(self):
+        self.run_simple_doctests('tests/specs/auto_events.rst')
+
+    def test_tim2lino_sync(self):
+        self.run_simple_doctests('tests/specs/tim2lino_sync.rst')
+
+    def test_places(self):
+        self.run_simple_doctests('tests/specs/places.rst')
+
 
 from . import test_appy_pod